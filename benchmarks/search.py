@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time user searches.
+
+Builds an in-memory SQLite database holding ``--users`` users spread over
+``--orgs`` organizations, with made-up names of alternating consonants and vowels, then
+times ``--queries`` searches for misspelled names, both over every user and
+within one organization.
+
+    python benchmarks/search.py --users 100000
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seamless_karma import create_app, search
+from seamless_karma.extensions import db
+from seamless_karma.models import Organization, User
+
+CONSONANTS = "bcdfghjklmnprstvwz"
+VOWELS = "aeiouy"
+
+
+def make_name(rng):
+    length = rng.randint(4, 9)
+    letters = [rng.choice(VOWELS if i % 2 else CONSONANTS) for i in range(length)]
+    return "".join(letters).capitalize()
+
+
+def misspell(name, rng):
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice("aeiou") + name[i + 1:]
+
+
+def populate(num_users, num_orgs, rng):
+    db.session.execute(Organization.__table__.insert(), [
+        {"name": "Org {}".format(i)} for i in range(num_orgs)])
+    rows = []
+    for i in range(num_users):
+        first, last = make_name(rng), make_name(rng)
+        rows.append({
+            "username": "{}{}{}".format(first[0], last, i).lower(),
+            "first_name": first,
+            "last_name": last,
+            "organization_id": rng.randint(1, num_orgs),
+            "allocation": Decimal("11.50"),
+        })
+    db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--orgs", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    app = create_app("test")
+    with app.test_request_context():
+        db.create_all()
+        users = populate(args.users, args.orgs, rng)
+        start = time.time()
+        search.users.search("x", ttl=3600)
+        print("{} users, index built in {:.2f}s".format(args.users, time.time() - start))
+        for scoped in (False, True):
+            timings = []
+            for i in range(args.queries):
+                user = rng.choice(users)
+                query = misspell(user["last_name"], rng)
+                group = user["organization_id"] if scoped else None
+                start = time.time()
+                search.users.search(query, group=group, ttl=3600)
+                timings.append(time.time() - start)
+            timings.sort()
+            print("{}:".format("one organization" if scoped else "all users"))
+            for label, value in [
+                    ("median", timings[len(timings) // 2]),
+                    ("p99", timings[int(len(timings) * 0.99)]),
+                    ("max", timings[-1])]:
+                print("  {:<8} {:8.2f}ms".format(label, value * 1000))
+
+
+if __name__ == "__main__":
+    main()
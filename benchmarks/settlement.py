@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time the settlement endpoint for a large organization.
+
+Builds an in-memory SQLite database holding one organization with
+``--users`` users and ``--orders`` orders between them, then times the
+karma query, the settlement solver and the whole API request separately.
+
+    python benchmarks/settlement.py --users 10000 --orders 50000
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seamless_karma import create_app
+from seamless_karma.extensions import db
+from seamless_karma.models import (Organization, User, Vendor, Order,
+    OrderContribution)
+from seamless_karma.settlement import organization_balances, settle
+
+
+def populate(num_users, num_orders, rng):
+    org = Organization(name="Benchmark", default_allocation=Decimal("12.00"))
+    vendor = Vendor(name="Benchmark Deli")
+    db.session.add_all([org, vendor])
+    db.session.commit()
+    db.session.execute(User.__table__.insert(), [{
+        "username": "user{}".format(i),
+        "first_name": "User",
+        "last_name": "{}".format(i),
+        "allocation": Decimal("12.00"),
+        "organization_id": org.id,
+    } for i in range(num_users)])
+    user_ids = [id for (id,) in db.session.query(User.id)]
+    today = date.today()
+    db.session.execute(Order.__table__.insert(), [{
+        "id": i + 1,
+        "for_date": today - timedelta(days=rng.randint(0, 365)),
+        "placed_at": datetime.now(),
+        "vendor_id": vendor.id,
+        "ordered_by_id": rng.choice(user_ids),
+    } for i in range(num_orders)])
+    contributions = []
+    for order_id in range(1, num_orders + 1):
+        for user_id in set(rng.sample(user_ids, rng.randint(1, 4))):
+            contributions.append({
+                "order_id": order_id,
+                "user_id": user_id,
+                "amount": Decimal(rng.randint(100, 1500)) / 100,
+            })
+    db.session.execute(OrderContribution.__table__.insert(), contributions)
+    db.session.commit()
+    return org.id
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print("{:<24} {:8.3f}s".format(label, time.time() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app("test")
+    with app.test_request_context():
+        db.create_all()
+        org_id = timed("populate", populate, args.users, args.orders,
+                       random.Random(args.seed))
+        balances = timed("karma query", organization_balances, org_id)
+        payments = timed("settle", settle, balances)
+        print("{} users with non-zero karma, {} payments".format(
+            len(balances), len(payments)))
+        client = app.test_client()
+        url = "/api/organizations/{}/settlement".format(org_id)
+        response = timed("GET " + url, client.get, url)
+        assert response.status_code == 200
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time vendor proximity searches.
+
+Builds an in-memory SQLite database holding ``--vendors`` vendors scattered
+over a metropolitan area, then times ``--queries`` searches for vendors
+within ``--radius`` kilometers of random points in it.
+
+    python benchmarks/vendors_near.py --vendors 100000 --radius 1
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seamless_karma import create_app, geo
+from seamless_karma.extensions import db
+from seamless_karma.models import Vendor
+
+# roughly the five boroughs of New York City
+SOUTH, NORTH = 40.50, 40.92
+WEST, EAST = -74.25, -73.70
+
+
+def populate(num_vendors, rng):
+    rows = []
+    for i in range(num_vendors):
+        lat = round(rng.uniform(SOUTH, NORTH), 6)
+        lon = round(rng.uniform(WEST, EAST), 6)
+        rows.append({
+            "name": "Vendor {}".format(i),
+            "latitude": Decimal(str(lat)),
+            "longitude": Decimal(str(lon)),
+            "geocell": geo.cell(lat, lon),
+        })
+    db.session.execute(Vendor.__table__.insert(), rows)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--vendors", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--radius", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    app = create_app("test")
+    with app.test_request_context():
+        db.create_all()
+        populate(args.vendors, rng)
+        timings = []
+        found = 0
+        for i in range(args.queries):
+            lat, lon = rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST)
+            start = time.time()
+            found += len(Vendor.near(lat, lon, args.radius))
+            timings.append(time.time() - start)
+            db.session.expunge_all()
+        timings.sort()
+        print("{} vendors, {} queries, radius {} km, {:.1f} vendors found on average".format(
+            args.vendors, args.queries, args.radius, found / args.queries))
+        for label, value in [
+                ("median", timings[len(timings) // 2]),
+                ("p90", timings[int(len(timings) * 0.9)]),
+                ("max", timings[-1])]:
+            print("{:<8} {:8.2f}ms".format(label, value * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# gunicorn configuration
+#
+# Every worker process has its own connection pool, so the database sees up
+# to workers * (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW) connections.
+# Set DATABASE_MAX_CONNECTIONS to the connections available to this app
+# (Postgres `max_connections`, minus whatever else connects to it) to keep
+# the number of workers below that limit.
+import os
+import multiprocessing
+
+pool_size = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+max_overflow = int(os.environ.get("DATABASE_MAX_OVERFLOW", 5))
+
+workers = int(os.environ.get(
+    "WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+if "DATABASE_MAX_CONNECTIONS" in os.environ:
+    max_connections = int(os.environ["DATABASE_MAX_CONNECTIONS"])
+    workers = max(1, min(workers, max_connections // (pool_size + max_overflow)))
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", 8000))
+
+# live update streams stay open for as long as someone is watching, which a
+# sync worker would time out, so each worker serves requests on threads
+# (threads share their worker's connection pool, and streams don't hold a
+# connection while they wait)
+threads = int(os.environ.get("WEB_THREADS", 8))
+# but each open stream keeps its thread, so leave at least half of them for
+# other requests; streams past the limit get a 503. Use seamless_karma.aio
+# for processes that hold a lot of streams.
+os.environ.setdefault("LIVE_MAX_STREAMS", str(threads // 2))
+
+# metrics from every worker are collected in this directory; see
+# seamless_karma/stats.py
+os.environ.setdefault("METRICS_DIR", "/tmp/seamless_karma_metrics")
+
+
+def on_starting(server):
+    from seamless_karma.stats import clear_metrics_dir
+    clear_metrics_dir()
+
+
+def child_exit(server, worker):
+    from seamless_karma.stats import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from seamless_karma import create_app
-from seamless_karma.models import db, User, Organization, Order, OrderContribution
+from seamless_karma.models import (db, User, Organization, Vendor, Order,
+    OrderContribution, DailyUserUsage, DailyUserKarma, UserKarmaRollup, Change)
+from seamless_karma.shards import copy_to_shards
 from flask import current_app
 from flask.ext.script import Manager, prompt_bool
 import sqlalchemy as sa
@@ -8,6 +10,8 @@ import subprocess as sp
 import os
 from path import path
 import hashlib
+import json
+from datetime import timedelta
 
 
 manager = Manager(create_app)
@@ -81,6 +85,35 @@ def collectstatic(dry_run, input):
         os.symlink(sourcemap_hash.name, latest_sourcemap)
 
 
+@manager.option('-n', '--limit', type=int, default=20,
+    help="number of entries to show (default 20)")
+@manager.option('--json', dest='as_json', action='store_true', default=False,
+    help="print entries as JSON, one per line")
+def slowlog(limit, as_json):
+    """
+    Show the most recent entries in the slow query log.
+    """
+    log = current_app.extensions.get("slowlog")
+    if log is None:
+        print("The slow query log is not enabled: set SLOW_QUERY_THRESHOLD")
+        return
+    for entry in log.entries()[-limit:]:
+        if as_json:
+            print(json.dumps(entry))
+            continue
+        print("{time} {duration_ms}ms {method} {path} ({resource})".format(
+            time=entry["time"], duration_ms=entry["duration_ms"],
+            method=entry.get("method", "-"), path=entry.get("path", "-"),
+            resource=entry.get("resource") or entry.get("endpoint") or "no request"))
+        print("  " + entry["statement"].replace("\n", "\n  "))
+        print("  parameters: {}".format(entry["parameters"]))
+        for line in entry.get("plan", []):
+            print("  | {}".format(line))
+        if "plan_error" in entry:
+            print("  could not explain: {}".format(entry["plan_error"]))
+        print("")
+
+
 ### DATABASE MANAGEMENT ###
 dbmanager = Manager(usage="Perform database operations")
 
@@ -90,6 +123,7 @@ def drop():
     "Drops database tables"
     if prompt_bool("Are you sure you want to lose all your data"):
         db.drop_all()
+        current_app.extensions["shards"].drop_all()
         db.session.commit()
 
 
@@ -97,6 +131,7 @@ def drop():
 def create():
     "Creates database tables from sqlalchemy models"
     db.create_all()
+    current_app.extensions["shards"].create_all()
     db.session.commit()
 
 
@@ -107,6 +142,41 @@ def recreate():
     create()
 
 
+@dbmanager.command
+def rebuild_usage():
+    "Regenerates the daily usage and karma summary tables from order_contributions"
+    connection = db.session.connection()
+    DailyUserUsage.rebuild(connection)
+    DailyUserKarma.rebuild(connection)
+    UserKarmaRollup.rebuild(connection)
+    db.session.commit()
+
+
+@dbmanager.command
+def rebuild_geocells():
+    "Recomputes the grid cell of every vendor, for proximity searches"
+    Vendor.update_geocells(db.session.connection())
+    db.session.commit()
+
+
+@dbmanager.command
+def compact_changes():
+    "Deletes changes from the change log that every client has seen"
+    deleted = Change.compact(
+        cursor_ttl=timedelta(days=current_app.config.get("CHANGE_CURSOR_TTL_DAYS", 7)),
+        max_age=timedelta(days=current_app.config.get("CHANGE_LOG_MAX_AGE_DAYS", 30)),
+    )
+    db.session.commit()
+    print("Deleted {} changes".format(deleted))
+
+
+@dbmanager.command
+def copy_vendors():
+    "Copies every vendor from the default database to every shard"
+    for vendor in Vendor.query:
+        copy_to_shards(vendor)
+
+
 @dbmanager.command
 def sql():
     "Dumps SQL for creating database tables"
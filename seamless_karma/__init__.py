@@ -5,6 +5,8 @@ from flask import Flask, render_template
 from .extensions import sentry, heroku, db, api
 from .converters import ISODateConverter
 from .context_processors import requirejs
+from .metrics import blueprint as metrics_blueprint
+from . import profiler, slowlog, live, fanout, shards
 from path import path
 
 
@@ -22,6 +24,8 @@ def create_app(config=None):
     register_url_converters(app)
     register_extensions(app)
     register_context_processors(app)
+    register_blueprints(app)
+    register_middleware(app)
 
     @app.route('/')
     def index():
@@ -39,6 +43,10 @@ def register_extensions(app):
 
     db.init_app(app)
     api.init_app(app)
+    slowlog.init_app(app)
+    live.init_app(app)
+    fanout.init_app(app)
+    shards.init_app(app)
 
 
 def register_url_converters(app):
@@ -47,3 +55,11 @@ def register_url_converters(app):
 
 def register_context_processors(app):
     app.context_processor(requirejs)
+
+
+def register_blueprints(app):
+    app.register_blueprint(metrics_blueprint)
+
+
+def register_middleware(app):
+    profiler.init_app(app)
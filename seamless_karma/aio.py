@@ -0,0 +1,276 @@
+# coding=utf-8
+"""
+An asyncio HTTP server for the app, for processes that hold a lot of live
+update streams (see :mod:`seamless_karma.live`).
+
+Under gunicorn, every open stream takes one of its worker's threads for as
+long as someone is watching, so a few idle browser tabs can leave no
+threads for ordinary requests. This server runs the same app, with the same
+routes and payloads, but only ever gives a request a thread while the app
+is working on it: views, and the SQLAlchemy queries they make, run on a
+fixed pool of threads, and once a view returns an
+:class:`~seamless_karma.live.EventStream`, the stream is sent from the
+event loop, which waits on every stream at once. An idle stream costs a
+socket and a few kilobytes, not a thread or a database connection.
+
+It speaks enough HTTP/1.1 to sit behind the Heroku router or nginx:
+keep-alive, and request bodies with a ``Content-Length``. It needs Python
+3.5 or later::
+
+    python -m seamless_karma.aio --config prod --port $PORT
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_to_bytes
+from seamless_karma import create_app
+from seamless_karma.live import EventStream, KEEPALIVE
+
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 10 * 1024 * 1024
+REASONS = {
+    400: "Bad Request",
+    411: "Length Required",
+    413: "Request Entity Too Large",
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, code=400):
+        super().__init__(code)
+        self.code = code
+
+
+async def read_request(reader):
+    """
+    Read one request from the connection: return its method, target,
+    version, headers and body, or None if the client has hung up between
+    requests.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise BadRequest()
+    except asyncio.LimitOverrunError:
+        raise BadRequest()
+    lines = head.decode("latin-1").split("\r\n")[:-2]
+    try:
+        method, target, version = lines[0].split(" ")
+        headers = []
+        for line in lines[1:]:
+            name, value = line.split(":", 1)
+            headers.append((name.strip(), value.strip()))
+    except ValueError:
+        raise BadRequest()
+    if not version.startswith("HTTP/1."):
+        raise BadRequest()
+    fields = dict((name.lower(), value) for name, value in headers)
+    if "chunked" in fields.get("transfer-encoding", "").lower():
+        raise BadRequest(411)
+    try:
+        length = int(fields.get("content-length", 0))
+    except ValueError:
+        raise BadRequest()
+    if length < 0:
+        raise BadRequest()
+    if length > MAX_BODY_SIZE:
+        raise BadRequest(413)
+    body = await reader.readexactly(length)
+    return method, target, version, headers, body
+
+
+def keep_alive(version, headers):
+    connection = [value.lower() for name, value in headers if name.lower() == "connection"]
+    if version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+def make_environ(request, sockname, peername):
+    method, target, version, headers, body = request
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": str(sockname[0]),
+        "SERVER_PORT": str(sockname[1]),
+        "SERVER_PROTOCOL": version,
+        "REMOTE_ADDR": str(peername[0]) if peername else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers:
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+def call_app(app, environ):
+    """
+    Run the app on a request, and return the status, headers and body of
+    its response. The body is read here, on a worker thread, unless it is
+    an event stream, which is returned as is.
+    """
+    response = []
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response[:] = [status, headers]
+        return chunks.append
+
+    result = app(environ, start_response)
+    if isinstance(result, EventStream):
+        return response[0], response[1], result
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response[0], response[1], b"".join(chunks)
+
+
+def response_head(status, headers):
+    lines = ["HTTP/1.1 " + status]
+    lines.extend("{}: {}".format(name, value) for name, value in headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class Server(object):
+    """
+    Serves a WSGI app, running it on a pool of ``threads`` threads.
+    """
+    def __init__(self, app, threads=8):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads)
+        self.streams = set()
+
+    async def start(self, host="0.0.0.0", port=8000, **kwargs):
+        return await asyncio.start_server(self.handle, host, port,
+                                          limit=MAX_HEADER_SIZE, **kwargs)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        sockname = writer.get_extra_info("sockname")
+        peername = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except BadRequest as e:
+                    writer.write(response_head("{} {}".format(e.code, REASONS[e.code]),
+                        [("Content-Length", "0"), ("Connection", "close")]))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                environ = make_environ(request, sockname, peername)
+                status, headers, body = await loop.run_in_executor(
+                    self.executor, call_app, self.app, environ)
+                if isinstance(body, EventStream):
+                    await self.send_stream(reader, writer, status, headers, body)
+                    return
+                persist = keep_alive(request[2], request[3])
+                names = set(name.lower() for name, _ in headers)
+                if "content-length" not in names:
+                    headers.append(("Content-Length", str(len(body))))
+                if not persist:
+                    headers.append(("Connection", "close"))
+                writer.write(response_head(status, headers))
+                if request[0] != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not persist:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send_stream(self, reader, writer, status, headers, stream):
+        """
+        Send an event stream until the watcher is dropped or the client
+        hangs up. The subscription wakes this up from whichever thread
+        publishes to it.
+        """
+        loop = asyncio.get_event_loop()
+        wakeup = asyncio.Event()
+        stream.subscription.on_message = lambda: loop.call_soon_threadsafe(wakeup.set)
+        # clients send nothing more on a stream, so this only finishes
+        # when they hang up
+        hangup = asyncio.ensure_future(reader.read())
+        self.streams.add(stream)
+        try:
+            writer.write(response_head(status, headers + [("Connection", "close")]))
+            while not stream.finished:
+                # cleared before looking, so that a message published after
+                # looking still wakes this up
+                wakeup.clear()
+                chunks = stream.ready()
+                if chunks:
+                    writer.write(b"".join(chunks))
+                    await writer.drain()
+                    continue
+                waiter = asyncio.ensure_future(wakeup.wait())
+                done, _ = await asyncio.wait([waiter, hangup], timeout=stream.heartbeat,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if hangup in done:
+                    return
+                if not done:
+                    writer.write(KEEPALIVE)
+                    await writer.drain()
+        finally:
+            stream.subscription.on_message = None
+            hangup.cancel()
+            self.streams.discard(stream)
+            stream.close()
+
+
+def serve(app, host="0.0.0.0", port=8000, threads=8):
+    loop = asyncio.get_event_loop()
+    server = Server(app, threads)
+    listener = loop.run_until_complete(server.start(host, port, backlog=2048))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.executor.shutdown()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--config", default="dev")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    # threads share the process's connection pool, so there is no use in
+    # having many more than it has connections
+    parser.add_argument("--threads", type=int,
+                        default=int(os.environ.get("WEB_THREADS", 8)))
+    options = parser.parse_args(args)
+    serve(create_app(options.config), options.host, options.port, options.threads)
+
+
+if __name__ == "__main__":
+    main()
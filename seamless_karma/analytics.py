@@ -0,0 +1,142 @@
+# coding=utf-8
+"""
+Spending statistics for an organization.
+
+Orders are read with one query that adds up each order's contributions in
+the database, and are fetched and folded into the statistics a chunk at a
+time, so memory use doesn't depend on the number of ORM objects. Only the
+order totals are kept, as a compact array of integer cents, since
+percentiles need all of them.
+"""
+from __future__ import unicode_literals
+
+from array import array
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+from seamless_karma.extensions import db
+from seamless_karma.flows import to_cents
+from seamless_karma.models import User, Vendor, Order, OrderContribution
+from seamless_karma.sql_types import Currency
+import sqlalchemy as sa
+from sqlalchemy.sql import type_coerce
+
+CHUNK_SIZE = 5000
+PERCENTILES = (50, 90, 99)
+TOP_VENDORS = 5
+
+
+def mean(total, count):
+    """
+    The mean of ``count`` amounts of cents adding up to ``total``, rounded
+    half up to the cent.
+    """
+    return int((Decimal(total) / count).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def percentile(ordered, p):
+    """
+    Nearest-rank percentile of a sorted sequence.
+    """
+    if not ordered:
+        return None
+    rank = max((p * len(ordered) + 99) // 100, 1)
+    return ordered[rank - 1]
+
+
+class OrganizationStats(object):
+    """
+    Order statistics, built up one chunk of orders at a time. Amounts are
+    in integer cents.
+    """
+    def __init__(self):
+        self.totals = array(str("l"))
+        self.external = 0
+        self.days = {}
+        self.vendors = {}
+
+    def add(self, rows):
+        """
+        Fold in ``(date_ordinal, vendor_id, total_cents, external_cents)``
+        rows, one per order.
+        """
+        for ordinal, vendor_id, total, external in rows:
+            self.totals.append(total)
+            self.external += external
+            count, amount = self.days.get(ordinal, (0, 0))
+            self.days[ordinal] = (count + 1, amount + total)
+            count, amount = self.vendors.get(vendor_id, (0, 0))
+            self.vendors[vendor_id] = (count + 1, amount + total)
+
+    @classmethod
+    def for_organization(cls, org_id, start=None, end=None, chunk_size=CHUNK_SIZE):
+        contributions = OrderContribution.__table__
+        orders = Order.__table__
+        total = type_coerce(sa.func.sum(contributions.c.amount), Currency)
+        external = type_coerce(sa.func.sum(sa.case(
+            [(contributions.c.user_id != orders.c.ordered_by_id, contributions.c.amount)],
+            else_=sa.literal_column("0"),
+        )), Currency)
+        query = (sa.select([orders.c.for_date, orders.c.vendor_id, total, external])
+            .select_from(contributions.join(orders)
+                .join(User.__table__, orders.c.ordered_by_id == User.__table__.c.id))
+            .where(User.__table__.c.organization_id == org_id)
+            .group_by(orders.c.id, orders.c.for_date, orders.c.vendor_id)
+        )
+        if start is not None:
+            query = query.where(orders.c.for_date >= start)
+        if end is not None:
+            query = query.where(orders.c.for_date <= end)
+        stats = cls()
+        # on PostgreSQL, use a server-side cursor so that only one chunk of
+        # rows is held in memory at a time
+        result = (db.session.connection()
+            .execution_options(stream_results=True)
+            .execute(query))
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                stats.add(
+                    (for_date.toordinal(), vendor_id, to_cents(total), to_cents(external))
+                    for for_date, vendor_id, total, external in rows
+                )
+        finally:
+            result.close()
+        return stats
+
+    @property
+    def total(self):
+        return sum(self.totals)
+
+    def order_size(self):
+        ordered = sorted(self.totals)
+        size = {
+            "mean": mean(self.total, len(ordered)) if ordered else None,
+            "max": ordered[-1] if ordered else None,
+        }
+        for p in PERCENTILES:
+            size["p{}".format(p)] = percentile(ordered, p)
+        return size
+
+    def daily(self):
+        """
+        ``(date, order_count, total_cents)`` for every day with orders.
+        """
+        return [(date.fromordinal(ordinal), count, amount)
+                for ordinal, (count, amount) in sorted(self.days.items())]
+
+    def top_vendors(self, n=TOP_VENDORS):
+        """
+        ``(vendor_id, order_count, total_cents)`` for the vendors with the
+        most spent, highest first.
+        """
+        ranked = sorted(self.vendors.items(), key=lambda item: (-item[1][1], item[0]))
+        return [(vendor_id, count, amount) for vendor_id, (count, amount) in ranked[:n]]
+
+
+def vendor_names(vendor_ids):
+    if not vendor_ids:
+        return {}
+    return dict(db.session.query(Vendor.id, Vendor.name)
+        .filter(Vendor.id.in_(vendor_ids)))
@@ -1,6 +1,66 @@
 # production configuration
+import json
 import os
 
 DEBUG = False
 SECRET_KEY = os.environ.get("SECRET_KEY", '\x1c\x19\x90\xaf\x1c\x03(\xbc\n\xf03\x9e\x08,\xafgO\xf0\xb7\xaar\x8b\xc5\x9d')
 SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgres://localhost/seamless_karma")
+
+# connection pool: each gunicorn worker can hold up to
+# DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections
+SQLALCHEMY_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 5))
+SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
+SQLALCHEMY_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", 3600))
+SQLALCHEMY_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "true").lower() == "true"
+SQLALCHEMY_STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", 30000))
+SQLALCHEMY_PGBOUNCER = os.environ.get("PGBOUNCER", "false").lower() == "true"
+
+# organizations on databases of their own: SQLALCHEMY_SHARDS is a JSON
+# object of shard name to database URL, and SHARD_MAP one of organization
+# ID to shard name; see seamless_karma/shards.py
+SQLALCHEMY_SHARDS = json.loads(os.environ.get("SQLALCHEMY_SHARDS", "{}"))
+SHARD_MAP = dict((int(org_id), shard) for org_id, shard in
+                 json.loads(os.environ.get("SHARD_MAP", "{}")).items())
+
+# refuse order changes that would take anyone over their daily allocation
+ENFORCE_ALLOCATIONS = os.environ.get("ENFORCE_ALLOCATIONS", "false").lower() == "true"
+
+# threads that run a request's independent queries at the same time, such
+# as the parts of the organization dashboard; they share the pool with the
+# request threads, so by default there are as many as the pool has room for
+# once every request thread has a connection
+QUERY_FANOUT_THREADS = int(os.environ.get("QUERY_FANOUT_THREADS", max(0,
+    SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW - int(os.environ.get("WEB_THREADS", 8)))))
+
+# on-demand profiling: send this value in an X-Profile-Token header or a
+# profile_token query parameter to get a profile of the request
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+PROFILER_DIR = os.environ.get("PROFILER_DIR")
+
+# slow query log: see `manage.py slowlog`
+if "SLOW_QUERY_THRESHOLD" in os.environ:
+    SLOW_QUERY_THRESHOLD = int(os.environ["SLOW_QUERY_THRESHOLD"])
+SLOW_QUERY_SAMPLE_RATE = float(os.environ.get("SLOW_QUERY_SAMPLE_RATE", 1.0))
+SLOW_QUERY_DIR = os.environ.get("SLOW_QUERY_DIR", "/tmp/seamless_karma_slowlog")
+
+# live updates: worker processes tell each other about changes through
+# sockets in this directory; see seamless_karma/live.py
+LIVE_SOCKET_DIR = os.environ.get("LIVE_SOCKET_DIR", "/tmp/seamless_karma_live")
+# under a threaded server, each open stream takes a thread for as long as
+# someone is watching; past this many per process, new ones get a 503 (see
+# gunicorn_config.py). Unset, as under seamless_karma.aio, there's no limit.
+if "LIVE_MAX_STREAMS" in os.environ:
+    LIVE_MAX_STREAMS = int(os.environ["LIVE_MAX_STREAMS"])
+
+# how long to keep flow matrices for date ranges that are over, in seconds
+FLOWS_CACHE_TTL = int(os.environ.get("FLOWS_CACHE_TTL", 300))
+# how long before karma leaderboards are rebuilt from scratch, in seconds
+LEADERBOARD_TTL = int(os.environ.get("LEADERBOARD_TTL", 300))
+# how long before in-memory search indexes are rebuilt from scratch, in
+# seconds; only used on databases without trigram indexes
+SEARCH_INDEX_TTL = int(os.environ.get("SEARCH_INDEX_TTL", 300))
+# changes are kept until every client seen in the last CHANGE_CURSOR_TTL_DAYS
+# days has synced past them, but no longer than CHANGE_LOG_MAX_AGE_DAYS
+CHANGE_CURSOR_TTL_DAYS = int(os.environ.get("CHANGE_CURSOR_TTL_DAYS", 7))
+CHANGE_LOG_MAX_AGE_DAYS = int(os.environ.get("CHANGE_LOG_MAX_AGE_DAYS", 30))
@@ -5,3 +5,7 @@ SECRET_KEY = "dummy"
 CACHE_NO_NULL_WARNING = True
 
 SQLALCHEMY_DATABASE_URI = "postgres://localhost/seamless_karma_test"
+# in-process caches outlive the database between tests
+FLOWS_CACHE_TTL = 0
+LEADERBOARD_TTL = 0
+SEARCH_INDEX_TTL = 0
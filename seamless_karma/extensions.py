@@ -7,7 +7,7 @@ heroku = Heroku()
 from raven.contrib.flask import Sentry
 sentry = Sentry()
 
-from flask.ext.sqlalchemy import SQLAlchemy
+from .subclass import SQLAlchemy
 db = SQLAlchemy()
 
 from .subclass import Api
@@ -0,0 +1,95 @@
+# coding=utf-8
+"""
+Run independent read queries at the same time, each on its own pooled
+connection.
+
+A view that needs several results that don't depend on each other would
+otherwise run their queries one after another on its session's connection,
+and take as long as all of them put together. :func:`fanout` runs each one
+on a thread from a pool shared by the process, in its own app context and so
+with its own session, and takes about as long as the slowest.
+
+The threads share the process's connection pool with the request threads,
+so ``QUERY_FANOUT_THREADS`` plus the number of request threads should not be
+more than the pool's size and overflow. A request should give its own
+connection back before it fans out, rather than hold it while it waits. Set
+it to 0 to run queries one after another. They always do when the database
+is SQLite in memory, since there every thread gets a database of its own.
+
+Each query goes to the same shard as the request's session (see
+:mod:`seamless_karma.shards`).
+"""
+from __future__ import unicode_literals
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from flask import current_app
+from seamless_karma.extensions import db
+
+
+class Fanout(object):
+    def __init__(self, app):
+        self.app = app
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        # worker processes may be forked after the app is created, and
+        # threads don't survive a fork
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPool(self.app.config["QUERY_FANOUT_THREADS"])
+                self.pid = os.getpid()
+            return self.pool
+
+    def concurrent(self):
+        if not self.app.config["QUERY_FANOUT_THREADS"]:
+            return False
+        url = db.get_engine(self.app).url
+        return not (url.drivername.startswith("sqlite") and
+                    url.database in (None, "", ":memory:"))
+
+    def call(self, shard, func, args):
+        with self.app.app_context():
+            db.session().shard = shard
+            if db.engine.name == "postgresql":
+                db.session.execute("SET TRANSACTION READ ONLY")
+            try:
+                return func(*args)
+            finally:
+                db.session.rollback()
+
+    def run(self, queries):
+        if len(queries) < 2 or not self.concurrent():
+            return dict((name, func(*args)) for name, (func, args) in queries.items())
+        pool = self.get_pool()
+        shard = db.session().shard
+        pending = dict((name, pool.apply_async(self.call, (shard, func, args)))
+                       for name, (func, args) in queries.items())
+        # wait for all of them, even if one fails, so that none is still
+        # running when the request ends
+        for result in pending.values():
+            result.wait()
+        return dict((name, result.get()) for name, result in pending.items())
+
+
+def fanout(**queries):
+    """
+    Run queries concurrently, and return a dict of their results. Each
+    keyword argument is the name of a result and a ``(function, args)``
+    tuple. The functions run outside of the request context, so they should
+    take whatever they need from the request as arguments, and they should
+    return plain data rather than model instances, since their sessions are
+    closed as soon as they return. If any of them raises an exception, it is
+    raised again here.
+    """
+    return current_app.extensions["fanout"].run(queries)
+
+
+def init_app(app):
+    app.config.setdefault("QUERY_FANOUT_THREADS", 4)
+    if not hasattr(app, "extensions"):
+        app.extensions = {}
+    app.extensions["fanout"] = Fanout(app)
@@ -0,0 +1,198 @@
+# coding=utf-8
+"""
+Who funds whom: the total amount each user in an organization has
+contributed to orders placed by each other user, as a sparse matrix.
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date
+from flask import current_app
+from seamless_karma.extensions import db
+from seamless_karma.models import User, Order, OrderContribution
+from seamless_karma.signals import orders_changed
+from seamless_karma.sql_types import Currency
+import sqlalchemy as sa
+from sqlalchemy.sql import type_coerce
+
+CACHE_SIZE = 128
+
+
+def to_cents(amount):
+    return int((amount * 100).to_integral_value())
+
+
+class FlowMatrix(object):
+    """
+    A giver → receiver matrix in compressed sparse row (CSR) form. Users are
+    numbered by their position in ``users``, which is sorted by user ID.
+    The receivers that giver ``users[i]`` has funded are
+    ``indices[indptr[i]:indptr[i+1]]``, in ascending order, and the total
+    amount in cents and the number of orders for each of those are at the
+    same positions in ``amounts`` and ``counts``.
+    """
+    def __init__(self, users, indptr, indices, amounts, counts):
+        self.users = users
+        self.indptr = indptr
+        self.indices = indices
+        self.amounts = amounts
+        self.counts = counts
+
+    @classmethod
+    def from_triples(cls, triples):
+        """
+        Build a matrix from ``(giver_id, receiver_id, cents, count)`` tuples
+        in coordinate (COO) form, sorted by giver and then receiver.
+        """
+        triples = list(triples)
+        users = sorted(set(t[0] for t in triples) | set(t[1] for t in triples))
+        position = dict((user_id, i) for i, user_id in enumerate(users))
+        indptr = array(str("l"), [0] * (len(users) + 1))
+        indices = array(str("l"))
+        amounts = array(str("l"))
+        counts = array(str("l"))
+        for giver_id, receiver_id, cents, count in triples:
+            indptr[position[giver_id] + 1] += 1
+            indices.append(position[receiver_id])
+            amounts.append(cents)
+            counts.append(count)
+        for i in range(len(users)):
+            indptr[i + 1] += indptr[i]
+        return cls(array(str("l"), users), indptr, indices, amounts, counts)
+
+    @classmethod
+    def for_organization(cls, org_id, start=None, end=None):
+        """
+        Build the matrix for an organization from a single grouped query.
+        Only contributions to other users' orders count; ``start`` and
+        ``end`` limit the orders by date, inclusively.
+        """
+        total = type_coerce(sa.func.sum(OrderContribution.amount), Currency)
+        query = (db.session.query(
+                OrderContribution.user_id, Order.ordered_by_id,
+                total, sa.func.count(),
+            )
+            .join(Order, OrderContribution.order_id == Order.id)
+            .join(User, Order.ordered_by_id == User.id)
+            .filter(User.organization_id == org_id)
+            .filter(OrderContribution.user_id != Order.ordered_by_id)
+            .group_by(OrderContribution.user_id, Order.ordered_by_id)
+            .order_by(OrderContribution.user_id, Order.ordered_by_id)
+        )
+        if start is not None:
+            query = query.filter(Order.for_date >= start)
+        if end is not None:
+            query = query.filter(Order.for_date <= end)
+        return cls.from_triples(
+            (giver_id, receiver_id, to_cents(amount), count)
+            for giver_id, receiver_id, amount, count in query
+        )
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, giver_id, receiver_id):
+        """
+        Return the amount that one user has given to another, in cents.
+        """
+        row = bisect_left(self.users, giver_id)
+        col = bisect_left(self.users, receiver_id)
+        if row == len(self.users) or self.users[row] != giver_id:
+            return 0
+        if col == len(self.users) or self.users[col] != receiver_id:
+            return 0
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        pos = bisect_left(self.indices, col, lo, hi)
+        if pos < hi and self.indices[pos] == col:
+            return self.amounts[pos]
+        return 0
+
+    def triples(self):
+        """
+        Iterate over ``(giver_id, receiver_id, cents, count)`` for every
+        non-zero entry.
+        """
+        for row, giver_id in enumerate(self.users):
+            for pos in range(self.indptr[row], self.indptr[row + 1]):
+                yield (giver_id, self.users[self.indices[pos]],
+                       self.amounts[pos], self.counts[pos])
+
+    def serialize(self):
+        return {
+            "format": "csr",
+            "users": self.users.tolist(),
+            "indptr": self.indptr.tolist(),
+            "indices": self.indices.tolist(),
+            "amounts": self.amounts.tolist(),
+            "counts": self.counts.tolist(),
+        }
+
+
+class FlowCache(object):
+    """
+    A small LRU cache of flow matrices, for date ranges that are over.
+    An entry is dropped when an order on a date in its range changes in
+    this process, and expires after ``ttl`` seconds in any case, since
+    other processes may change orders too.
+    """
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(start, end):
+        return end is not None and end < date.today()
+
+    def get(self, org_id, start, end):
+        key = (org_id, start, end)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, org_id, start, end, matrix, ttl):
+        with self.lock:
+            self.entries[(org_id, start, end)] = (matrix, time.time() + ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, dates):
+        with self.lock:
+            for key in list(self.entries):
+                org_id, start, end = key
+                if any((start is None or start <= d) and d <= end for d in dates):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = FlowCache()
+
+
+def get_flows(org_id, start=None, end=None):
+    """
+    Return the flow matrix for an organization, from the cache if the date
+    range is over and ``FLOWS_CACHE_TTL`` is not zero.
+    """
+    ttl = current_app.config.get("FLOWS_CACHE_TTL", 300)
+    if not ttl or not FlowCache.cacheable(start, end):
+        return FlowMatrix.for_organization(org_id, start, end)
+    matrix = cache.get(org_id, start, end)
+    if matrix is None:
+        matrix = FlowMatrix.for_organization(org_id, start, end)
+        cache.set(org_id, start, end, matrix, ttl)
+    return matrix
+
+
+@orders_changed.connect
+def invalidate_flows(sender, changes):
+    cache.invalidate(set(for_date for user_id, for_date in changes))
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+A fixed grid over the globe, for finding things near a point with an
+ordinary B-tree index.
+
+Each cell is ``CELL_SIZE`` degrees of latitude by ``CELL_SIZE`` degrees of
+longitude, and is numbered row by row, from the south pole and the
+antimeridian. Cells in the same row have consecutive numbers, so the cells
+overlapping a circle make up one range of numbers per row, and the search
+is one index range scan per row.
+"""
+from __future__ import division, unicode_literals
+
+import math
+
+CELL_SIZE = 0.01
+ROWS = int(round(180 / CELL_SIZE))
+COLUMNS = int(round(360 / CELL_SIZE))
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def _row(lat):
+    return min(int(math.floor((lat + 90) / CELL_SIZE)), ROWS - 1)
+
+
+def _column(lon):
+    return int(math.floor((lon + 180) / CELL_SIZE)) % COLUMNS
+
+
+def cell(lat, lon):
+    """
+    Return the number of the cell containing a point, or None if the
+    point is unknown.
+    """
+    if lat is None or lon is None:
+        return None
+    return _row(float(lat)) * COLUMNS + _column(float(lon))
+
+
+def cell_ranges(lat, lon, radius_km):
+    """
+    Return a list of ``(first, last)`` cell number ranges, inclusive, that
+    together cover every point within ``radius_km`` of the given point.
+    """
+    lat, lon = float(lat), float(lon)
+    lat_delta = radius_km / KM_PER_DEGREE
+    south, north = max(lat - lat_delta, -90), min(lat + lat_delta, 90)
+    # the widest part of the circle is on the parallel closest to a pole
+    widest = max(abs(south), abs(north))
+    if widest >= 90:
+        lon_delta = 180
+    else:
+        lon_delta = lat_delta / math.cos(math.radians(widest))
+    ranges = []
+    for row in range(_row(south), _row(north) + 1):
+        base = row * COLUMNS
+        if lon_delta >= 180:
+            ranges.append((base, base + COLUMNS - 1))
+            continue
+        west, east = _column(lon - lon_delta), _column(lon + lon_delta)
+        if west <= east:
+            ranges.append((base + west, base + east))
+        else:
+            # wraps around the antimeridian
+            ranges.append((base + west, base + COLUMNS - 1))
+            ranges.append((base, base + east))
+    return ranges
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points, by the haversine formula.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, map(float, (lat1, lon1, lat2, lon2)))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
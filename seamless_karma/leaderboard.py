@@ -0,0 +1,168 @@
+# coding=utf-8
+"""
+Karma leaderboards, kept in memory for each organization.
+
+A leaderboard is built from the database the first time it's needed, and
+after that only the users whose karma may have changed are looked up
+again, the next time the leaderboard is read. Each process keeps its own
+leaderboards, and only hears about changes made by that process, so they
+are also rebuilt after ``LEADERBOARD_TTL`` seconds.
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+from bisect import bisect_left, insort
+from seamless_karma.extensions import db
+from seamless_karma.flows import to_cents
+from seamless_karma.models import User
+from seamless_karma.settlement import organization_balances
+from seamless_karma.signals import karma_changed
+
+
+class Leaderboard(object):
+    """
+    The users of one organization, sorted by karma from highest to lowest,
+    and then by user ID. Entries are ``(-karma_cents, user_id)`` tuples in
+    a sorted list, so finding a user's rank or the top N users is a binary
+    search, and changing a user's karma is a binary search plus a shift of
+    the list that is much cheaper than sorting again.
+    """
+    def __init__(self, karma):
+        self.karma = dict(karma)
+        self.entries = sorted((-cents, user_id) for user_id, cents in self.karma.items())
+        self.built_at = time.time()
+
+    @classmethod
+    def build(cls, org_id):
+        karma = dict((user_id, 0) for (user_id,) in
+            db.session.query(User.id).filter(User.organization_id == org_id))
+        karma.update(organization_balances(org_id))
+        return cls(karma)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.karma
+
+    def set(self, user_id, cents):
+        self.remove(user_id)
+        self.karma[user_id] = cents
+        insort(self.entries, (-cents, user_id))
+
+    def remove(self, user_id):
+        if user_id not in self.karma:
+            return
+        entry = (-self.karma.pop(user_id), user_id)
+        del self.entries[bisect_left(self.entries, entry)]
+
+    def top(self, n):
+        """
+        Return ``(user_id, karma_cents)`` for the ``n`` users with the most
+        karma.
+        """
+        return [(user_id, -cents) for cents, user_id in self.entries[:n]]
+
+    def rank(self, user_id):
+        """
+        Return the 1-based rank of a user, or None if they aren't on this
+        leaderboard.
+        """
+        if user_id not in self.karma:
+            return None
+        return bisect_left(self.entries, (-self.karma[user_id], user_id)) + 1
+
+
+class Leaderboards(object):
+    """
+    The leaderboards of every organization this process has been asked
+    about, and the users whose karma has changed since they were last
+    looked up, with the generation in which each was last marked.
+
+    The lock only guards these; queries run without it, so that reading
+    one organization's leaderboard doesn't wait for another's to be built,
+    and commits on other threads can mark users stale in the meantime.
+    """
+    def __init__(self):
+        self.boards = {}
+        self.stale = {}
+        self.generation = 0
+        self.building = 0
+        self.lock = threading.Lock()
+
+    def mark_stale(self, user_ids):
+        with self.lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self.stale[user_id] = self.generation
+
+    def clear(self):
+        with self.lock:
+            self.boards.clear()
+            self.stale.clear()
+
+    def get(self, org_id, ttl):
+        """
+        Return the up-to-date leaderboard for an organization.
+        """
+        with self.lock:
+            board = self.boards.get(org_id)
+            rebuild = board is None or board.built_at + ttl < time.time()
+            if rebuild:
+                self.building += 1
+        if rebuild:
+            try:
+                board = Leaderboard.build(org_id)
+            except Exception:
+                with self.lock:
+                    self.building -= 1
+                raise
+            # in one step, so that no stale user is forgotten in between
+            with self.lock:
+                self.building -= 1
+                self.boards[org_id] = board
+        self.refresh()
+        return board
+
+    def refresh(self):
+        """
+        Look up the organization and karma of the stale users with one
+        query, and move them to the right place on whichever leaderboards
+        are loaded. A user marked stale again while they were being looked
+        up is left for the next read. So are all of them while a leaderboard
+        is being built, since it may have been read before their change.
+        """
+        with self.lock:
+            stale = dict(self.stale)
+        if not stale:
+            return
+        rows = (db.session.query(User.id, User.organization_id, User.karma)
+            .filter(User.id.in_(stale))).all()
+        with self.lock:
+            current = set(user_id for user_id, generation in stale.items()
+                          if self.stale.get(user_id) == generation)
+            found = set()
+            for user_id, org_id, karma in rows:
+                found.add(user_id)
+                if user_id not in current:
+                    continue
+                for other_id, board in self.boards.items():
+                    if other_id != org_id:
+                        board.remove(user_id)
+                if org_id in self.boards:
+                    self.boards[org_id].set(user_id, to_cents(karma))
+            for user_id in current - found:
+                for board in self.boards.values():
+                    board.remove(user_id)
+            if not self.building:
+                for user_id in current:
+                    del self.stale[user_id]
+
+
+leaderboards = Leaderboards()
+
+
+@karma_changed.connect
+def mark_stale(sender, user_ids):
+    leaderboards.mark_stale(user_ids)
@@ -0,0 +1,389 @@
+# coding=utf-8
+"""
+Live updates of unallocated money and karma, for the lunchtime UI.
+
+Watchers subscribe to an organization and a date. When a transaction that
+changes orders commits, the new unallocated balances and karma of the users
+involved are looked up once, and the same message is put on every
+watcher's queue, so a change costs one lookup however many people are
+watching. Users are looked up on the shard of the organization that's
+being watched.
+
+Each process only hears about the changes that it commits. To share them
+between the worker processes on one machine, set ``LIVE_SOCKET_DIR``: each
+process then binds a Unix datagram socket in that directory, and tells the
+other processes' sockets about every change it commits. Each process with
+watchers then does its own lookup.
+"""
+from __future__ import unicode_literals
+
+import errno
+import json
+import os
+import socket
+import threading
+from collections import defaultdict
+from datetime import datetime
+import six
+from six.moves import queue
+import sqlalchemy as sa
+from seamless_karma.extensions import db
+from seamless_karma.models import User
+from seamless_karma.signals import orders_changed, karma_changed, allocations_changed
+from seamless_karma.shards import engines_for
+
+QUEUE_SIZE = 100
+DATAGRAM_SIZE = 65536
+# changes per datagram; each is at most about 30 bytes of JSON
+BATCH_SIZE = 1000
+
+
+class Subscription(object):
+    """
+    One watcher's queue of ``(event, data)`` messages. If the watcher falls
+    more than ``QUEUE_SIZE`` messages behind, it is dropped, and
+    ``overflowed`` is set so that it can start again from scratch. If set,
+    ``on_message`` is called, from the publishing thread, whenever a
+    message is added or the watcher is dropped.
+    """
+    def __init__(self, topic, size=QUEUE_SIZE):
+        self.topic = topic
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+        self.on_message = None
+
+    def get(self, timeout):
+        """
+        Return the next message, or None if there was none for ``timeout``
+        seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def notify(self):
+        if self.on_message is not None:
+            self.on_message()
+
+
+def server_sent_event(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode("utf-8")
+
+
+KEEPALIVE = b": keepalive\n\n"
+
+
+class EventStream(object):
+    """
+    The body of a stream of server-sent events: a first event, then every
+    message for a subscription, until the watcher is dropped.
+
+    Iterating over it blocks while waiting for messages, sending a comment
+    every ``heartbeat`` seconds so that proxies don't time out and so that
+    a client that has gone away is noticed; that suits servers with a
+    thread per request. Servers that can wait for many streams at once use
+    :meth:`ready` and the subscription's ``on_message`` instead (see
+    :mod:`seamless_karma.aio`). Closing the stream unsubscribes.
+    """
+    def __init__(self, hub, subscription, first, heartbeat):
+        self.hub = hub
+        self.subscription = subscription
+        self.pending = [server_sent_event(*first)]
+        self.heartbeat = heartbeat
+        self.finished = False
+
+    def __iter__(self):
+        while not self.finished:
+            chunks = self.ready()
+            if chunks:
+                for chunk in chunks:
+                    yield chunk
+                continue
+            message = self.subscription.get(timeout=self.heartbeat)
+            if message is None:
+                yield KEEPALIVE
+            else:
+                yield server_sent_event(*message)
+
+    def ready(self):
+        """
+        Return the chunks that can be sent right now, without waiting.
+        """
+        chunks, self.pending = self.pending, []
+        while True:
+            message = self.subscription.get(timeout=0)
+            if message is None:
+                break
+            chunks.append(server_sent_event(*message))
+        if self.subscription.overflowed and not self.finished:
+            chunks.append(server_sent_event("resync", None))
+            self.finished = True
+        return chunks
+
+    def close(self):
+        self.hub.unsubscribe(self.subscription)
+
+
+class Hub(object):
+    """
+    The watchers of each ``(organization_id, date)`` topic in this process.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.subscriptions = defaultdict(set)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.relay = None
+
+    def subscribe(self, org_id, for_date, limit=None):
+        """
+        Return a new subscription, or None if ``limit`` is given and this
+        process already has that many watchers.
+        """
+        self.start_relay()
+        subscription = Subscription((org_id, for_date))
+        with self.lock:
+            if limit is not None and self.count >= limit:
+                return None
+            self.subscriptions[subscription.topic].add(subscription)
+            self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            watchers = self.subscriptions.get(subscription.topic)
+            if watchers is not None and subscription in watchers:
+                watchers.remove(subscription)
+                self.count -= 1
+                if not watchers:
+                    del self.subscriptions[subscription.topic]
+
+    def topics(self):
+        with self.lock:
+            return set(self.subscriptions)
+
+    def publish(self, topic, event, data):
+        with self.lock:
+            watchers = list(self.subscriptions.get(topic, ()))
+        for subscription in watchers:
+            try:
+                subscription.queue.put_nowait((event, data))
+            except queue.Full:
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+            subscription.notify()
+
+    def start_relay(self):
+        """
+        Bind this process's socket, if ``LIVE_SOCKET_DIR`` is set. Worker
+        processes may be forked after the app is created, so this happens
+        on first use in each process.
+        """
+        directory = self.app.config.get("LIVE_SOCKET_DIR")
+        if directory and (self.relay is None or self.relay.pid != os.getpid()):
+            with self.lock:
+                if self.relay is None or self.relay.pid != os.getpid():
+                    self.relay = SocketRelay(directory, self)
+
+    def orders_changed(self, changes, relay=True):
+        """
+        Publish the unallocated balances of the users whose orders changed,
+        to the topics that anyone in this process is watching.
+        """
+        if relay:
+            self.start_relay()
+            if self.relay is not None:
+                self.relay.send({"orders": [[user_id, for_date.isoformat()]
+                                            for user_id, for_date in changes]})
+        topics = self.topics()
+        if not topics:
+            return
+        by_date = defaultdict(set)
+        for user_id, for_date in changes:
+            by_date[for_date].add(user_id)
+        watched_orgs = defaultdict(set)
+        for org_id, for_date in topics:
+            watched_orgs[for_date].add(org_id)
+        all_orgs = set(org_id for org_id, _ in topics)
+        for engine, shard_orgs in engines_for(self.app, all_orgs).items():
+            connection = engine.connect()
+            try:
+                for for_date, user_ids in by_date.items():
+                    org_ids = watched_orgs.get(for_date, set()) & shard_orgs
+                    if not org_ids:
+                        continue
+                    rows = connection.execute(
+                        sa.select([User.id, User.organization_id, User.unallocated(for_date)])
+                        .where(User.id.in_(user_ids))
+                        .where(User.organization_id.in_(org_ids))
+                        .order_by(User.id))
+                    updates = defaultdict(list)
+                    for user_id, org_id, unallocated in rows:
+                        updates[org_id].append({
+                            "id": user_id,
+                            "unallocated": six.text_type(unallocated),
+                        })
+                    for org_id, data in updates.items():
+                        self.publish((org_id, for_date), "unallocated", data)
+            finally:
+                connection.close()
+
+    def allocations_changed(self, user_ids, effective, relay=True):
+        """
+        Publish the unallocated balances of users whose allocations changed
+        from the ``effective`` date onwards, to the topics for that date or
+        later that anyone in this process is watching.
+        """
+        if relay:
+            self.start_relay()
+            if self.relay is not None:
+                self.relay.send({"allocations": [[user_id, effective.isoformat()]
+                                                 for user_id in sorted(user_ids)]})
+        changes = set((user_id, for_date)
+                      for _, for_date in self.topics() if for_date >= effective
+                      for user_id in user_ids)
+        if changes:
+            self.orders_changed(changes, relay=False)
+
+    def karma_changed(self, user_ids, relay=True):
+        """
+        Publish the karma of users whose karma changed, to every topic for
+        their organization that anyone in this process is watching.
+        """
+        if relay:
+            self.start_relay()
+            if self.relay is not None:
+                self.relay.send({"karma": sorted(user_ids)})
+        topics = self.topics()
+        if not topics:
+            return
+        watched_orgs = set(org_id for org_id, _ in topics)
+        updates = defaultdict(list)
+        for engine, shard_orgs in engines_for(self.app, watched_orgs).items():
+            connection = engine.connect()
+            try:
+                rows = connection.execute(
+                    sa.select([User.id, User.organization_id, User.karma])
+                    .where(User.id.in_(user_ids))
+                    .where(User.organization_id.in_(shard_orgs))
+                    .order_by(User.id))
+                for user_id, org_id, karma in rows:
+                    updates[org_id].append({"id": user_id, "karma": six.text_type(karma)})
+            finally:
+                connection.close()
+        for org_id, for_date in topics:
+            if org_id in updates:
+                self.publish((org_id, for_date), "karma", updates[org_id])
+
+
+class SocketRelay(object):
+    """
+    Passes changes between the processes on one machine, through a Unix
+    datagram socket per process in a shared directory. Sockets left behind
+    by processes that have exited are removed when sending to them fails.
+    """
+    def __init__(self, directory, hub, name=None):
+        self.directory = directory
+        self.hub = hub
+        self.pid = os.getpid()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, "{}.sock".format(name or self.pid))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        # never hold up a commit because another process is busy
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.thread = threading.Thread(target=self.receive, name="live-relay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def peers(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".sock") and path != self.path:
+                yield path
+
+    def send(self, message):
+        # keep datagrams well under the size limit
+        [(key, values)] = message.items()
+        for start in range(0, len(values), BATCH_SIZE):
+            self.send_datagram(json.dumps({key: values[start:start + BATCH_SIZE]}))
+
+    def send_datagram(self, text):
+        data = text.encode("utf-8")
+        for path in self.peers():
+            try:
+                self.sender.sendto(data, path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                # a peer whose buffer is full misses this change, just as
+                # if it had been restarted
+
+    def receive(self):
+        while True:
+            try:
+                data = self.socket.recv(DATAGRAM_SIZE)
+            except socket.error:
+                # closed
+                return
+            try:
+                message = json.loads(data.decode("utf-8"))
+            except ValueError:
+                continue
+            with self.hub.app.app_context():
+                try:
+                    if "orders" in message:
+                        self.hub.orders_changed(set(
+                            (user_id, datetime.strptime(for_date, "%Y-%m-%d").date())
+                            for user_id, for_date in message["orders"]), relay=False)
+                    if "allocations" in message:
+                        by_date = defaultdict(set)
+                        for user_id, effective in message["allocations"]:
+                            by_date[effective].add(user_id)
+                        for effective, user_ids in by_date.items():
+                            self.hub.allocations_changed(user_ids,
+                                datetime.strptime(effective, "%Y-%m-%d").date(), relay=False)
+                    if "karma" in message:
+                        self.hub.karma_changed(set(message["karma"]), relay=False)
+                except Exception:
+                    self.hub.app.logger.exception("could not publish relayed change")
+                finally:
+                    db.session.remove()
+
+
+def init_app(app):
+    app.config.setdefault("LIVE_SOCKET_DIR", None)
+    app.config.setdefault("LIVE_HEARTBEAT", 15)
+    app.config.setdefault("LIVE_MAX_STREAMS", None)
+    if not hasattr(app, "extensions"):
+        app.extensions = {}
+    app.extensions["live"] = Hub(app)
+
+
+@orders_changed.connect
+def publish_unallocated(sender, changes):
+    hub = getattr(sender, "extensions", {}).get("live")
+    if hub is not None:
+        hub.orders_changed(changes)
+
+
+@karma_changed.connect
+def publish_karma(sender, user_ids):
+    hub = getattr(sender, "extensions", {}).get("live")
+    if hub is not None:
+        hub.karma_changed(user_ids)
+
+
+@allocations_changed.connect
+def publish_allocations(sender, organization_id, user_ids, effective):
+    hub = getattr(sender, "extensions", {}).get("live")
+    if hub is not None:
+        hub.allocations_changed(user_ids, effective)
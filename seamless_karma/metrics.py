@@ -0,0 +1,81 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import time
+import sqlalchemy as sa
+from flask import Blueprint, Response, g, request, has_request_context
+from seamless_karma.stats import Counter, Histogram, render
+
+blueprint = Blueprint("metrics", __name__)
+
+CONTENT_TYPE = str("text/plain; version=0.0.4; charset=utf-8")
+
+REQUESTS = Counter("seamless_karma_http_requests_total",
+    "HTTP requests handled, by endpoint, method and status code.")
+REQUEST_LATENCY = Histogram("seamless_karma_http_request_duration_seconds",
+    "Time spent handling HTTP requests, by endpoint and method.")
+DB_TIME = Counter("seamless_karma_db_query_duration_seconds_total",
+    "Time spent executing SQL statements, by endpoint.")
+DB_QUERIES = Counter("seamless_karma_db_queries_total",
+    "SQL statements executed, by endpoint.")
+DB_ROWS = Counter("seamless_karma_db_rows_total",
+    "Rows returned or affected by SQL statements, by endpoint, as far as "
+    "the database driver reports them.")
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        context._metrics_start = time.time()
+
+
+@sa.event.listens_for(sa.engine.Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is None or not hasattr(g, "metrics_start"):
+        return
+    g.db_time += time.time() - start
+    g.db_queries += 1
+    if cursor.rowcount > 0:
+        g.db_rows += cursor.rowcount
+
+
+@blueprint.before_app_request
+def start_timer():
+    g.metrics_start = time.time()
+    g.db_time = 0.0
+    g.db_queries = 0
+    g.db_rows = 0
+
+
+def record_request(status_code):
+    if not hasattr(g, "metrics_start"):
+        return
+    elapsed = time.time() - g.metrics_start
+    endpoint = request.endpoint or "unknown"
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=status_code)
+    REQUEST_LATENCY.observe(elapsed, endpoint=endpoint, method=request.method)
+    DB_TIME.inc(g.db_time, endpoint=endpoint)
+    DB_QUERIES.inc(g.db_queries, endpoint=endpoint)
+    DB_ROWS.inc(g.db_rows, endpoint=endpoint)
+    del g.metrics_start
+
+
+@blueprint.after_app_request
+def record_response(response):
+    record_request(response.status_code)
+    return response
+
+
+@blueprint.teardown_app_request
+def record_unhandled_exception(exc):
+    # only still pending if the request failed without a response
+    record_request(500)
+
+
+@blueprint.route("/metrics")
+def metrics():
+    """
+    Expose metrics for all worker processes in the Prometheus text format.
+    """
+    return Response(render(), content_type=CONTENT_TYPE)
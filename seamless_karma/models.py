@@ -3,11 +3,15 @@ from __future__ import unicode_literals
 
 from seamless_karma.extensions import db
 from seamless_karma.sql_types import Currency
+from seamless_karma import geo
+from seamless_karma.signals import orders_changed, karma_changed, names_changed
+from flask import current_app, has_app_context
 import sqlalchemy as sa
 from sqlalchemy.orm import backref
 from sqlalchemy.sql import type_coerce
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from decimal import Decimal
+from datetime import date as Date, datetime, timedelta
 
 
 class Organization(db.Model):
@@ -16,6 +20,9 @@ class Organization(db.Model):
     seamless_id = db.Column(db.Integer, unique=True)
     name = db.Column(db.String(256), unique=True, nullable=False)
     default_allocation = db.Column(Currency(scale=2))
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return u"<Organization {!r}>".format(self.name)
@@ -29,6 +36,7 @@ class User(db.Model):
     first_name = db.Column(db.String(256), nullable=False)
     last_name = db.Column(db.String(256), nullable=False)
     allocation = db.Column(Currency(scale=2), nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
 
     organization_id = db.Column(
         db.Integer, db.ForeignKey('organizations.id'), nullable=False
@@ -37,6 +45,11 @@ class User(db.Model):
         Organization, backref=db.backref('users', lazy="dynamic")
     )
 
+    __table_args__ = (
+        db.Index('ix_users_last_name_first_name', 'last_name', 'first_name'),
+    )
+    __mapper_args__ = {"version_id_col": version}
+
     @classmethod
     def create(cls, username, first_name, last_name, organization, allocation=None, seamless_id=None):
         return cls(
@@ -106,32 +119,147 @@ class User(db.Model):
     @participated_on.expression
     def participated_on(cls, date):
         return (
-            db.session.query(Order)
-            .join(OrderContribution)
-            .filter(OrderContribution.user_id == cls.id)
-            .filter(Order.for_date == date)
+            db.session.query(DailyUserUsage)
+            .filter(DailyUserUsage.user_id == cls.id)
+            .filter(DailyUserUsage.for_date == date)
             .exists()
         )
 
+    @hybrid_method
+    def allocation_on(self, date):
+        """
+        The allocation that was in effect for this user on the given date:
+        that of the most recently started allocation period covering the
+        date, or the user's current allocation if no period covers it.
+        """
+        periods = [p for p in self.allocation_periods if p.covers(date)]
+        if not periods:
+            return self.allocation
+        return max(periods, key=lambda p: (p.valid_from, p.id)).allocation
+
+    @allocation_on.expression
+    def allocation_on(cls, date):
+        in_effect = (db.session.query(AllocationPeriod.allocation)
+            .filter(AllocationPeriod.user_id == cls.id)
+            .filter(AllocationPeriod.valid_from <= date)
+            .filter(sa.or_(
+                AllocationPeriod.valid_to == None,
+                AllocationPeriod.valid_to > date,
+            ))
+            .order_by(AllocationPeriod.valid_from.desc(), AllocationPeriod.id.desc())
+            .limit(1)
+            .as_scalar()
+        )
+        return type_coerce(
+            sa.func.coalesce(in_effect, cls.allocation),
+            Currency
+        )
+
+    def change_allocation(self, allocation, effective=None):
+        """
+        Change this user's allocation from the ``effective`` date onwards
+        (today, by default), keeping the allocation in effect on earlier
+        dates. Replaces any of the user's allocation periods that would
+        have started on or after that date.
+        """
+        effective = effective or Date.today()
+        if not self.allocation_periods and self.allocation is not None:
+            # remember what the allocation was before it first changed
+            self.allocation_periods.append(AllocationPeriod(
+                allocation=self.allocation,
+                valid_from=AllocationPeriod.BEGINNING,
+            ))
+        for period in list(self.allocation_periods):
+            if period.valid_from >= effective:
+                self.allocation_periods.remove(period)
+            elif period.valid_to is None or period.valid_to > effective:
+                period.valid_to = effective
+        self.allocation_periods.append(AllocationPeriod(
+            allocation=allocation,
+            valid_from=effective,
+        ))
+        if effective <= Date.today():
+            self.allocation = allocation
+
+    @classmethod
+    def bulk_change_allocation(cls, users, allocation, effective=None):
+        """
+        Change the allocation of every user matched by the ``users`` query,
+        like :meth:`change_allocation`, but with a fixed number of set-based
+        statements no matter how many users there are. Returns the number
+        of users changed.
+        """
+        effective = effective or Date.today()
+        user_ids = users.with_entities(cls.id).subquery()
+        periods = AllocationPeriod.__table__
+        users_table = cls.__table__
+        connection = db.session.connection()
+        # before the allocations change, since ``users`` may filter on them
+        changed = connection.execute(
+            sa.select([users_table.c.id, users_table.c.organization_id])
+            .where(users_table.c.id.in_(sa.select([user_ids.c.id])))
+            .order_by(users_table.c.id)).fetchall()
+        has_period = sa.exists().where(periods.c.user_id == users_table.c.id)
+        # remember what the allocation was before it first changed
+        connection.execute(periods.insert().from_select(
+            ['user_id', 'allocation', 'valid_from'],
+            sa.select([
+                users_table.c.id,
+                users_table.c.allocation,
+                sa.literal(AllocationPeriod.BEGINNING, sa.Date),
+            ])
+            .where(users_table.c.id.in_(sa.select([user_ids.c.id])))
+            .where(~has_period)
+        ))
+        in_users = periods.c.user_id.in_(sa.select([user_ids.c.id]))
+        connection.execute(periods.delete()
+            .where(in_users)
+            .where(periods.c.valid_from >= effective))
+        connection.execute(periods.update()
+            .where(in_users)
+            .where(sa.or_(periods.c.valid_to == None, periods.c.valid_to > effective))
+            .values(valid_to=effective))
+        result = connection.execute(periods.insert().from_select(
+            ['user_id', 'allocation', 'valid_from'],
+            sa.select([
+                user_ids.c.id,
+                sa.literal(allocation, Currency(scale=2)),
+                sa.literal(effective, sa.Date),
+            ])
+        ))
+        if effective <= Date.today():
+            connection.execute(users_table.update()
+                .where(users_table.c.id.in_(sa.select([user_ids.c.id])))
+                .values(allocation=allocation, version=users_table.c.version + 1))
+        # logged at commit, like the ORM's changes (see write_changes)
+        now = datetime.utcnow()
+        db.session.info.setdefault('changes', []).extend({
+            'model': 'user',
+            'object_id': user_id,
+            'action': 'updated',
+            'organization_id': organization_id,
+            'changed_at': now,
+        } for user_id, organization_id in changed)
+        # the rows changed behind the ORM's back
+        db.session.expire_all()
+        return result.rowcount
+
     @hybrid_method
     def unallocated(self, date):
         allocated = sum(o.user_contribution(self.id) for o in self.orders
             if o.for_date == date) or Decimal('0.00')
-        return self.allocation - allocated
+        return self.allocation_on(date) - allocated
 
     @unallocated.expression
     def unallocated(cls, date):
-        allocated = (db.session.query(
-            sa.func.coalesce(
-                sa.func.sum(OrderContribution.amount),
-                Decimal('0.00')
-            ).label('allocated'))
-            .join(Order)
-            .filter(Order.for_date == date)
-            .filter(OrderContribution.user_id == cls.id)
+        allocated = (db.session.query(DailyUserUsage.amount)
+            .filter(DailyUserUsage.user_id == cls.id)
+            .filter(DailyUserUsage.for_date == date)
+            .as_scalar()
         )
         return type_coerce(
-            (cls.allocation - allocated).label('unallocated'),
+            (cls.allocation_on(date) - sa.func.coalesce(allocated, Decimal('0.00')))
+                .label('unallocated'),
             Currency
         )
 
@@ -140,29 +268,85 @@ class Vendor(db.Model):
     __tablename__ = 'vendors'
     id = db.Column(db.Integer, primary_key=True)
     seamless_id = db.Column(db.Integer, unique=True)
-    name = db.Column(db.String(256), nullable=False)
+    name = db.Column(db.String(256), nullable=False, index=True)
     latitude = db.Column(db.Numeric)
     longitude = db.Column(db.Numeric)
+    # the grid cell containing the vendor, for proximity searches; see
+    # seamless_karma.geo
+    geocell = db.Column(db.Integer, index=True)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    @classmethod
+    def near(cls, lat, lon, radius_km):
+        """
+        Return ``(vendor_id, distance_km)`` for every vendor within
+        ``radius_km`` of the given point, nearest first. The database only
+        looks at vendors in the grid cells covering the circle, using the
+        index on ``geocell``; exact distances are worked out here.
+        """
+        ranges = geo.cell_ranges(lat, lon, radius_km)
+        candidates = (db.session.query(cls.id, cls.latitude, cls.longitude)
+            .filter(sa.or_(*[
+                cls.geocell.between(first, last) for first, last in ranges
+            ]))
+        )
+        found = []
+        for vendor_id, vendor_lat, vendor_lon in candidates:
+            distance = geo.distance_km(lat, lon, vendor_lat, vendor_lon)
+            if distance <= radius_km:
+                found.append((distance, vendor_id))
+        found.sort()
+        return [(vendor_id, distance) for distance, vendor_id in found]
+
+    @classmethod
+    def update_geocells(cls, connection):
+        """
+        Recompute ``geocell`` for every vendor.
+        """
+        table = cls.__table__
+        rows = connection.execute(
+            sa.select([table.c.id, table.c.latitude, table.c.longitude]))
+        for vendor_id, lat, lon in rows.fetchall():
+            connection.execute(table.update()
+                .where(table.c.id == vendor_id)
+                .values(geocell=geo.cell(lat, lon)))
+
+
+@sa.event.listens_for(Vendor, "before_insert")
+@sa.event.listens_for(Vendor, "before_update")
+def set_vendor_geocell(mapper, connection, vendor):
+    vendor.geocell = geo.cell(vendor.latitude, vendor.longitude)
 
 
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
     seamless_id = db.Column(db.Integer, unique=True)
-    for_date = db.Column(db.Date, nullable=False)
-    placed_at = db.Column(db.DateTime, nullable=False)
+    # load the old date before changing it, so that daily usage can be
+    # moved from one day to the other
+    for_date = db.column_property(
+        db.Column(db.Date, nullable=False, index=True), active_history=True
+    )
+    placed_at = db.Column(db.DateTime, nullable=False, index=True)
 
     vendor_id = db.Column(
-        db.Integer, db.ForeignKey('vendors.id'), nullable=False
+        db.Integer, db.ForeignKey('vendors.id'), nullable=False, index=True
     )
     vendor = db.relationship(Vendor, backref="orders")
     ordered_by_id = db.Column(
-        db.Integer, db.ForeignKey('users.id'), nullable=False
+        db.Integer, db.ForeignKey('users.id'), nullable=False, index=True
     )
     ordered_by = db.relationship(User, backref="own_orders")
     contributors = db.relationship(
         User, secondary="order_contributions", backref="orders"
     )
+    # also bumped when only the contributions change; see
+    # bump_order_versions()
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return u"<Order {date}>".format(date=self.for_date.isoformat())
@@ -279,3 +463,754 @@ class OrderContribution(db.Model):
             (cls.order_id == Order.id) and
             (cls.user_id == Order.ordered_by_id)
         )
+
+
+class AllocationPeriod(db.Model):
+    """
+    An allocation that was in effect for a user from ``valid_from`` up to,
+    but not including, ``valid_to`` (or indefinitely, if ``valid_to`` is
+    null); see :meth:`User.allocation_on`.
+    """
+    __tablename__ = 'allocation_periods'
+    # the start of a period covering every date before the first change
+    BEGINNING = Date(1900, 1, 1)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    allocation = db.Column(Currency(scale=2), nullable=False)
+    valid_from = db.Column(db.Date, nullable=False)
+    valid_to = db.Column(db.Date)
+
+    user = db.relationship(User, backref=backref(
+        "allocation_periods", cascade="all, delete-orphan",
+        order_by="AllocationPeriod.valid_from",
+    ))
+
+    __table_args__ = (
+        db.Index('ix_allocation_periods_user_id_valid_from',
+            user_id, valid_from),
+    )
+
+    def __repr__(self):
+        return u"<AllocationPeriod {amount} from {start} to {end}>".format(
+            amount=self.allocation, start=self.valid_from, end=self.valid_to)
+
+    def covers(self, date):
+        return (self.valid_from <= date and
+            (self.valid_to is None or date < self.valid_to))
+
+
+def set_summary_row(connection, table, key, values):
+    """
+    Make the row of a summary table whose primary key is ``key``, a dict of
+    column name to value, have ``values``; or delete it if ``values`` is
+    None. The row is updated in place, and only inserted if it's missing,
+    so that two transactions refreshing the same row don't both insert it.
+    If another transaction inserts it first, the insert is rolled back to
+    a savepoint, and the row is updated instead.
+    """
+    where = sa.and_(*[table.c[name] == value for name, value in key.items()])
+    if values is None:
+        connection.execute(table.delete().where(where))
+        return
+    if connection.execute(table.update().where(where).values(**values)).rowcount:
+        return
+    if connection.dialect.name != "postgresql":
+        # SQLite only lets one transaction write at a time
+        connection.execute(table.insert().values(dict(key, **values)))
+        return
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(dict(key, **values)))
+    except sa.exc.IntegrityError:
+        savepoint.rollback()
+        connection.execute(table.update().where(where).values(**values))
+    else:
+        savepoint.commit()
+
+
+class DailyUserUsage(db.Model):
+    """
+    How much of their allocation each user has used on each day, and in how
+    many orders. This is a summary of ``order_contributions``, kept up to
+    date in the same transaction as any change to an order or contribution
+    (see :func:`update_daily_user_usage`), so that a user's unallocated
+    money for a date is a single primary key lookup.
+    """
+    __tablename__ = 'daily_user_usage'
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True
+    )
+    for_date = db.Column(db.Date, primary_key=True)
+    amount = db.Column(Currency(scale=2), nullable=False)
+    order_count = db.Column(db.Integer, nullable=False)
+
+    user = db.relationship(
+        User, backref=db.backref('daily_usage', lazy="dynamic")
+    )
+
+    __table_args__ = (
+        db.Index('ix_daily_user_usage_for_date_user_id', 'for_date', 'user_id'),
+    )
+
+    def __repr__(self):
+        return u"<DailyUserUsage {date} {amount}>".format(
+            date=self.for_date.isoformat(), amount=self.amount)
+
+    @classmethod
+    def summary_query(cls):
+        return (sa.select([
+                OrderContribution.user_id,
+                Order.for_date,
+                sa.func.sum(OrderContribution.__table__.c.amount),
+                sa.func.count(),
+            ])
+            .select_from(OrderContribution.__table__.join(Order.__table__))
+            .group_by(OrderContribution.user_id, Order.for_date)
+        )
+
+    @classmethod
+    def refresh(cls, connection, user_id, for_date):
+        """
+        Recompute the summary row for one user on one day.
+        """
+        row = connection.execute(cls.summary_query()
+            .where(OrderContribution.user_id == user_id)
+            .where(Order.for_date == for_date)).first()
+        set_summary_row(connection, cls.__table__,
+            {"user_id": user_id, "for_date": for_date},
+            row and {"amount": row[2], "order_count": row[3]})
+
+    @classmethod
+    def rebuild(cls, connection):
+        """
+        Regenerate the whole table from ``order_contributions``.
+        """
+        table = cls.__table__
+        connection.execute(table.delete())
+        connection.execute(table.insert().from_select(
+            ['user_id', 'for_date', 'amount', 'order_count'],
+            cls.summary_query()
+        ))
+
+    @classmethod
+    def lock(cls, connection, keys):
+        """
+        Lock the usage of some users on some days, given as ``(user_id,
+        for_date)`` pairs, until the end of the transaction, so that other
+        transactions changing the same users' orders on the same days wait
+        for this one, and no others do. Locks are taken in a fixed order, so
+        that two transactions can't each wait for the other.
+
+        On PostgreSQL, these are advisory locks rather than row locks, since
+        a user's summary row doesn't exist until their first order of the
+        day. SQLite only lets one transaction write at a time, and this one
+        has already written, so there is nothing more to do.
+        """
+        if connection.dialect.name != "postgresql":
+            return
+        for user_id, for_date in sorted(keys):
+            connection.execute(sa.select([
+                sa.func.pg_advisory_xact_lock(user_id, for_date.toordinal())
+            ]))
+
+    @classmethod
+    def amounts(cls, connection, keys):
+        """
+        The amounts used by some users on some days, as a dict of
+        ``(user_id, for_date)`` to amount. Days without orders are left out.
+        """
+        table = cls.__table__
+        rows = connection.execute(sa.select([table.c.user_id, table.c.for_date, table.c.amount])
+            .where(sa.or_(*[
+                sa.and_(table.c.user_id == user_id, table.c.for_date == for_date)
+                for user_id, for_date in keys
+            ])))
+        return dict(((user_id, for_date), amount) for user_id, for_date, amount in rows)
+
+    @classmethod
+    def overdrawn(cls, connection, keys, before):
+        """
+        Return ``(user_id, for_date, unallocated)`` for each of the given
+        users and days that has less than nothing unallocated, and whose
+        usage went up since ``before`` (as returned by :meth:`amounts`).
+        Users who were already over, perhaps because their allocation was
+        lowered afterwards, can still cut back.
+        """
+        after = cls.amounts(connection, keys)
+        overdrawn = []
+        for user_id, for_date in sorted(keys):
+            amount = after.get((user_id, for_date), Decimal('0.00'))
+            if amount <= before.get((user_id, for_date), Decimal('0.00')):
+                continue
+            unallocated = connection.execute(sa.select([User.unallocated(for_date)])
+                .where(User.id == user_id)).scalar()
+            if unallocated is not None and unallocated < 0:
+                overdrawn.append((user_id, for_date, unallocated))
+        return overdrawn
+
+
+class AllocationExceeded(Exception):
+    """
+    Raised by a flush that would take users over their allocation for a
+    day, when ``ENFORCE_ALLOCATIONS`` is set. The flush's transaction has
+    been rolled back.
+    """
+    def __init__(self, overdrawn):
+        self.overdrawn = overdrawn
+        super(AllocationExceeded, self).__init__("; ".join(
+            "user {} would be {} over their allocation on {}".format(
+                user_id, -unallocated, for_date.isoformat())
+            for user_id, for_date, unallocated in overdrawn))
+
+
+class DailyUserKarma(db.Model):
+    """
+    How much each user gave to other users' orders, and received from other
+    users for their own orders, on each day. The difference is the change in
+    their karma that day. Kept up to date in the same transaction as any
+    change to an order or contribution (see :func:`update_karma_history`).
+    """
+    __tablename__ = 'daily_user_karma'
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True
+    )
+    for_date = db.Column(db.Date, primary_key=True)
+    given = db.Column(Currency(scale=2), nullable=False)
+    received = db.Column(Currency(scale=2), nullable=False)
+
+    def __repr__(self):
+        return u"<DailyUserKarma {date} +{given} -{received}>".format(
+            date=self.for_date.isoformat(),
+            given=self.given, received=self.received)
+
+    @classmethod
+    def summary_query(cls, user_id=None, for_date=None):
+        contributions = OrderContribution.__table__
+        orders = Order.__table__
+        external = contributions.c.user_id != orders.c.ordered_by_id
+        zero = sa.literal_column("0")
+        given = (sa.select([
+                contributions.c.user_id.label('user_id'),
+                orders.c.for_date.label('for_date'),
+                contributions.c.amount.label('given'),
+                zero.label('received'),
+            ])
+            .select_from(contributions.join(orders))
+            .where(external)
+        )
+        received = (sa.select([
+                orders.c.ordered_by_id.label('user_id'),
+                orders.c.for_date.label('for_date'),
+                zero.label('given'),
+                contributions.c.amount.label('received'),
+            ])
+            .select_from(contributions.join(orders))
+            .where(external)
+        )
+        if user_id is not None:
+            given = given.where(contributions.c.user_id == user_id)
+            received = received.where(orders.c.ordered_by_id == user_id)
+        if for_date is not None:
+            given = given.where(orders.c.for_date == for_date)
+            received = received.where(orders.c.for_date == for_date)
+        both = sa.union_all(given, received).alias('karma')
+        return (sa.select([
+                both.c.user_id, both.c.for_date,
+                sa.func.sum(both.c.given, type_=Currency(scale=2)),
+                sa.func.sum(both.c.received, type_=Currency(scale=2)),
+            ])
+            .group_by(both.c.user_id, both.c.for_date)
+        )
+
+    @classmethod
+    def refresh(cls, connection, user_id, for_date):
+        """
+        Recompute the row for one user on one day.
+        """
+        row = connection.execute(cls.summary_query(user_id, for_date)).first()
+        set_summary_row(connection, cls.__table__,
+            {"user_id": user_id, "for_date": for_date},
+            row and {"given": row[2], "received": row[3]})
+
+    @classmethod
+    def rebuild(cls, connection):
+        """
+        Regenerate the whole table from ``order_contributions``.
+        """
+        table = cls.__table__
+        connection.execute(table.delete())
+        connection.execute(table.insert().from_select(
+            ['user_id', 'for_date', 'given', 'received'],
+            cls.summary_query()
+        ))
+
+
+class UserKarmaRollup(db.Model):
+    """
+    :class:`DailyUserKarma`, added up by week (starting on Monday) or by
+    month, so that a long karma history only needs a few rows.
+    """
+    __tablename__ = 'user_karma_rollups'
+    GRANULARITIES = ('week', 'month')
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True
+    )
+    granularity = db.Column(db.String(8), primary_key=True)
+    period_start = db.Column(db.Date, primary_key=True)
+    given = db.Column(Currency(scale=2), nullable=False)
+    received = db.Column(Currency(scale=2), nullable=False)
+
+    def __repr__(self):
+        return u"<UserKarmaRollup {granularity} {date}>".format(
+            granularity=self.granularity, date=self.period_start.isoformat())
+
+    @staticmethod
+    def start_of(granularity, for_date):
+        if granularity == 'week':
+            return for_date - timedelta(days=for_date.weekday())
+        return for_date.replace(day=1)
+
+    @staticmethod
+    def end_of(granularity, start):
+        if granularity == 'week':
+            return start + timedelta(days=7)
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+
+    @classmethod
+    def refresh(cls, connection, user_id, granularity, start):
+        """
+        Recompute one rollup row from the daily rows in its period.
+        """
+        daily = DailyUserKarma.__table__
+        row = connection.execute(sa.select([
+                sa.func.sum(daily.c.given),
+                sa.func.sum(daily.c.received),
+            ])
+            .where(daily.c.user_id == user_id)
+            .where(daily.c.for_date >= start)
+            .where(daily.c.for_date < cls.end_of(granularity, start))
+            .group_by(daily.c.user_id)).first()
+        set_summary_row(connection, cls.__table__,
+            {"user_id": user_id, "granularity": granularity, "period_start": start},
+            row and {"given": row[0], "received": row[1]})
+
+    @classmethod
+    def rebuild(cls, connection):
+        """
+        Regenerate the whole table from :class:`DailyUserKarma`.
+        """
+        table = cls.__table__
+        daily = DailyUserKarma.__table__
+        totals = {}
+        for row in connection.execute(sa.select([daily])):
+            for granularity in cls.GRANULARITIES:
+                key = (row.user_id, granularity,
+                    cls.start_of(granularity, row.for_date))
+                given, received = totals.get(key, (0, 0))
+                totals[key] = (given + row.given, received + row.received)
+        connection.execute(table.delete())
+        if totals:
+            connection.execute(table.insert(), [{
+                'user_id': user_id,
+                'granularity': granularity,
+                'period_start': start,
+                'given': given,
+                'received': received,
+            } for (user_id, granularity, start), (given, received) in totals.items()])
+
+
+class Change(db.Model):
+    """
+    An append-only log of every user, order, vendor and organization that
+    was created, updated or deleted, so that clients can catch up with what
+    changed since they last looked instead of downloading everything again.
+    The ID is the sequence number that clients use as their cursor. Written
+    in the same transaction as the change itself, just before it commits
+    (see :func:`log_changes` and :func:`write_changes`).
+
+    Vendors don't belong to an organization, so their changes are logged
+    without one, and every organization sees them.
+    """
+    __tablename__ = 'changes'
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(16), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(8), nullable=False)
+    organization_id = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_changes_organization_id_id', 'organization_id', 'id'),
+    )
+
+    #: the advisory lock that transactions hold while they write changes
+    LOCK_KEY = 0x6368616e
+
+    MODELS = {
+        'organization': Organization,
+        'user': User,
+        'vendor': Vendor,
+        'order': Order,
+    }
+
+    def __repr__(self):
+        return u"<Change {id} {action} {model} {object_id}>".format(
+            id=self.id, action=self.action, model=self.model, object_id=self.object_id)
+
+    @classmethod
+    def since(cls, cursor, organization_id=None):
+        query = cls.query.filter(cls.id > cursor)
+        if organization_id is not None:
+            query = query.filter(sa.or_(
+                cls.organization_id == organization_id,
+                cls.organization_id == None,
+            ))
+        return query.order_by(cls.id)
+
+    @classmethod
+    def oldest(cls):
+        """
+        The sequence number of the oldest change still in the log, or None
+        if nothing has ever been logged.
+        """
+        return db.session.query(sa.func.min(cls.id)).scalar()
+
+    @classmethod
+    def latest(cls):
+        return db.session.query(sa.func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def compact(cls, cursor_ttl=timedelta(days=7), max_age=timedelta(days=30), now=None):
+        """
+        Delete the changes that every client has already seen: those before
+        the oldest cursor of any client seen in the last ``cursor_ttl``, as
+        well as any change older than ``max_age``. The newest change is
+        always kept, so that clients whose cursors are now too old can tell.
+        If no client has been seen recently, only old changes are deleted.
+        Returns the number of changes deleted.
+        """
+        now = now or datetime.utcnow()
+        before = (db.session.query(sa.func.min(ChangeCursor.position))
+            .filter(ChangeCursor.seen_at >= now - cursor_ttl)
+            .scalar())
+        old = (db.session.query(sa.func.max(cls.id))
+            .filter(cls.changed_at < now - max_age)
+            .scalar())
+        if old is not None:
+            before = max(before or 0, old + 1)
+        if before is None:
+            return 0
+        before = min(before, cls.latest())
+        return cls.query.filter(cls.id < before).delete(synchronize_session=False)
+
+
+class ChangeCursor(db.Model):
+    """
+    The last change seen by each named client of the change log, so that
+    compaction keeps anything a client still needs.
+    """
+    __tablename__ = 'change_cursors'
+    client = db.Column(db.String(256), primary_key=True)
+    position = db.Column(db.Integer, nullable=False)
+    seen_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return u"<ChangeCursor {client} {position}>".format(
+            client=self.client, position=self.position)
+
+
+@sa.event.listens_for(sa.orm.Session, "before_flush")
+def bump_order_versions(session, flush_context, instances):
+    """
+    An order's contributions are part of the order, as far as clients are
+    concerned, so changing them should change its version too. Marking a
+    column as modified makes the flush update the order's row, and so its
+    version, even if nothing else about it changed.
+    """
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if not isinstance(obj, OrderContribution):
+            continue
+        orders = set(sa.inspect(obj).attrs.order.history.deleted or ())
+        orders.add(obj.order)
+        for order in orders:
+            if (order is not None and order not in session.deleted and
+                    sa.inspect(order).persistent):
+                sa.orm.attributes.flag_modified(order, "placed_at")
+
+
+@sa.event.listens_for(sa.orm.Session, "before_flush")
+def collect_daily_user_usage(session, flush_context, instances):
+    """
+    Note every user and date whose daily usage is touched by this flush,
+    including the old date of an order that was moved. This has to happen
+    before the flush, while deleted orders can still be loaded.
+    """
+    pending = session.info.setdefault('daily_user_usage', [])
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(obj, OrderContribution):
+            orders = set(sa.inspect(obj).attrs.order.history.deleted or ())
+            orders.add(obj.order)
+            user_ids = set(sa.inspect(obj).attrs.user_id.history.deleted or ())
+            user_ids.add(obj.user_id)
+            for order in orders:
+                if order is None:
+                    continue
+                for user_id in user_ids:
+                    # a new contribution may only get its user_id when it's
+                    # flushed, so keep hold of the contribution itself
+                    pending.append((obj, user_id, order.for_date))
+        elif isinstance(obj, Order) and obj not in session.deleted:
+            # deleted orders delete their contributions, which are handled
+            # above; otherwise only a change of date matters here
+            history = sa.inspect(obj).attrs.for_date.history
+            if not history.has_changes():
+                continue
+            for for_date in set(history.deleted or ()) | set(history.added or ()):
+                for contribution in obj.contributions:
+                    pending.append((contribution, contribution.user_id, for_date))
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def update_daily_user_usage(session, flush_context):
+    """
+    Refresh the daily usage noted by :func:`collect_daily_user_usage`, in
+    the same transaction as the flush.
+
+    If ``ENFORCE_ALLOCATIONS`` is set, the usage being refreshed is locked
+    first, so that it is added up from every other committed order, and
+    the flush fails with :class:`AllocationExceeded` if it takes anyone
+    over their allocation.
+    """
+    pending = session.info.pop('daily_user_usage', [])
+    affected = set()
+    for contribution, user_id, for_date in pending:
+        if user_id is None:
+            user_id = contribution.user_id
+        if user_id is not None and for_date is not None:
+            affected.add((user_id, for_date))
+    if not affected:
+        return
+    connection = session.connection()
+    enforce = has_app_context() and current_app.config.get("ENFORCE_ALLOCATIONS")
+    if enforce:
+        DailyUserUsage.lock(connection, affected)
+        before = DailyUserUsage.amounts(connection, affected)
+    for user_id, for_date in affected:
+        DailyUserUsage.refresh(connection, user_id, for_date)
+    if enforce:
+        overdrawn = DailyUserUsage.overdrawn(connection, affected, before)
+        if overdrawn:
+            raise AllocationExceeded(overdrawn)
+    session.info.setdefault('orders_changed', set()).update(affected)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def send_orders_changed(session):
+    changes = session.info.pop('orders_changed', None)
+    if changes:
+        sender = current_app._get_current_object() if has_app_context() else None
+        orders_changed.send(sender, changes=changes)
+
+
+@sa.event.listens_for(sa.orm.Session, "before_flush")
+def collect_karma_changes(session, flush_context, instances):
+    """
+    Note every user whose karma, or whose organization, is touched by this
+    flush, along with the dates of the orders involved: contributors and
+    orderers of changed orders, and users who are created, deleted or moved
+    to another organization. IDs that are only assigned by the flush are
+    looked up afterwards, as ``(obj, attribute, dates)``.
+    """
+    pending = session.info.setdefault('karma_changed', [])
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(obj, OrderContribution):
+            orders = set(sa.inspect(obj).attrs.order.history.deleted or ())
+            orders.add(obj.order)
+            orders.discard(None)
+            dates = set(order.for_date for order in orders)
+            pending.append((obj, 'user_id', dates))
+            pending.extend((user_id, None, dates) for user_id in
+                sa.inspect(obj).attrs.user_id.history.deleted or ())
+            pending.extend((order, 'ordered_by_id', dates) for order in orders)
+        elif isinstance(obj, Order) and obj not in session.deleted:
+            state = sa.inspect(obj)
+            if not (state.attrs.ordered_by_id.history.has_changes() or
+                    state.attrs.ordered_by.history.has_changes() or
+                    state.attrs.for_date.history.has_changes()):
+                continue
+            dates = set(state.attrs.for_date.history.deleted or ())
+            dates.add(obj.for_date)
+            old_ids = set(state.attrs.ordered_by_id.history.deleted or ())
+            old_ids.update(user.id for user in
+                state.attrs.ordered_by.history.deleted or () if user is not None)
+            pending.extend((user_id, None, dates) for user_id in old_ids)
+            pending.append((obj, 'ordered_by_id', dates))
+            pending.extend((c, 'user_id', dates) for c in obj.contributions)
+        elif isinstance(obj, User):
+            if obj in session.dirty and not sa.inspect(obj).attrs.organization_id.history.deleted:
+                continue
+            pending.append((obj, 'id', ()))
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def update_karma_history(session, flush_context):
+    """
+    Refresh the daily karma and the rollups for every user and date noted
+    by :func:`collect_karma_changes`, and remember the users for
+    :func:`send_karma_changed`. The users and dates are also sent with
+    ``orders_changed``, since an order whose orderer changes changes who
+    gave money to whom, but not anyone's daily usage.
+    """
+    pending = session.info.pop('karma_changed', [])
+    user_ids = set()
+    days = set()
+    for obj, attr, dates in pending:
+        user_id = obj if attr is None else getattr(obj, attr)
+        if user_id is None:
+            continue
+        user_ids.add(user_id)
+        days.update((user_id, for_date) for for_date in dates if for_date is not None)
+    if not user_ids:
+        return
+    session.info.setdefault('karma_changed_ids', set()).update(user_ids)
+    if not days:
+        return
+    session.info.setdefault('orders_changed', set()).update(days)
+    connection = session.connection()
+    periods = set()
+    for user_id, for_date in days:
+        DailyUserKarma.refresh(connection, user_id, for_date)
+        for granularity in UserKarmaRollup.GRANULARITIES:
+            start = UserKarmaRollup.start_of(granularity, for_date)
+            periods.add((user_id, granularity, start))
+    for user_id, granularity, start in periods:
+        UserKarmaRollup.refresh(connection, user_id, granularity, start)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def send_karma_changed(session):
+    user_ids = session.info.pop('karma_changed_ids', None)
+    if user_ids:
+        sender = current_app._get_current_object() if has_app_context() else None
+        karma_changed.send(sender, user_ids=user_ids)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def collect_names_changed(session, flush_context):
+    """
+    Note the users and vendors created, changed or deleted by this flush,
+    for :func:`send_names_changed`.
+    """
+    for obj in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(obj, (User, Vendor)) and obj.id is not None:
+            changed = session.info.setdefault('names_changed', {})
+            changed.setdefault(type(obj), set()).add(obj.id)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def send_names_changed(session):
+    changed = session.info.pop('names_changed', None)
+    if changed:
+        sender = current_app._get_current_object() if has_app_context() else None
+        for model, ids in changed.items():
+            names_changed.send(sender, model=model, ids=ids)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def log_changes(session, flush_context):
+    """
+    Note a :class:`Change` for every user, order, vendor and organization
+    created, updated or deleted by this flush, for :func:`write_changes`.
+    Changing an order's contributions counts as updating the order, and
+    changing allocation periods counts as updating their user or
+    organization.
+    """
+    logged = tuple(Change.MODELS.values())
+    changes = {}
+    for action, objs in (("deleted", session.deleted), ("created", session.new),
+                         ("updated", session.dirty)):
+        for obj in objs:
+            if isinstance(obj, OrderContribution):
+                orders = sa.inspect(obj).attrs.order.history.deleted or [obj.order]
+                obj, action = orders[0], "updated"
+            elif isinstance(obj, AllocationPeriod):
+                obj, action = obj.user, "updated"
+            elif action == "updated" and not session.is_modified(obj, include_collections=False):
+                continue
+            if not isinstance(obj, logged) or obj.id is None:
+                continue
+            # being created or deleted trumps being updated
+            key = (type(obj), obj.id)
+            if changes.get(key, (None, "updated"))[1] == "updated":
+                changes[key] = (obj, action)
+    if not changes:
+        return
+    connection = session.connection()
+    orderers = set(obj.ordered_by_id for obj, _ in changes.values()
+        if isinstance(obj, Order))
+    organizations = {}
+    if orderers:
+        users = User.__table__
+        organizations = dict(connection.execute(
+            sa.select([users.c.id, users.c.organization_id])
+            .where(users.c.id.in_(orderers))).fetchall())
+    names = dict((model, name) for name, model in Change.MODELS.items())
+    now = datetime.utcnow()
+    rows = []
+    for (model, object_id), (obj, action) in sorted(
+            changes.items(), key=lambda item: (names[item[0][0]], item[0][1])):
+        if isinstance(obj, Organization):
+            organization_id = obj.id
+        elif isinstance(obj, User):
+            organization_id = obj.organization_id
+        elif isinstance(obj, Order):
+            # the orderer may have been deleted in this flush too
+            organization_id = organizations.get(obj.ordered_by_id,
+                obj.ordered_by.organization_id if obj.ordered_by else None)
+        else:
+            organization_id = None
+        rows.append({
+            'model': names[model],
+            'object_id': object_id,
+            'action': action,
+            'organization_id': organization_id,
+            'changed_at': now,
+        })
+    session.info.setdefault('changes', []).extend(rows)
+
+
+@sa.event.listens_for(sa.orm.Session, "before_commit")
+def write_changes(session):
+    """
+    Append the changes noted by :func:`log_changes` to the log, as the last
+    thing before the transaction commits.
+
+    Clients read the log in ID order, and move their cursor past every
+    change they've read. If a transaction could commit a change with a
+    higher ID while another was yet to commit one with a lower ID, a client
+    could read the first and never see the second. So on PostgreSQL,
+    transactions take turns to write to the log, from the moment they take
+    their IDs until they commit, and IDs become visible in order. SQLite
+    only lets one transaction write at a time anyway.
+    """
+    # the last flush happens after this, unless it's done now
+    session.flush()
+    rows = session.info.pop('changes', None)
+    if not rows:
+        return
+    connection = session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.execute(sa.select([sa.func.pg_advisory_xact_lock(Change.LOCK_KEY)]))
+    connection.execute(Change.__table__.insert(), rows)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_rollback")
+def forget_orders_changed(session):
+    session.info.pop('orders_changed', None)
+    session.info.pop('karma_changed_ids', None)
+    session.info.pop('names_changed', None)
+    session.info.pop('changes', None)
@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import threading
+import time
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+from .stats import Counter, Gauge, MaxGauge
+
+
+POOL_CONNECTS = Counter("seamless_karma_db_pool_connects_total",
+    "New database connections opened by the pool.")
+POOL_INVALIDATIONS = Counter("seamless_karma_db_pool_invalidations_total",
+    "Pooled connections discarded as dead or broken.")
+POOL_CHECKOUTS = Counter("seamless_karma_db_pool_checkouts_total",
+    "Connections handed out by the pool.")
+POOL_CHECKOUT_WAIT = Counter("seamless_karma_db_pool_checkout_wait_seconds_total",
+    "Total time spent waiting to check out a connection.")
+POOL_CHECKOUT_WAIT_MAX = MaxGauge("seamless_karma_db_pool_checkout_wait_seconds_max",
+    "Longest time spent waiting to check out a connection.")
+POOL_EXHAUSTED = Counter("seamless_karma_db_pool_exhausted_total",
+    "Checkouts requested while every connection was in use.")
+POOL_TIMEOUTS = Counter("seamless_karma_db_pool_timeouts_total",
+    "Checkouts that gave up waiting for a connection.")
+POOL_SIZE = Gauge("seamless_karma_db_pool_size",
+    "Number of connections the pool keeps open.")
+POOL_CHECKED_OUT = Gauge("seamless_karma_db_pool_checked_out",
+    "Connections currently checked out.")
+POOL_OVERFLOW = Gauge("seamless_karma_db_pool_overflow",
+    "Connections currently open beyond the pool size.")
+
+
+def record_checkout(waited, exhausted=False, timed_out=False):
+    if timed_out:
+        POOL_TIMEOUTS.inc()
+    else:
+        POOL_CHECKOUTS.inc()
+    if exhausted:
+        POOL_EXHAUSTED.inc()
+    POOL_CHECKOUT_WAIT.inc(waited)
+    POOL_CHECKOUT_WAIT_MAX.set(waited)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long each checkout waits for a connection,
+    and how often the pool is exhausted (every connection, including the
+    overflow, is already checked out).
+    """
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._checkout_state = threading.local()
+
+    def is_exhausted(self):
+        if self._max_overflow == -1:
+            return False
+        return self.checkedout() >= self.size() + self._max_overflow
+
+    def _do_get(self):
+        # QueuePool._do_get() calls itself again when it loses a race for
+        # an overflow slot, so only time the outermost call
+        if getattr(self._checkout_state, "timing", False):
+            return super(InstrumentedQueuePool, self)._do_get()
+        self._checkout_state.timing = True
+        exhausted = self.is_exhausted()
+        start = time.time()
+        try:
+            rec = super(InstrumentedQueuePool, self)._do_get()
+        except sa.exc.TimeoutError:
+            record_checkout(
+                time.time() - start, exhausted=True, timed_out=True)
+            raise
+        finally:
+            self._checkout_state.timing = False
+        record_checkout(time.time() - start, exhausted=exhausted)
+        self.record_state()
+        return rec
+
+    def _do_return_conn(self, conn):
+        super(InstrumentedQueuePool, self)._do_return_conn(conn)
+        self.record_state()
+
+    def record_state(self):
+        POOL_SIZE.set(self.size())
+        POOL_CHECKED_OUT.set(self.checkedout())
+        POOL_OVERFLOW.set(max(self.overflow(), 0))
+
+
+@sa.event.listens_for(InstrumentedQueuePool, "connect")
+def on_connect(dbapi_connection, connection_record):
+    POOL_CONNECTS.inc()
+
+
+@sa.event.listens_for(InstrumentedQueuePool, "invalidate")
+def on_invalidate(dbapi_connection, connection_record, exception):
+    POOL_INVALIDATIONS.inc()
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Pessimistic disconnect handling: make sure a connection is still alive
+    before handing it out of the pool. If it isn't, the pool discards it
+    and transparently tries again with a fresh connection.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise sa.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def local_statement_timeout(milliseconds):
+    """
+    Return a checkout listener that limits statement time for the
+    transaction that the checkout starts, using ``SET LOCAL`` so that no
+    state leaks onto the server connection. This is the only way to set
+    a statement timeout from the application when connecting through
+    PgBouncer in transaction pooling mode, which rejects startup options
+    and hands a server connection to a different client after every
+    transaction.
+    """
+    def set_timeout(dbapi_connection, connection_record, connection_proxy):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SET LOCAL statement_timeout = %d" % milliseconds)
+        finally:
+            cursor.close()
+    return set_timeout
@@ -0,0 +1,224 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import threading
+import time
+import sqlalchemy as sa
+from werkzeug.urls import url_decode, url_encode
+from seamless_karma.extensions import db
+
+TOKEN_HEADER = "HTTP_X_PROFILE_TOKEN"
+TOKEN_PARAM = "profile_token"
+MAX_FUNCTIONS = 40
+
+_local = threading.local()
+
+
+def constant_time_compare(a, b):
+    """
+    Compare two byte strings in time that doesn't depend on where they
+    differ, like :func:`hmac.compare_digest`, which Python 2.7.6 doesn't
+    have.
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+compare_digest = getattr(hmac, "compare_digest", constant_time_compare)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, "statements", None) is not None:
+        context._profiler_start = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_profiler_start", None)
+    if start is None or getattr(_local, "statements", None) is None:
+        return
+    _local.statements.append({
+        "statement": statement,
+        "parameters": parameters,
+        "executemany": executemany,
+        "duration": time.time() - start,
+    })
+
+
+def explain(engine, statement, parameters, analyze=True):
+    """
+    Return the query plan for a statement, as a list of lines. On PostgreSQL,
+    if ``analyze`` is set, SELECT statements are run again with
+    ``EXPLAIN ANALYZE`` to get actual row counts and timings; anything else
+    only gets a plain ``EXPLAIN``, inside a transaction that is rolled back.
+    """
+    if engine.name == "postgresql":
+        if analyze and statement.lstrip().upper().startswith("SELECT"):
+            prefix = "EXPLAIN ANALYZE "
+        else:
+            prefix = "EXPLAIN "
+    else:
+        prefix = "EXPLAIN QUERY PLAN "
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        rows = conn.execute(prefix + statement, parameters).fetchall()
+    finally:
+        trans.rollback()
+        conn.close()
+    return [" ".join("{}".format(col) for col in row) if len(row) > 1 else row[0]
+            for row in rows]
+
+
+def function_stats(profiler):
+    stats = pstats.Stats(profiler).stats
+    by_cumulative = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [{
+        "function": "{}:{}({})".format(*func),
+        "calls": nc,
+        "primitive_calls": cc,
+        "total_time": tt,
+        "cumulative_time": ct,
+    } for func, (cc, nc, tt, ct, callers) in by_cumulative[:MAX_FUNCTIONS]]
+
+
+class ProfilerMiddleware(object):
+    """
+    WSGI middleware that profiles a single request when asked to. A request
+    is profiled if it carries the ``PROFILER_TOKEN`` configuration value in
+    an ``X-Profile-Token`` header or a ``profile_token`` query parameter.
+
+    The request is run under cProfile, and every SQL statement it executes
+    is timed. The report includes the functions with the highest cumulative
+    time, the statements, and the query plan for the slowest statement. If
+    ``PROFILER_DIR`` is configured, the report is saved there as JSON and
+    the normal response is returned with an ``X-Profile-Report`` header
+    naming the file; otherwise the report replaces the response.
+
+    Requests without a token go straight through to the application.
+    """
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+        self.token = app.config["PROFILER_TOKEN"]
+        self.directory = app.config.get("PROFILER_DIR")
+        for name, fn in (("before_cursor_execute", before_cursor_execute),
+                         ("after_cursor_execute", after_cursor_execute)):
+            if not sa.event.contains(sa.engine.Engine, name, fn):
+                sa.event.listen(sa.engine.Engine, name, fn)
+
+    def requested_token(self, environ):
+        token = environ.get(TOKEN_HEADER)
+        if token is None and TOKEN_PARAM in environ.get("QUERY_STRING", ""):
+            args = url_decode(environ["QUERY_STRING"])
+            token = args.get(TOKEN_PARAM)
+            if token is not None:
+                # don't let the token leak into links built from the URL
+                del args[TOKEN_PARAM]
+                environ["QUERY_STRING"] = url_encode(args)
+        return token
+
+    def __call__(self, environ, start_response):
+        token = self.requested_token(environ)
+        if token is None or not compare_digest(
+                token.encode("utf-8"), self.token.encode("utf-8")):
+            return self.wsgi_app(environ, start_response)
+
+        response = {}
+
+        def profiled_start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return lambda data: response.setdefault("written", []).append(data)
+
+        def run():
+            app_iter = self.wsgi_app(environ, profiled_start_response)
+            headers = dict((name.lower(), value) for name, value in response["headers"])
+            if headers.get("content-type", "").startswith("text/event-stream"):
+                # a live stream doesn't end until the client hangs up, so it
+                # is passed through without a report
+                response["stream"] = app_iter
+                return None
+            try:
+                return b"".join(response.get("written", []) + list(app_iter))
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        profiler = cProfile.Profile()
+        _local.statements = []
+        start = time.time()
+        try:
+            body = profiler.runcall(run)
+        finally:
+            statements = _local.statements
+            _local.statements = None
+        duration = time.time() - start
+        if "stream" in response:
+            start_response(response["status"], response["headers"])
+            return response["stream"]
+
+        report = self.make_report(environ, response["status"], duration,
+                                  profiler, statements)
+        data = json.dumps(report, indent=2).encode("utf-8")
+        if self.directory:
+            filename = os.path.join(self.directory, "profile-{:.6f}.json".format(start))
+            with open(filename, "wb") as f:
+                f.write(data)
+            headers = response["headers"] + [(str("X-Profile-Report"), str(filename))]
+            start_response(response["status"], headers)
+            return [body]
+        start_response(str("200 OK"), [
+            (str("Content-Type"), str("application/json")),
+            (str("Content-Length"), str(len(data))),
+        ])
+        return [data]
+
+    def make_report(self, environ, status, duration, profiler, statements):
+        report = {
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "query": environ.get("QUERY_STRING"),
+            "status": status,
+            "duration": duration,
+            "sql_duration": sum(s["duration"] for s in statements),
+            "functions": function_stats(profiler),
+            "sql": [{
+                "statement": s["statement"],
+                "parameters": repr(s["parameters"]),
+                "duration": s["duration"],
+            } for s in statements],
+        }
+        candidates = [s for s in statements if not s["executemany"]]
+        if candidates:
+            slowest = max(candidates, key=lambda s: s["duration"])
+            entry = {
+                "statement": slowest["statement"],
+                "parameters": repr(slowest["parameters"]),
+                "duration": slowest["duration"],
+            }
+            try:
+                entry["plan"] = explain(
+                    db.get_engine(self.app), slowest["statement"], slowest["parameters"])
+            except sa.exc.SQLAlchemyError as e:
+                entry["plan_error"] = "{}".format(e)
+            report["slowest_statement"] = entry
+        return report
+
+
+def init_app(app):
+    """
+    Install the profiler, if ``PROFILER_TOKEN`` is configured.
+    """
+    app.config.setdefault("PROFILER_TOKEN", None)
+    app.config.setdefault("PROFILER_DIR", None)
+    if app.config["PROFILER_TOKEN"]:
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app)
@@ -6,3 +6,9 @@ from .organization import *
 from .vendor import *
 from .order import *
 from .allocation import *
+from .flow import *
+from .settlement import *
+from .leaderboard import *
+from .analytics import *
+from .change import *
+from .dashboard import *
@@ -2,18 +2,24 @@
 from __future__ import unicode_literals
 
 from seamless_karma.extensions import db, api
-from seamless_karma.models import User
+from seamless_karma.models import User, Organization
+from seamless_karma.subclass import date_type
+from seamless_karma.signals import allocations_changed
+from seamless_karma.suggestions import candidates, suggest
+from seamless_karma.flows import to_cents
+from seamless_karma.live import EventStream
 import sqlalchemy as sa
-from flask import request
+from flask import request, current_app, Response
 import six
-from flask.ext.restful import Resource
+from flask.ext.restful import Resource, abort, reqparse
 from decimal import Decimal
-from .decorators import handle_sqlalchemy_errors
-from .utils import bool_from_str
+from datetime import date
+from .decorators import handle_sqlalchemy_errors, read_only_get
+from .utils import bool_from_str, format_cents
 
 
 class OrganizationUnallocatedForDate(Resource):
-    decorators = [handle_sqlalchemy_errors()]
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
 
     def get(self, org_id, for_date):
         """
@@ -85,41 +91,285 @@ class OrganizationUnallocatedForDate(Resource):
         # are we including nonparticipants? (users in this org who have not yet
         # participated in an order for this date)
         nonparticipants = bool_from_str(request.args.get('nonparticipants', False))
-        total_query = (db.session.query(
-                sa.func.coalesce(
-                    sa.func.sum(User.unallocated(for_date)),
-                    Decimal('0.00')
-                )
+        return unallocated_for_date(org_id, for_date, nonparticipants)
+
+
+def unallocated_for_date(org_id, for_date, nonparticipants=False):
+    total_query = (db.session.query(
+            sa.func.coalesce(
+                sa.func.sum(User.unallocated(for_date)),
+                Decimal('0.00')
             )
-            .filter(User.organization_id == org_id)
         )
-        if not nonparticipants:
-            total_query = total_query.filter(User.participated_on(for_date))
-        total = total_query.scalar()
+        .filter(User.organization_id == org_id)
+    )
+    if not nonparticipants:
+        total_query = total_query.filter(User.participated_on(for_date))
+    total = total_query.scalar()
 
-        main_query = (db.session.query(User, User.unallocated(for_date), User.karma)
-            .filter(User.organization_id == org_id)
-            .order_by(sa.desc(User.unallocated(for_date)), User.karma)
-        )
-        if not nonparticipants:
-            main_query = main_query.filter(User.participated_on(for_date))
+    main_query = (db.session.query(User, User.unallocated(for_date), User.karma)
+        .filter(User.organization_id == org_id)
+        .order_by(sa.desc(User.unallocated(for_date)), User.karma)
+    )
+    if not nonparticipants:
+        main_query = main_query.filter(User.participated_on(for_date))
+
+    output = {
+        "total_unallocated": six.text_type(total),
+        "data": [],
+    }
+    for user, unallocated, karma in main_query:
+        output["data"].append({
+            "id": user.id,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "unallocated": six.text_type(unallocated),
+            "karma": six.text_type(karma),
+        })
+    return output
+
+
+class OrganizationUnallocatedStream(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id, for_date):
+        """
+        A stream of `server-sent events`_ that keeps the information from
+        :http:get:`/api/organizations/(int:org_id)/orders/(date:for_date)/unallocated`
+        up to date, instead of polling it. The stream starts with a
+        ``snapshot`` event, holding exactly what that API call returns. Then
+        whenever orders change, there is an ``unallocated`` event with the
+        new unallocated money of the users involved, and a ``karma`` event
+        with the new Karma of any users in the organization whose Karma
+        changed. Users may appear in these events who weren't in the
+        snapshot, if they have just participated in an order.
+
+        If the client can't keep up, the stream sends a ``resync`` event and
+        ends; reconnect to get a new snapshot.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: text/event-stream
+
+            event: snapshot
+            data: {"total_unallocated": "5.20", "data": [{"id": 1, "first_name": "Frank", "last_name": "Smith", "unallocated": "5.20", "karma": "8.20"}]}
+
+            event: unallocated
+            data: [{"id": 1, "unallocated": "1.70"}, {"id": 93, "unallocated": "0.00"}]
+
+            event: karma
+            data: [{"id": 1, "karma": "4.70"}, {"id": 93, "karma": "-6.70"}]
+
+        :query nonparticipants: As for the snapshot.
+        :status 200: no errors
+        :status 404: there is no organization with the given ID
+        :status 503: this server process already has as many streams open
+            as ``LIVE_MAX_STREAMS``; try again later
 
-        output = {
-            "total_unallocated": six.text_type(total),
-            "data": [],
+        .. _server-sent events: http://www.w3.org/TR/eventsource/
+        """
+        if not Organization.query.get(org_id):
+            abort(404, message="Organization {} does not exist".format(org_id))
+        nonparticipants = bool_from_str(request.args.get('nonparticipants', False))
+        hub = current_app.extensions["live"]
+        heartbeat = current_app.config["LIVE_HEARTBEAT"]
+        # subscribe first, so that nothing is missed between the snapshot
+        # and the first update
+        subscription = hub.subscribe(org_id, for_date,
+            limit=current_app.config["LIVE_MAX_STREAMS"])
+        if subscription is None:
+            abort(503, message="too many live update streams are open; "
+                               "try again later")
+        try:
+            snapshot = unallocated_for_date(org_id, for_date, nonparticipants)
+        except:
+            hub.unsubscribe(subscription)
+            raise
+        stream = EventStream(hub, subscription, ("snapshot", snapshot), heartbeat)
+        # passed through untouched, so that servers can recognize it
+        return Response(stream, mimetype="text/event-stream", direct_passthrough=True,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+bulk_parser = reqparse.RequestParser()
+bulk_parser.add_argument('allocation', type=Decimal, required=True,
+    help="New allocation, as a decimal string")
+bulk_parser.add_argument('effective', type=date_type)
+bulk_parser.add_argument('user_id', type=int, action='append')
+bulk_parser.add_argument('current_allocation', type=Decimal)
+bulk_parser.add_argument('default', type=bool_from_str, default=False)
+
+
+class OrganizationAllocations(Resource):
+    decorators = [handle_sqlalchemy_errors()]
+
+    def post(self, org_id):
+        """
+        Change the allocation of every user in the organization identified by
+        the given organization ID, or of a subset of them. All of the users
+        are changed in a single transaction, using a fixed number of queries
+        however many users there are. As with
+        :http:put:`/api/users/(int:user_id)`, unallocated money for dates
+        before the change is still based on the old allocations.
+
+        Example request:
+
+        .. sourcecode:: http
+
+            POST /api/organizations/1/allocations HTTP/1.1
+            Host: seamlesskarma.com
+            Content-Type: application/x-www-form-urlencoded
+            Content-Length: 40
+
+            allocation=12.00&current_allocation=11.50&default=true
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "message": "updated",
+              "count": 4817
+            }
+
+        :form allocation: *Required* The new daily allocation, in dollars.
+        :form effective: *Optional* The date that the new allocation takes
+            effect, formatted as an ISO8601 date string (YYYY-MM-DD). Defaults
+            to today.
+        :form user_id: *Optional* Only change the users with these IDs. May be
+            given more than once.
+        :form current_allocation: *Optional* Only change users whose allocation
+            is currently this amount; for example, the old default allocation
+            of the organization.
+        :form default: *Optional* If set to `true`, also make the new
+            allocation the default allocation of the organization.
+        :status 200: the allocations were updated
+        :status 404: there is no organization with the given ID
+        """
+        org = Organization.query.get(org_id)
+        if not org:
+            abort(404, message="Organization {} does not exist".format(org_id))
+        args = bulk_parser.parse_args()
+        users = User.query.filter(User.organization_id == org.id)
+        if args.user_id:
+            users = users.filter(User.id.in_(args.user_id))
+        if args.current_allocation is not None:
+            users = users.filter(User.allocation == args.current_allocation)
+        user_ids = [user_id for (user_id,) in users.with_entities(User.id)]
+        effective = args.effective or date.today()
+        count = 0
+        if user_ids:
+            count = User.bulk_change_allocation(
+                users, args.allocation, effective=effective)
+        if args.default:
+            org.default_allocation = args.allocation
+        db.session.commit()
+        allocations_changed.send(current_app._get_current_object(),
+            organization_id=org_id, user_ids=user_ids, effective=effective)
+        return {"message": "updated", "count": count}
+
+
+suggest_parser = reqparse.RequestParser()
+suggest_parser.add_argument('amount', type=Decimal, required=True, location='args',
+    help="Total amount of the order, as a decimal string")
+suggest_parser.add_argument('orderer', type=int, required=True, location='args',
+    help="ID of the user placing the order")
+suggest_parser.add_argument('nonparticipants', type=bool_from_str, default=False,
+    location='args')
+
+
+class OrganizationSuggestionForDate(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id, for_date):
+        """
+        Suggest who should contribute how much to an order that has not been
+        placed yet, for users within the organization identified by the given
+        organization ID. The user placing the order contributes as much of
+        their unallocated money as they can, and the rest is taken from the
+        users with the lowest Karma first, never more than their unallocated
+        money for the given date. As with
+        :http:get:`/api/organizations/(int:org_id)/orders/(date:for_date)/unallocated`,
+        only users who have already participated in an order for that date
+        are considered, unless the ``nonparticipants`` query parameter is set.
+
+        If there isn't enough unallocated money to cover the order, the
+        amount that is left over is returned as ``shortfall``.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "amount": "25.00",
+              "shortfall": "0.00",
+              "data": [
+                {
+                  "id": 8,
+                  "amount": "11.50"
+                }, {
+                  "id": 43,
+                  "amount": "2.25"
+                }, {
+                  "id": 93,
+                  "amount": "4.90"
+                }, {
+                  "id": 1,
+                  "amount": "5.20"
+                }, {
+                  "id": 81,
+                  "amount": "1.15"
+                }
+              ]
+            }
+
+        :query amount: *Required* The total amount of the order, in dollars.
+        :query orderer: *Required* The ID of the user placing the order.
+        :query nonparticipants: If set to `true`, consider *all* users in the
+            organization, regardless of whether they have participated in an
+            order for the given day or not.
+        :status 200: no errors
+        :status 400: the amount is not positive, or the orderer is not in
+            the organization
+        """
+        args = suggest_parser.parse_args()
+        amount = to_cents(args.amount)
+        if amount <= 0:
+            abort(400, message="amount must be positive")
+        orderer = User.query.get(args.orderer)
+        if not orderer or orderer.organization_id != org_id:
+            abort(400, message="orderer must be a user in the organization")
+        contributions, shortfall = suggest(amount, orderer.id, candidates(
+            org_id, for_date, orderer.id, args.nonparticipants))
+        return {
+            "amount": format_cents(amount),
+            "shortfall": format_cents(shortfall),
+            "data": [{
+                "id": user_id,
+                "amount": format_cents(cents),
+            } for user_id, cents in contributions],
         }
-        for user, unallocated, karma in main_query:
-            output["data"].append({
-                "id": user.id,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "unallocated": six.text_type(unallocated),
-                "karma": six.text_type(karma),
-            })
-        return output
 
 
+api.add_resource(OrganizationAllocations, "/organizations/<int:org_id>/allocations")
 api.add_resource(
     OrganizationUnallocatedForDate,
     "/organizations/<int:org_id>/orders/<date:for_date>/unallocated"
 )
+api.add_resource(
+    OrganizationUnallocatedStream,
+    "/organizations/<int:org_id>/orders/<date:for_date>/unallocated/stream"
+)
+api.add_resource(
+    OrganizationSuggestionForDate,
+    "/organizations/<int:org_id>/orders/<date:for_date>/suggest"
+)
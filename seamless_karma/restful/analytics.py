@@ -0,0 +1,104 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from seamless_karma.models import Organization
+from seamless_karma.extensions import api
+from seamless_karma.subclass import date_type
+from seamless_karma.analytics import OrganizationStats, vendor_names
+from flask.ext.restful import Resource, abort, reqparse
+from .decorators import handle_sqlalchemy_errors, read_only_get
+from .utils import format_cents
+
+parser = reqparse.RequestParser()
+parser.add_argument('from', dest='start', type=date_type, location='args')
+parser.add_argument('to', dest='end', type=date_type, location='args')
+
+
+def optional_cents(cents):
+    return None if cents is None else format_cents(cents)
+
+
+class OrganizationStatistics(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id):
+        """
+        Return spending statistics for orders placed by users in the
+        organization identified by the given organization ID: the total
+        spent, how much of it was contributed by users other than the person
+        who placed the order, the distribution of order sizes, the total for
+        each day, and the vendors with the most spent.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "from": "2014-03-01",
+              "to": "2014-03-31",
+              "order_count": 3,
+              "total": "61.75",
+              "external_total": "14.25",
+              "external_share": 0.2308,
+              "order_size": {
+                "mean": "20.58",
+                "p50": "18.50",
+                "p90": "31.00",
+                "p99": "31.00",
+                "max": "31.00"
+              },
+              "daily": [
+                {"date": "2014-03-03", "order_count": 2, "total": "43.25"},
+                {"date": "2014-03-04", "order_count": 1, "total": "18.50"}
+              ],
+              "top_vendors": [
+                {"id": 3, "name": "Hummus Place", "order_count": 2, "total": "49.50"},
+                {"id": 7, "name": "Dos Toros", "order_count": 1, "total": "12.25"}
+              ]
+            }
+
+        :query from: Only include orders on or after this date, formatted as
+            an ISO8601 date string (YYYY-MM-DD).
+        :query to: Only include orders on or before this date, formatted as
+            an ISO8601 date string (YYYY-MM-DD).
+        :status 200: no errors
+        :status 404: there is no organization with the given ID
+        """
+        if not Organization.query.get(org_id):
+            abort(404, message="Organization {} does not exist".format(org_id))
+        args = parser.parse_args()
+        stats = OrganizationStats.for_organization(org_id, args.start, args.end)
+        total = stats.total
+        return {
+            "from": args.start.isoformat() if args.start else None,
+            "to": args.end.isoformat() if args.end else None,
+            "order_count": len(stats.totals),
+            "total": format_cents(total),
+            "external_total": format_cents(stats.external),
+            "external_share": round(float(stats.external) / total, 4) if total else None,
+            "order_size": dict((key, optional_cents(value))
+                for key, value in stats.order_size().items()),
+            "daily": [{
+                "date": day.isoformat(),
+                "order_count": count,
+                "total": format_cents(amount),
+            } for day, count, amount in stats.daily()],
+            "top_vendors": top_vendors(stats),
+        }
+
+
+def top_vendors(stats):
+    top = stats.top_vendors()
+    names = vendor_names([vendor_id for vendor_id, _, _ in top])
+    return [{
+        "id": vendor_id,
+        "name": names.get(vendor_id),
+        "order_count": count,
+        "total": format_cents(amount),
+    } for vendor_id, count, amount in top]
+
+
+api.add_resource(OrganizationStatistics, "/organizations/<int:org_id>/stats")
@@ -0,0 +1,108 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from datetime import datetime
+from seamless_karma.models import Change, ChangeCursor, Organization
+from seamless_karma.extensions import db, api
+from flask.ext.restful import Resource, abort, reqparse
+from .decorators import handle_sqlalchemy_errors
+
+MAX_CHANGES = 1000
+
+parser = reqparse.RequestParser()
+parser.add_argument('since', type=int, location='args')
+parser.add_argument('org', type=int, location='args')
+parser.add_argument('client', location='args')
+parser.add_argument('limit', type=int, default=200, location='args')
+
+
+class ChangeList(Resource):
+    # remembers client cursors, so reads aren't read-only
+    decorators = [handle_sqlalchemy_errors(Change)]
+
+    def get(self):
+        """
+        Return what changed since a client last synced: users, orders,
+        vendors and organizations that were created, updated or deleted,
+        in the order that they changed. Fetch the objects themselves from
+        their own resources. Something that changed several times may
+        appear several times.
+
+        To start syncing, call this without ``since`` to get the current
+        cursor, then download the full lists. After that, pass the
+        ``cursor`` from each response as ``since`` in the next request.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "cursor": 1573,
+              "more": false,
+              "data": [
+                {
+                  "seq": 1572,
+                  "type": "order",
+                  "id": 419,
+                  "action": "created"
+                }, {
+                  "seq": 1573,
+                  "type": "user",
+                  "id": 12,
+                  "action": "updated"
+                }
+              ]
+            }
+
+        :query since: The ``cursor`` from the last response.
+        :query org: Only changes to this organization, its users and their
+            orders, and to vendors.
+        :query client: A name for this client. Changes aren't deleted from
+            the log until every client that has synced in the last few days
+            has seen them.
+        :query limit: Maximum number of changes to return, up to 1000.
+            Defaults to 200. If there are more, ``more`` is true, and the
+            rest can be fetched straight away.
+        :status 200: no errors
+        :status 404: there is no organization with the given ID
+        :status 410: the changes since this cursor are no longer in the
+            log; download the full lists again, and start over
+        """
+        args = parser.parse_args()
+        if args.org is not None and not Organization.query.get(args.org):
+            abort(404, message="Organization {} does not exist".format(args.org))
+        latest = Change.latest()
+        if args.since is not None:
+            oldest = Change.oldest()
+            if args.since < 0 or args.since > latest or (
+                    oldest is not None and args.since < oldest - 1):
+                abort(410, message="changes since {} are no longer available".format(
+                    args.since))
+        if args.client:
+            cursor = ChangeCursor.query.get(args.client) or ChangeCursor(client=args.client)
+            cursor.position = latest if args.since is None else args.since
+            cursor.seen_at = datetime.utcnow()
+            db.session.add(cursor)
+            db.session.commit()
+        if args.since is None:
+            return {"cursor": latest, "more": False, "data": []}
+        limit = min(max(args.limit, 1), MAX_CHANGES)
+        changes = Change.since(args.since, args.org).limit(limit + 1).all()
+        more = len(changes) > limit
+        changes = changes[:limit]
+        return {
+            "cursor": changes[-1].id if changes else args.since,
+            "more": more,
+            "data": [{
+                "seq": change.id,
+                "type": change.model,
+                "id": change.object_id,
+                "action": change.action,
+            } for change in changes],
+        }
+
+
+api.add_resource(ChangeList, "/changes")
@@ -0,0 +1,195 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from datetime import date, timedelta
+from seamless_karma.models import User, Order, Organization
+from seamless_karma.extensions import db, api
+from seamless_karma.subclass import TWOPLACES, date_type
+from seamless_karma.analytics import OrganizationStats
+from seamless_karma.leaderboard import leaderboards
+from seamless_karma.fanout import fanout
+import sqlalchemy as sa
+from flask import current_app
+import six
+from flask.ext.restful import Resource, abort, marshal, reqparse
+from .decorators import handle_sqlalchemy_errors, read_only_get
+from .utils import format_cents
+from . import organization, order
+from .allocation import unallocated_for_date
+from .analytics import top_vendors
+from .leaderboard import top_users, MAX_TOP
+
+MAX_DAYS = 366
+
+parser = reqparse.RequestParser()
+parser.add_argument('date', dest='for_date', type=date_type, location='args')
+parser.add_argument('top', type=int, default=10, location='args')
+parser.add_argument('days', type=int, default=30, location='args')
+
+
+def roster(org_id):
+    return [{
+        "id": user_id,
+        "username": username,
+        "first_name": first_name,
+        "last_name": last_name,
+        "allocation": six.text_type(allocation.quantize(TWOPLACES)),
+    } for user_id, username, first_name, last_name, allocation in
+        db.session.query(User.id, User.username, User.first_name, User.last_name,
+                         User.allocation)
+        .filter(User.organization_id == org_id)
+        .order_by(User.last_name, User.first_name, User.id)]
+
+
+def orders_on(org_id, for_date):
+    orders = (Order.query
+        .join(User)
+        .filter(User.organization_id == org_id)
+        .filter(Order.for_date == for_date)
+        .options(sa.orm.joinedload(Order.contributions))
+        .order_by(Order.placed_at, Order.id))
+    return marshal(orders.all(), order.mfields)
+
+
+def leaderboard(org_id, top, ttl):
+    return top_users(leaderboards.get(org_id, ttl), top)
+
+
+def vendor_stats(org_id, start, end):
+    stats = OrganizationStats.for_organization(org_id, start, end)
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "order_count": len(stats.totals),
+        "total": format_cents(stats.total),
+        "top_vendors": top_vendors(stats),
+    }
+
+
+class OrganizationDashboard(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id):
+        """
+        Return everything the lunchtime page shows for the organization
+        identified by the given organization ID, in one response: its users,
+        the orders and unallocated money for a date, the top of the Karma
+        leaderboard, and the vendors with the most spent recently. The parts
+        are looked up at the same time, each with its own database
+        connection, so this takes about as long as the slowest of them.
+
+        ``unallocated`` is the same as
+        :http:get:`/api/organizations/(int:org_id)/orders/(date:for_date)/unallocated`,
+        ``leaderboard`` as
+        :http:get:`/api/organizations/(int:org_id)/leaderboard`, and
+        ``top_vendors`` as in
+        :http:get:`/api/organizations/(int:org_id)/stats`.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "organization": {
+                "id": 1,
+                "seamless_id": null,
+                "name": "Acme",
+                "default_allocation": "10.00"
+              },
+              "date": "2014-03-03",
+              "users": [
+                {
+                  "id": 1,
+                  "username": "fsmith",
+                  "first_name": "Frank",
+                  "last_name": "Smith",
+                  "allocation": "10.00"
+                }
+              ],
+              "orders": [
+                {
+                  "id": 12,
+                  "seamless_id": null,
+                  "vendor_id": 3,
+                  "ordered_by": 1,
+                  "for_date": "2014-03-03",
+                  "placed_at": "2014-03-03T11:50:00",
+                  "total": "9.50",
+                  "contributions": [{"user_id": 1, "amount": "9.50"}]
+                }
+              ],
+              "unallocated": {
+                "total_unallocated": "0.50",
+                "data": [
+                  {
+                    "id": 1,
+                    "first_name": "Frank",
+                    "last_name": "Smith",
+                    "unallocated": "0.50",
+                    "karma": "0.00"
+                  }
+                ]
+              },
+              "leaderboard": {
+                "count": 1,
+                "data": [
+                  {
+                    "rank": 1,
+                    "id": 1,
+                    "first_name": "Frank",
+                    "last_name": "Smith",
+                    "karma": "0.00"
+                  }
+                ]
+              },
+              "vendors": {
+                "from": "2014-02-02",
+                "to": "2014-03-03",
+                "order_count": 1,
+                "total": "9.50",
+                "top_vendors": [
+                  {"id": 3, "name": "Hummus Place", "order_count": 1, "total": "9.50"}
+                ]
+              }
+            }
+
+        :query date: The date to show orders and unallocated money for,
+            formatted as an ISO8601 date string (YYYY-MM-DD). Defaults to
+            today.
+        :query top: How many users of the leaderboard to return, up to 200.
+            Defaults to 10.
+        :query days: How many days, up to and including ``date``, to add up
+            vendor spending for, up to 366. Defaults to 30.
+        :status 200: no errors
+        :status 400: ``days`` is out of range
+        :status 404: there is no organization with the given ID
+        """
+        org = Organization.query.get(org_id)
+        if not org:
+            abort(404, message="Organization {} does not exist".format(org_id))
+        args = parser.parse_args()
+        for_date = args.for_date or date.today()
+        if not 1 <= args.days <= MAX_DAYS:
+            abort(400, message="days must be between 1 and {}".format(MAX_DAYS))
+        top = min(max(args.top, 0), MAX_TOP)
+        org_data = marshal(org, organization.mfields)
+        # don't hold a connection while the queries wait for theirs
+        db.session.commit()
+        output = fanout(
+            users=(roster, (org_id,)),
+            orders=(orders_on, (org_id, for_date)),
+            unallocated=(unallocated_for_date, (org_id, for_date)),
+            leaderboard=(leaderboard,
+                (org_id, top, current_app.config.get("LEADERBOARD_TTL", 300))),
+            vendors=(vendor_stats,
+                (org_id, for_date - timedelta(days=args.days - 1), for_date)),
+        )
+        output["organization"] = org_data
+        output["date"] = for_date.isoformat()
+        return output
+
+
+api.add_resource(OrganizationDashboard, "/organizations/<int:org_id>/dashboard")
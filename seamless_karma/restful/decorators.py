@@ -1,14 +1,21 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
+import operator
 import re
-from functools import wraps
+from functools import wraps, total_ordering
+from itertools import islice
+import six
 from six.moves.urllib.parse import urlsplit
 from textwrap import dedent
 
 import sqlalchemy as sa
 from seamless_karma.extensions import db
-from flask import request
+from seamless_karma.models import AllocationExceeded
+from seamless_karma.shards import route, scattered, merge
+from seamless_karma.subclass import int_type
+from flask import request, current_app
+from werkzeug.http import quote_etag
 from flask.ext.restful import abort, marshal
 from .utils import update_url_query
 
@@ -73,6 +80,20 @@ def handle_sqlalchemy_errors(model=None):
         def wrapper(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
+            except sa.orm.exc.StaleDataError:
+                # someone else changed the row since it was loaded
+                db.session.rollback()
+                abort(412 if "If-Match" in request.headers else 409,
+                    message="{} was changed by another request; get it again "
+                            "and retry".format(model.__name__ if model else "Resource"))
+            except sa.exc.TimeoutError:
+                # no connection came free in SQLALCHEMY_POOL_TIMEOUT seconds
+                db.session.rollback()
+                abort(503, message="the database is busy; try again shortly")
+            except AllocationExceeded as e:
+                # a failed flush leaves the session unusable until rolled back
+                db.session.rollback()
+                abort(409, message=six.text_type(e))
             except sa.exc.SQLAlchemyError as e:
                 message = parse_sqlalchemy_exception(e, model)
                 abort(400, message=message)
@@ -81,7 +102,222 @@ def handle_sqlalchemy_errors(model=None):
     return decorator
 
 
-def resource_list(model, marshal_fields, default_limit=50, max_limit=200, parser=None):
+def read_only_get(func):
+    """
+    For GET and HEAD requests, run the view in a read-only transaction, and
+    end that transaction as soon as the view returns. Views return data
+    that has already been marshalled into plain Python objects, so the
+    database connection can go back to the pool before the response is
+    serialized and sent, rather than being held until the app context is
+    torn down.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return func(*args, **kwargs)
+        if db.engine.name == 'postgresql':
+            db.session.execute("SET TRANSACTION READ ONLY")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db.session.rollback()
+    return wrapper
+
+
+def version_headers(obj):
+    """
+    Headers for a response about a versioned object: its version, as an
+    ETag, for clients to send back as ``If-Match`` when they change it.
+    """
+    return {"ETag": quote_etag(six.text_type(obj.version))}
+
+
+def check_version(obj):
+    """
+    Before changing or deleting a versioned object, make sure that the
+    client has seen the latest version of it, if it sent an ``If-Match``
+    header. If the object changes between now and the end of the request,
+    the update fails, and :func:`handle_sqlalchemy_errors` turns that into
+    412 Precondition Failed as well.
+    """
+    if ("If-Match" in request.headers and
+            not request.if_match.contains(six.text_type(obj.version))):
+        abort(412, message="{} {} has changed; its version is now {}".format(
+            type(obj).__name__, obj.id, obj.version))
+
+
+FILTER_OPERATORS = {
+    "eq": operator.eq,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+MAX_IN_VALUES = 100
+
+
+class Filter(object):
+    """
+    A filter that clients may apply to a resource list, on one column. Only
+    columns with an index should be filters, so that every filter can be
+    answered with an index scan rather than by reading the whole table.
+
+    Clients filter with ``name=value``, ``name__in=value1,value2``, or
+    ``name__<op>=value`` where ``op`` is ``lt``, ``lte``, ``gt`` or
+    ``gte``. Values are converted with ``type(value, name)``, which raises
+    ValueError if the value won't do.
+    If ``via`` is the name of a relationship, the column belongs to the
+    related model, and the filter matches rows with any related row that
+    matches.
+    """
+    def __init__(self, column, type=int_type, operators=("eq", "in", "lt", "lte", "gt", "gte"),
+                 via=None):
+        self.column = column
+        self.type = type
+        self.operators = operators
+        self.via = via
+
+    def clause(self, model, name, op, value):
+        if op not in self.operators:
+            raise ValueError("cannot filter {} with {!r}; use one of: {}".format(
+                name, op, ", ".join(self.operators)))
+        if op == "in":
+            values = [self.type(v, name) for v in value.split(",") if v]
+            if not values:
+                raise ValueError("{}__in needs at least one value".format(name))
+            if len(values) > MAX_IN_VALUES:
+                raise ValueError("{}__in takes at most {} values".format(name, MAX_IN_VALUES))
+            condition = self.column.in_(values)
+        else:
+            condition = FILTER_OPERATORS[op](self.column, self.type(value, name))
+        if self.via is not None:
+            condition = getattr(model, self.via).any(condition)
+        return condition
+
+
+def apply_filters(query, model, filters, ignore=()):
+    """
+    Filter ``query`` by the filters in the request's query string, which
+    must be named in ``filters``, a dict of name to :class:`Filter`.
+    Filtering on an attribute of the model that isn't a filter is refused,
+    since it would need a full table scan. Query string arguments named in
+    ``ignore`` are left alone.
+    """
+    for key, value in request.args.items():
+        if key in ignore:
+            continue
+        name, _, op = key.partition("__")
+        if name in filters:
+            try:
+                query = query.filter(filters[name].clause(model, name, op or "eq", value))
+            except ValueError as e:
+                abort(400, message=six.text_type(e))
+        elif op or name in sa.inspect(model).all_orm_descriptors:
+            abort(400, message="cannot filter on {!r}; filter on one of: {}".format(
+                name, ", ".join(sorted(filters))))
+    return query
+
+
+def sort_columns(model, sorts=None):
+    """
+    Return the columns to sort by for the request's ``order`` argument, as
+    ``(column, descending)`` pairs. ``order`` is a comma-separated list of
+    sort keys, each preceded by ``-`` to sort in descending order. Sort keys
+    must be named in ``sorts``, a dict of name to a column or a tuple of
+    columns; only indexed columns should be sort keys, so that sorting
+    never means computing and sorting a value for every row. Rows are
+    always sorted by ID last, so that pages don't overlap or skip rows that
+    are otherwise equal.
+    """
+    if sorts is None:
+        sorts = {"id": model.id}
+    result = []
+    tiebreaker = True
+    if request.values.get("order"):
+        for key in request.values["order"].split(","):
+            name = key.lstrip("-")
+            if name not in sorts:
+                abort(400, message="cannot order by {!r}; order by one of: {}".format(
+                    name, ", ".join(sorted(sorts))))
+            columns = sorts[name]
+            if not isinstance(columns, tuple):
+                columns = (columns,)
+            for column in columns:
+                result.append((column, key.startswith("-")))
+                if column is model.id:
+                    tiebreaker = False
+    if tiebreaker:
+        result.append((model.id, False))
+    return result
+
+
+def order_by(columns, collation=None):
+    """
+    Return the ORDER BY clauses for ``columns``, a list of ``(column,
+    descending)`` pairs from :func:`sort_columns`. If ``collation`` is
+    given, strings are sorted with it.
+    """
+    clauses = []
+    for column, descending in columns:
+        if collation is not None and isinstance(column.type, sa.String):
+            column = column.collate(collation)
+        clauses.append(column.desc() if descending else column.asc())
+    return clauses
+
+
+@total_ordering
+class Descending(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def sort_key(columns):
+    """
+    Return a function that gives the key that an object would be sorted by
+    in the database, when sorted by ``columns``, a list of ``(column,
+    descending)`` pairs from :func:`sort_columns`.
+    """
+    # PostgreSQL sorts nulls after everything else, SQLite before
+    nulls_last = db.engine.name == 'postgresql'
+
+    def key(obj):
+        values = []
+        for column, descending in columns:
+            value = getattr(obj, column.key)
+            value = ((value is None) == nulls_last, value)
+            values.append(Descending(value) if descending else value)
+        return tuple(values)
+    return key
+
+
+def scatter(query, marshal_fields, key, limit, offset):
+    """
+    Run a sorted query on every shard, and return the total count and one
+    page of the marshalled results, merged in order. Each shard sorts its
+    own rows, so it only has to return as many as the page needs.
+    """
+    count = 0
+    results = []
+    for name in current_app.extensions["shards"].names():
+        route(name)
+        if db.engine.name == 'postgresql':
+            db.session.execute("SET TRANSACTION READ ONLY")
+        count += query.count()
+        rows = query.limit(offset + limit).all()
+        results.append(list(zip([key(row) for row in rows],
+                                marshal(rows, marshal_fields))))
+    route(None)
+    return count, list(islice(merge(results), offset, offset + limit))
+
+
+def resource_list(model, marshal_fields, default_limit=50, max_limit=200, parser=None,
+                  filters=None, sorts=None):
     def outer(func):
         @wraps(func)
         def inner(*args, **kwargs):
@@ -108,30 +344,41 @@ def resource_list(model, marshal_fields, default_limit=50, max_limit=200, parser
                 if offset < 0:
                     abort(400, "offset cannot be negative")
 
-            orders = []
-            if "order" in request.values:
-                for order_str in request.values["order"].split(','):
-                    if not hasattr(model, order_str):
-                        abort(400, "cannot order on attribute {!r}".format(order_str))
-                    orders.append(getattr(model, order_str))
-            elif hasattr(model, "id"):
-                orders.append(model.id)
+            columns = sort_columns(model, sorts)
+            # results from several shards are merged in Python's order,
+            # which for strings is PostgreSQL's "C" collation and SQLite's
+            # default one
+            scatter_query = scattered(model)
+            collation = None
+            if scatter_query and db.engine.name == 'postgresql':
+                collation = "C"
+            orders = order_by(columns, collation)
 
             # process the function
             query = func(*args, **kwargs)
 
             # allow users to filter by parser fields
+            parser_args = {}
             if parser:
-                for name, value in parser.parse_args().items():
+                parser_args = parser.parse_args()
+                for name, value in parser_args.items():
                     if hasattr(model, name) and value is not None:
                         query = query.filter(getattr(model, name) == value)
+            if filters is not None:
+                query = apply_filters(query, model, filters,
+                    ignore=set(parser_args) | {"limit", "offset", "order"})
 
             # build the results
-            count = query.count()
-            results = query.order_by(*orders).limit(limit).offset(offset).all()
+            if scatter_query:
+                count, data = scatter(query.order_by(*orders), marshal_fields,
+                    sort_key(columns), limit, offset or 0)
+            else:
+                count = query.count()
+                results = query.order_by(*orders).limit(limit).offset(offset).all()
+                data = marshal(results, marshal_fields)
             output = {
                 "count": count,
-                "data": marshal(results, marshal_fields),
+                "data": data,
             }
             # just get path and query args from URL
             scheme, netloc, path, query, fragment = urlsplit(request.url)
@@ -0,0 +1,73 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from seamless_karma.models import Organization
+from seamless_karma.extensions import api
+from seamless_karma.subclass import date_type
+from seamless_karma.flows import get_flows
+from flask.ext.restful import Resource, abort, reqparse
+from .decorators import handle_sqlalchemy_errors, read_only_get
+
+parser = reqparse.RequestParser()
+parser.add_argument('from', dest='start', type=date_type, location='args')
+parser.add_argument('to', dest='end', type=date_type, location='args')
+
+
+class OrganizationFlows(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id):
+        """
+        Return how much each user in the organization identified by the given
+        organization ID has contributed to orders placed by each other user.
+        Contributions to a user's own orders are not included.
+
+        The result is a sparse matrix in compressed sparse row format. Users
+        are numbered by their position in ``users``. The users that
+        ``users[i]`` has contributed to are at
+        ``indices[indptr[i]:indptr[i+1]]``, and the same positions in
+        ``amounts`` and ``counts`` hold the total amount contributed, in cents,
+        and the number of orders. For example, in the response below, user 4
+        has contributed $3.50 to one order of user 9, and user 9 has
+        contributed $12.00 over two orders of user 4 and $2.25 to one order
+        of user 17.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "from": "2014-03-01",
+              "to": "2014-03-31",
+              "format": "csr",
+              "users": [4, 9, 17],
+              "indptr": [0, 1, 3, 3],
+              "indices": [1, 0, 2],
+              "amounts": [350, 1200, 225],
+              "counts": [1, 2, 1]
+            }
+
+        :query from: Only include orders on or after this date, formatted as
+            an ISO8601 date string (YYYY-MM-DD).
+        :query to: Only include orders on or before this date, formatted as
+            an ISO8601 date string (YYYY-MM-DD).
+        :status 200: no errors
+        :status 404: there is no organization with the given ID
+        """
+        if not Organization.query.get(org_id):
+            abort(404, message="Organization {} does not exist".format(org_id))
+        args = parser.parse_args()
+        if args.start and args.end and args.start > args.end:
+            abort(400, message="`from` must not be after `to`")
+        output = {
+            "from": args.start.isoformat() if args.start else None,
+            "to": args.end.isoformat() if args.end else None,
+        }
+        output.update(get_flows(org_id, args.start, args.end).serialize())
+        return output
+
+
+api.add_resource(OrganizationFlows, "/organizations/<int:org_id>/flows")
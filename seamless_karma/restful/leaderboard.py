@@ -0,0 +1,103 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from seamless_karma.models import User, Organization
+from seamless_karma.extensions import db, api
+from seamless_karma.leaderboard import leaderboards
+from flask import current_app
+from flask.ext.restful import Resource, abort, reqparse
+from .decorators import handle_sqlalchemy_errors, read_only_get
+from .utils import format_cents
+
+MAX_TOP = 200
+
+parser = reqparse.RequestParser()
+parser.add_argument('top', type=int, default=10, location='args')
+parser.add_argument('user', type=int, location='args')
+
+
+class OrganizationLeaderboard(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id):
+        """
+        Return the users with the most Karma in the organization identified by
+        the given organization ID, highest first. Users with the same Karma
+        are ranked by ID.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "count": 58,
+              "data": [
+                {
+                  "rank": 1,
+                  "id": 81,
+                  "first_name": "Brian",
+                  "last_name": "Masters",
+                  "karma": "9.20"
+                }, {
+                  "rank": 2,
+                  "id": 1,
+                  "first_name": "Frank",
+                  "last_name": "Smith",
+                  "karma": "8.20"
+                }
+              ],
+              "user": {
+                "rank": 37,
+                "id": 43,
+                "karma": "-4.90"
+              }
+            }
+
+        :query top: How many users to return, up to 200. Defaults to 10.
+        :query user: *Optional* The ID of a user in the organization, whose
+            rank should be returned as ``user``.
+        :status 200: no errors
+        :status 400: the user is not in the organization
+        :status 404: there is no organization with the given ID
+        """
+        if not Organization.query.get(org_id):
+            abort(404, message="Organization {} does not exist".format(org_id))
+        args = parser.parse_args()
+        top = min(max(args.top, 0), MAX_TOP)
+        board = leaderboards.get(
+            org_id, current_app.config.get("LEADERBOARD_TTL", 300))
+        output = top_users(board, top)
+        if args.user is not None:
+            if args.user not in board:
+                abort(400, message="User {} is not in the organization".format(args.user))
+            output["user"] = {
+                "rank": board.rank(args.user),
+                "id": args.user,
+                "karma": format_cents(board.karma[args.user]),
+            }
+        return output
+
+
+def top_users(board, top):
+    leaders = board.top(top)
+    names = dict((user_id, (first_name, last_name))
+        for user_id, first_name, last_name in
+        db.session.query(User.id, User.first_name, User.last_name)
+            .filter(User.id.in_([user_id for user_id, _ in leaders]))
+    ) if leaders else {}
+    return {
+        "count": len(board),
+        "data": [{
+            "rank": rank,
+            "id": user_id,
+            "first_name": names.get(user_id, (None, None))[0],
+            "last_name": names.get(user_id, (None, None))[1],
+            "karma": format_cents(cents),
+        } for rank, (user_id, cents) in enumerate(leaders, 1)],
+    }
+
+
+api.add_resource(OrganizationLeaderboard, "/organizations/<int:org_id>/leaderboard")
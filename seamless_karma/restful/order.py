@@ -15,7 +15,8 @@ from datetime import datetime, date
 import copy
 import six
 from .utils import make_optional
-from .decorators import handle_sqlalchemy_errors, resource_list
+from .decorators import (handle_sqlalchemy_errors, read_only_get, resource_list,
+    Filter, check_version, version_headers)
 
 
 class OrderContributionField(fields.Raw):
@@ -35,6 +36,7 @@ mfields = {
     "placed_at": ISOFormatField,
     "total": TwoDecimalPlaceField(attribute="total_amount"),
     "contributions": OrderContributionField,
+    "version": fields.Integer,
 }
 
 
@@ -101,16 +103,55 @@ user_order_parser.add_argument('seamless_id', type=int)
 order_parser = copy.deepcopy(user_order_parser)
 order_parser.add_argument('ordered_by_id', type=int, required=True)
 
+# only indexed columns, so that filtering never reads the whole table
+filters = {
+    "for_date": Filter(Order.for_date, date_type),
+    "placed_at": Filter(Order.placed_at, datetime_type, operators=("lt", "lte", "gt", "gte")),
+    "vendor_id": Filter(Order.vendor_id),
+    "ordered_by_id": Filter(Order.ordered_by_id),
+    "contributor": Filter(OrderContribution.user_id, operators=("eq", "in"),
+        via="contributions"),
+}
+sorts = {
+    "id": Order.id,
+    "seamless_id": Order.seamless_id,
+    "for_date": Order.for_date,
+    "placed_at": Order.placed_at,
+}
+
 
 class OrderList(Resource):
     model = Order
-    decorators = [handle_sqlalchemy_errors(Order)]
+    decorators = [handle_sqlalchemy_errors(Order), read_only_get]
 
-    @resource_list(Order, mfields)
+    @resource_list(Order, mfields, filters=filters, sorts=sorts)
     def get(self):
         """
         Return a list of all orders.
 
+        :query for_date: Only orders for this date, as YYYY-MM-DD. Also
+            ``for_date__in``, with a comma-separated list of dates, and
+            ``for_date__lt``, ``__lte``, ``__gt`` and ``__gte`` for ranges.
+        :query placed_at__lt: Only orders placed before this ISO8601
+            date-time. Also ``placed_at__lte``, ``__gt`` and ``__gte``.
+        :query vendor_id: Only orders from this vendor. Also ``vendor_id__in``.
+        :query ordered_by_id: Only orders placed by this user. Also
+            ``ordered_by_id__in``.
+        :query contributor: Only orders this user contributed to. Also
+            ``contributor__in``.
+        :query order: Comma-separated sort keys, each one of ``id``,
+            ``seamless_id``, ``for_date`` or ``placed_at``, with a leading
+            ``-`` to sort in descending order. Ties are sorted by ID.
+        :status 200: no errors
+        :status 400: an invalid filter, or a filter on anything else
+
+        Example request:
+
+        .. sourcecode:: http
+
+            GET /api/orders?for_date__gte=2014-03-01&for_date__lt=2014-04-01&vendor_id__in=3,7 HTTP/1.1
+            Host: seamlesskarma.com
+
         Example response:
 
         .. sourcecode:: http
@@ -209,6 +250,8 @@ class OrderList(Resource):
             }
 
         :status 201: the order was successfully created
+        :status 409: allocations are enforced, and the order would take one
+            of the contributors over their allocation for the day
 
         .. _Seamless: http://www.seamless.com
         """
@@ -222,7 +265,7 @@ class OrderList(Resource):
 
 class OrderDetail(Resource):
     model = Order
-    decorators = [handle_sqlalchemy_errors(Order)]
+    decorators = [handle_sqlalchemy_errors(Order), read_only_get]
 
     def get_order_or_abort(self, id):
         o = Order.query.get(id)
@@ -264,10 +307,13 @@ class OrderDetail(Resource):
               ]
             }
 
+        :resheader ETag: the version of the order, to send as ``If-Match``
+            when changing it
         :status 200: no error
         :status 404: there is no order with the given ID
         """
-        return self.get_order_or_abort(order_id)
+        o = self.get_order_or_abort(order_id)
+        return o, 200, version_headers(o)
 
     @marshal_with(mfields)
     def put(self, order_id):
@@ -323,21 +369,27 @@ class OrderDetail(Resource):
             existing contribution information, meaning that if you do not include
             a specific user's contribution in your update, that contribution
             will be removed from this order.
+        :reqheader If-Match: *Optional* the version of the order that the
+            client last saw, from its ``ETag``
         :status 200: the order was updated
         :status 404: there is no user with the given ID
+        :status 409: the order was changed by another request at the same
+            time
+        :status 412: the order has changed since the version in ``If-Match``
         """
 
         o = self.get_order_or_abort(order_id)
+        check_version(o)
         args = make_optional(order_parser).parse_args()
         for attr in ('seamless_id', 'vendor_id', 'ordered_by_id', 'for_date', 'placed_at'):
             if attr in args:
-                setattr(u, attr, args[attr])
+                setattr(o, attr, args[attr])
         if args.contributions:
-            o.contributions = [OrderContribution(user_id=c.user_id, amount=amount, order=o)
+            o.contributions = [OrderContribution(user_id=user_id, amount=amount, order=o)
                 for user_id, amount in args.contributions.items()]
         db.session.add(o)
         db.session.commit()
-        return o
+        return o, 200, version_headers(o)
 
     def delete(self, order_id):
         """
@@ -354,10 +406,16 @@ class OrderDetail(Resource):
               "message": "deleted"
             }
 
+        :reqheader If-Match: *Optional* the version of the order that the
+            client last saw, from its ``ETag``
         :status 200: the order was deleted
         :status 404: there is no order with the given ID
+        :status 409: the order was changed by another request at the same
+            time
+        :status 412: the order has changed since the version in ``If-Match``
         """
         o = self.get_order_or_abort(order_id)
+        check_version(o)
         db.session.delete(o)
         db.session.commit()
         return {"message": "deleted"}, 200
@@ -365,9 +423,9 @@ class OrderDetail(Resource):
 
 class UserOrderList(Resource):
     model = Order
-    decorators = [handle_sqlalchemy_errors(Order)]
+    decorators = [handle_sqlalchemy_errors(Order), read_only_get]
 
-    @resource_list(Order, mfields)
+    @resource_list(Order, mfields, filters=filters, sorts=sorts)
     def get(self, user_id):
         """
         Get all orders ordered by the user identified by the given user ID.
@@ -392,9 +450,9 @@ class UserOrderList(Resource):
 
 class OrganizationOrderList(Resource):
     model = Order
-    decorators = [handle_sqlalchemy_errors(Order)]
+    decorators = [handle_sqlalchemy_errors(Order), read_only_get]
 
-    @resource_list(Order, mfields)
+    @resource_list(Order, mfields, filters=filters, sorts=sorts)
     def get(self, org_id):
         """
         Get all orders placed by users in the organization identified by
@@ -408,9 +466,9 @@ class OrganizationOrderList(Resource):
 
 class OrganizationOrderListForDate(Resource):
     model = Order
-    decorators = [handle_sqlalchemy_errors(Order)]
+    decorators = [handle_sqlalchemy_errors(Order), read_only_get]
 
-    @resource_list(Order, mfields)
+    @resource_list(Order, mfields, filters=filters, sorts=sorts)
     def get(self, org_id, for_date):
         """
         Get all orders placed on the given date by users in the organization
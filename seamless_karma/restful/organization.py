@@ -9,13 +9,15 @@ from flask import url_for
 from flask.ext.restful import Resource, abort, fields, marshal_with, reqparse
 from decimal import Decimal
 from .utils import make_optional
-from .decorators import handle_sqlalchemy_errors, resource_list
+from .decorators import (handle_sqlalchemy_errors, read_only_get, resource_list,
+    check_version, version_headers)
 
 mfields = {
     "id": fields.Integer,
     "seamless_id": fields.Integer(default=None),
     "name": fields.String,
     "default_allocation": TwoDecimalPlaceField,
+    "version": fields.Integer,
 }
 
 parser = reqparse.RequestParser()
@@ -23,16 +25,27 @@ parser.add_argument('seamless_id', type=int)
 parser.add_argument('name', required=True)
 parser.add_argument('default_allocation', type=Decimal)
 
+sorts = {
+    "id": Organization.id,
+    "seamless_id": Organization.seamless_id,
+    "name": Organization.name,
+}
+
 
 class OrganizationList(Resource):
     model = Organization
-    decorators = [handle_sqlalchemy_errors(Organization)]
+    decorators = [handle_sqlalchemy_errors(Organization), read_only_get]
 
-    @resource_list(Organization, mfields, parser=make_optional(parser))
+    @resource_list(Organization, mfields, parser=make_optional(parser),
+        sorts=sorts)
     def get(self):
         """
         Return a list of all organizations.
 
+        :query order: Comma-separated sort keys, each one of ``id``,
+            ``seamless_id`` or ``name``, with a leading ``-`` to sort in
+            descending order. Ties are sorted by ID.
+
         Example response:
 
         .. sourcecode:: http
@@ -108,7 +121,7 @@ class OrganizationList(Resource):
 
 class OrganizationDetail(Resource):
     model = Organization
-    decorators = [handle_sqlalchemy_errors(Organization)]
+    decorators = [handle_sqlalchemy_errors(Organization), read_only_get]
 
     def get_org_or_abort(self, id):
         o = Organization.query.get(id)
@@ -135,10 +148,13 @@ class OrganizationDetail(Resource):
               "default_allocation": "11.50"
             }
 
+        :resheader ETag: the version of the organization, to send as ``If-Match``
+            when changing it
         :status 200: no error
         :status 404: there is no user with the given ID
         """
-        return self.get_org_or_abort(org_id)
+        o = self.get_org_or_abort(org_id)
+        return o, 200, version_headers(o)
 
     @marshal_with(mfields)
     def put(self, org_id):
@@ -173,17 +189,23 @@ class OrganizationDetail(Resource):
         :form seamless_id: *Optional* updated Seamless ID
         :form name: *Optional* updated name
         :form default_allocation: *Optional* updated default allocation
+        :reqheader If-Match: *Optional* the version of the organization that the
+            client last saw, from its ``ETag``
         :status 200: the organization was updated
         :status 404: there is no organization with the given ID
+        :status 409: the organization was changed by another request at the same
+            time
+        :status 412: the organization has changed since the version in ``If-Match``
         """
         o = self.get_org_or_abort(org_id)
+        check_version(o)
         args = make_optional(parser).parse_args()
         for attr in ('seamless_id', 'name', 'default_allocation'):
             if attr in args:
                 setattr(o, attr, args[attr])
         db.session.add(o)
         db.session.commit()
-        return o
+        return o, 200, version_headers(o)
 
     def delete(self, org_id):
         """
@@ -200,10 +222,16 @@ class OrganizationDetail(Resource):
               "message": "deleted"
             }
 
+        :reqheader If-Match: *Optional* the version of the organization that the
+            client last saw, from its ``ETag``
         :status 200: the organization was deleted
         :status 404: there is no organization with the given ID
+        :status 409: the organization was changed by another request at the same
+            time
+        :status 412: the organization has changed since the version in ``If-Match``
         """
         o = self.get_org_or_abort(org_id)
+        check_version(o)
         db.session.delete(o)
         db.session.commit()
         return {"message": "deleted"}, 200
@@ -211,7 +239,7 @@ class OrganizationDetail(Resource):
 
 class OrganizationByName(Resource):
     model = Organization
-    decorators = [handle_sqlalchemy_errors(Organization)]
+    decorators = [handle_sqlalchemy_errors(Organization), read_only_get]
 
     def get_org_or_abort(self, name):
         try:
@@ -225,7 +253,8 @@ class OrganizationByName(Resource):
         Get a specific organization, identified by name. Otherwise identical
         to :http:get:`/api/organizations/(id:org_id)`
         """
-        return self.get_org_or_abort(name)
+        o = self.get_org_or_abort(name)
+        return o, 200, version_headers(o)
 
     @marshal_with(mfields)
     def put(self, name):
@@ -235,13 +264,14 @@ class OrganizationByName(Resource):
         :http:put:`/api/organizations/(id:org_id)`
         """
         o = self.get_org_or_abort(name)
+        check_version(o)
         args = make_optional(parser).parse_args()
         for attr in ('seamless_id', 'default_allocation'):
             if attr in args:
                 setattr(o, attr, args[attr])
         db.session.add(o)
         db.session.commit()
-        return o
+        return o, 200, version_headers(o)
 
     def delete(self, name):
         """
@@ -249,6 +279,7 @@ class OrganizationByName(Resource):
         to :http:delete:`/api/organizations(id:org_id)`
         """
         o = self.get_org_or_abort(name)
+        check_version(o)
         db.session.delete(o)
         db.session.commit()
         return {"message": "deleted"}, 200
@@ -0,0 +1,66 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from seamless_karma.models import Organization
+from seamless_karma.extensions import api
+from seamless_karma.settlement import organization_balances, settle
+from flask.ext.restful import Resource, abort
+from .utils import format_cents
+from .decorators import handle_sqlalchemy_errors, read_only_get
+
+
+class OrganizationSettlement(Resource):
+    decorators = [handle_sqlalchemy_errors(), read_only_get]
+
+    def get(self, org_id):
+        """
+        Return a list of payments that would settle the Karma of every user in
+        the organization identified by the given organization ID: users with
+        negative Karma pay users with positive Karma, until everyone is at
+        zero. There are never more payments than users with non-zero Karma,
+        and usually far fewer, since the largest debt is always paid to the
+        largest credit first.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "total": "17.40",
+              "data": [
+                {
+                  "from_user_id": 93,
+                  "to_user_id": 81,
+                  "amount": "9.20"
+                }, {
+                  "from_user_id": 43,
+                  "to_user_id": 1,
+                  "amount": "4.90"
+                }, {
+                  "from_user_id": 93,
+                  "to_user_id": 1,
+                  "amount": "3.30"
+                }
+              ]
+            }
+
+        :status 200: no errors
+        :status 404: there is no organization with the given ID
+        """
+        if not Organization.query.get(org_id):
+            abort(404, message="Organization {} does not exist".format(org_id))
+        payments = settle(organization_balances(org_id))
+        return {
+            "total": format_cents(sum(cents for _, _, cents in payments)),
+            "data": [{
+                "from_user_id": payer_id,
+                "to_user_id": payee_id,
+                "amount": format_cents(cents),
+            } for payer_id, payee_id, cents in payments],
+        }
+
+
+api.add_resource(OrganizationSettlement, "/organizations/<int:org_id>/settlement")
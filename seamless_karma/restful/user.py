@@ -1,15 +1,20 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from seamless_karma.models import User, Organization
+from seamless_karma.models import (User, Organization, DailyUserKarma,
+    UserKarmaRollup)
 from seamless_karma.extensions import db, api
-from seamless_karma.subclass import TwoDecimalPlaceField
+from seamless_karma.subclass import TwoDecimalPlaceField, TWOPLACES, date_type
 import sqlalchemy as sa
-from flask import url_for
-from flask.ext.restful import Resource, abort, fields, marshal_with, reqparse
+from seamless_karma import search
+from flask import url_for, current_app
+from flask.ext.restful import (Resource, abort, fields, marshal, marshal_with,
+    reqparse)
 from decimal import Decimal
+import six
 from .utils import make_optional
-from .decorators import handle_sqlalchemy_errors, resource_list
+from .decorators import (handle_sqlalchemy_errors, read_only_get, resource_list,
+    check_version, version_headers)
 
 
 mfields = {
@@ -21,6 +26,7 @@ mfields = {
     "allocation": TwoDecimalPlaceField,
     "karma": TwoDecimalPlaceField,
     "organization_id": fields.Integer,
+    "version": fields.Integer,
     # "organization": fields.Nested({
     #     "id": fields.Integer,
     #     "name": fields.String,
@@ -37,16 +43,28 @@ parser.add_argument('last_name', required=True)
 parser.add_argument('allocation', type=Decimal,
     help="Seamless allocation of user, as a decimal string")
 
+sorts = {
+    "id": User.id,
+    "seamless_id": User.seamless_id,
+    "username": User.username,
+    "name": (User.last_name, User.first_name),
+}
+
 
 class UserList(Resource):
     model = User
-    decorators = [handle_sqlalchemy_errors(User)]
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
 
-    @resource_list(User, mfields, parser=make_optional(parser))
+    @resource_list(User, mfields, parser=make_optional(parser), sorts=sorts)
     def get(self):
         """
         Return a list of all users.
 
+        :query order: Comma-separated sort keys, each one of ``id``,
+            ``seamless_id``, ``username`` or ``name`` (last name, then first
+            name), with a leading ``-`` to sort in descending order. Ties are
+            sorted by ID.
+
         Example response:
 
         .. sourcecode:: http
@@ -177,9 +195,9 @@ class UserList(Resource):
 
 class UsersInOrganization(Resource):
     model = User
-    decorators = [handle_sqlalchemy_errors(User)]
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
 
-    @resource_list(User, mfields, parser=make_optional(parser))
+    @resource_list(User, mfields, parser=make_optional(parser), sorts=sorts)
     def get(self, org_id):
         """
         Return a list of all users in the given organization. Identical to
@@ -210,7 +228,7 @@ class UsersInOrganization(Resource):
 
 class UsersInOrganizationByName(Resource):
     model = User
-    decorators = [handle_sqlalchemy_errors(User)]
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
 
     def get_org_or_abort(self, name):
         try:
@@ -218,7 +236,7 @@ class UsersInOrganizationByName(Resource):
         except sa.orm.exc.NoResultFound:
             abort(404, message="Organization {} does not exist".format(name))
 
-    @resource_list(User, mfields, parser=make_optional(parser))
+    @resource_list(User, mfields, parser=make_optional(parser), sorts=sorts)
     def get(self, name):
         """
         Return a list of all users in the given organization. Identical to
@@ -247,7 +265,7 @@ class UsersInOrganizationByName(Resource):
 
 class UserDetail(Resource):
     model = User
-    decorators = [handle_sqlalchemy_errors(User)]
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
 
     def get_user_or_abort(self, id):
         u = User.query.get(id)
@@ -278,10 +296,13 @@ class UserDetail(Resource):
               "organization_id": 3
             }
 
+        :resheader ETag: the version of the user, to send as ``If-Match``
+            when changing it
         :status 200: no error
         :status 404: there is no user with the given ID
         """
-        return self.get_user_or_abort(user_id)
+        u = self.get_user_or_abort(user_id)
+        return u, 200, version_headers(u)
 
     @marshal_with(mfields)
     def put(self, user_id):
@@ -320,18 +341,29 @@ class UserDetail(Resource):
         :form seamless_id: *Optional* updated Seamless ID
         :form username: *Optional* updated Seamless username
         :form first_name: *Optional* updated first name
-        :form last_name: *Optional* updated allocation
+        :form last_name: *Optional* updated last name
+        :form allocation: *Optional* updated allocation, which takes effect
+            today. Unallocated money for earlier dates is still based on
+            the allocation that was in effect at the time.
+        :reqheader If-Match: *Optional* the version of the user that the
+            client last saw, from its ``ETag``
         :status 200: the user was updated
         :status 404: there is no user with the given ID
+        :status 409: the user was changed by another request at the same
+            time
+        :status 412: the user has changed since the version in ``If-Match``
         """
         u = self.get_user_or_abort(user_id)
+        check_version(u)
         args = make_optional(parser).parse_args()
-        for attr in ('seamless_id', 'username', 'first_name', 'last_name', 'allocation'):
+        for attr in ('seamless_id', 'username', 'first_name', 'last_name'):
             if attr in args:
                 setattr(u, attr, args[attr])
+        if args.get('allocation') is not None and args['allocation'] != u.allocation:
+            u.change_allocation(args['allocation'])
         db.session.add(u)
         db.session.commit()
-        return u
+        return u, 200, version_headers(u)
 
     def delete(self, user_id):
         """
@@ -348,10 +380,16 @@ class UserDetail(Resource):
               "message": "deleted"
             }
 
+        :reqheader If-Match: *Optional* the version of the user that the
+            client last saw, from its ``ETag``
         :status 200: the user was deleted
         :status 404: there is no user with the given ID
+        :status 409: the user was changed by another request at the same
+            time
+        :status 412: the user has changed since the version in ``If-Match``
         """
         u = self.get_user_or_abort(user_id)
+        check_version(u)
         db.session.delete(u)
         db.session.commit()
         return {"message": "deleted"}, 200
@@ -359,7 +397,7 @@ class UserDetail(Resource):
 
 class UserByUsername(Resource):
     model = User
-    decorators = [handle_sqlalchemy_errors(User)]
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
 
     def get_user_or_abort(self, username):
         try:
@@ -373,7 +411,8 @@ class UserByUsername(Resource):
         Get a user by Seamless username instead of by ID. Otherwise identical
         to :http:get:`/api/users/(int:user_id)`
         """
-        return self.get_user_or_abort(username)
+        u = self.get_user_or_abort(username)
+        return u, 200, version_headers(u)
 
     @marshal_with(mfields)
     def put(self, username):
@@ -383,13 +422,16 @@ class UserByUsername(Resource):
         :http:put:`/api/users/(int:user_id)`.
         """
         u = self.get_user_or_abort(username)
+        check_version(u)
         args = make_optional(parser).parse_args()
-        for attr in ('seamless_id', 'first_name', 'last_name', 'allocation'):
+        for attr in ('seamless_id', 'first_name', 'last_name'):
             if attr in args:
                 setattr(u, attr, args[attr])
+        if args.get('allocation') is not None and args['allocation'] != u.allocation:
+            u.change_allocation(args['allocation'])
         db.session.add(u)
         db.session.commit()
-        return u
+        return u, 200, version_headers(u)
 
     def delete(self, username):
         """
@@ -397,12 +439,177 @@ class UserByUsername(Resource):
         identical to :http:delete:`/api/users/(int:user_id)`.
         """
         u = self.get_user_or_abort(username)
+        check_version(u)
         db.session.delete(u)
         db.session.commit()
         return {"message": "deleted"}, 200
 
+
+history_parser = reqparse.RequestParser()
+history_parser.add_argument('granularity', default='day', location='args',
+    choices=('day',) + UserKarmaRollup.GRANULARITIES)
+history_parser.add_argument('from', dest='start', type=date_type, location='args')
+history_parser.add_argument('to', dest='end', type=date_type, location='args')
+
+
+class UserKarmaHistory(Resource):
+    model = User
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
+
+    def get(self, user_id):
+        """
+        Return how a user's Karma has changed over time, by day, week or month.
+        Only periods in which the user's Karma changed are included. Each
+        period is identified by its first day; weeks start on Monday. For each
+        period, ``given`` is what the user contributed to other users' orders,
+        ``received`` is what other users contributed to the user's orders,
+        and ``karma`` is the user's Karma at the end of the period.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "granularity": "month",
+              "data": [
+                {
+                  "date": "2014-02-01",
+                  "given": "12.50",
+                  "received": "3.00",
+                  "karma": "9.50"
+                }, {
+                  "date": "2014-03-01",
+                  "given": "0.00",
+                  "received": "11.25",
+                  "karma": "-1.75"
+                }
+              ]
+            }
+
+        :query granularity: One of ``day``, ``week`` or ``month``. Defaults
+            to ``day``.
+        :query from: Only include periods starting on or after this date,
+            formatted as an ISO8601 date string (YYYY-MM-DD).
+        :query to: Only include periods starting on or before this date,
+            formatted as an ISO8601 date string (YYYY-MM-DD).
+        :status 200: no error
+        :status 404: there is no user with the given ID
+        """
+        if not User.query.get(user_id):
+            abort(404, message="User {} does not exist".format(user_id))
+        args = history_parser.parse_args()
+        if args.granularity == 'day':
+            table = DailyUserKarma.__table__
+            date_col = table.c.for_date
+            rows = (db.session.query(date_col, table.c.given, table.c.received)
+                .filter(table.c.user_id == user_id))
+        else:
+            table = UserKarmaRollup.__table__
+            date_col = table.c.period_start
+            rows = (db.session.query(date_col, table.c.given, table.c.received)
+                .filter(table.c.user_id == user_id)
+                .filter(table.c.granularity == args.granularity))
+        karma = Decimal('0.00')
+        if args.start:
+            # Karma at the start is the sum of every earlier period
+            given, received = (rows.filter(date_col < args.start)
+                .with_entities(sa.func.sum(table.c.given), sa.func.sum(table.c.received))
+                .one())
+            if given is not None:
+                karma = given - received
+            rows = rows.filter(date_col >= args.start)
+        if args.end:
+            rows = rows.filter(date_col <= args.end)
+        output = {"granularity": args.granularity, "data": []}
+        for period, given, received in rows.order_by(date_col):
+            karma += given - received
+            output["data"].append({
+                "date": period.isoformat(),
+                "given": six.text_type(given.quantize(TWOPLACES)),
+                "received": six.text_type(received.quantize(TWOPLACES)),
+                "karma": six.text_type(karma.quantize(TWOPLACES)),
+            })
+        return output
+
+
+MAX_SEARCH_RESULTS = 100
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', required=True, location='args',
+    help="Text to search for")
+search_parser.add_argument('org', type=int, location='args',
+    help="Organization ID")
+search_parser.add_argument('limit', type=int, default=20, location='args')
+
+
+class UserSearch(Resource):
+    model = User
+    decorators = [handle_sqlalchemy_errors(User), read_only_get]
+
+    def get(self):
+        """
+        Search for users by username or by name, allowing for typos. Results
+        are ranked by how similar the best-matching name is to the query,
+        from 0 to 1; names that start with the query always match.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "count": 1,
+              "data": [
+                {
+                  "id": 1,
+                  "seamless_id": 5,
+                  "username": "alice",
+                  "first_name": "Alice",
+                  "last_name": "Smith",
+                  "allocation": "11.50",
+                  "karma": "0.00",
+                  "organization_id": 1,
+                  "score": 0.533
+                }
+              ]
+            }
+
+        :query q: *Required* Text to search for.
+        :query org: Only search the users in the organization with this ID.
+        :query limit: Maximum number of users to return, up to 100.
+            Defaults to 20.
+        :status 200: no errors
+        :status 400: the query is empty
+        """
+        args = search_parser.parse_args()
+        if not search.words(args.q):
+            abort(400, message="q must contain at least one letter or digit")
+        limit = min(max(args.limit, 0), MAX_SEARCH_RESULTS)
+        found = search.users.search(args.q, group=args.org, limit=limit,
+            ttl=current_app.config.get("SEARCH_INDEX_TTL", 300))
+        users = {}
+        if found:
+            users = dict((user.id, user) for user in
+                User.query.filter(User.id.in_([id for id, _ in found])))
+        data = []
+        for user_id, score in found:
+            if user_id not in users:
+                continue
+            item = marshal(users[user_id], mfields)
+            item["score"] = round(score, 3)
+            data.append(item)
+        return {"count": len(data), "data": data}
+
+
 api.add_resource(UserList, "/users")
+api.add_resource(UserSearch, "/users/search")
 api.add_resource(UserDetail, "/users/<int:user_id>")
 api.add_resource(UserByUsername, "/users/<username>")
+api.add_resource(UserKarmaHistory, "/users/<int:user_id>/karma/history")
 api.add_resource(UsersInOrganization, "/organizations/<int:org_id>/users")
 api.add_resource(UsersInOrganizationByName, "/organizations/<name>/users")
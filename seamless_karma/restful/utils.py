@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 
 import copy
 import six
+from decimal import Decimal
+from seamless_karma.subclass import TWOPLACES
 from six.moves.urllib.parse import (
     urlsplit, urlunsplit, parse_qsl, urlencode
 )
@@ -58,3 +60,10 @@ def bool_from_str(s):
         return False
     else:
         return True
+
+
+def format_cents(cents):
+    """
+    Format an integer number of cents as a decimal string, like "11.50".
+    """
+    return six.text_type((Decimal(cents) / 100).quantize(TWOPLACES))
@@ -3,11 +3,15 @@ from __future__ import unicode_literals
 
 from seamless_karma.models import Vendor
 from seamless_karma.extensions import db, api
-from flask import url_for
-from flask.ext.restful import Resource, abort, fields, marshal_with, reqparse
+from seamless_karma import search
+from seamless_karma.shards import copy_to_shards, delete_from_shards
+from flask import url_for, current_app
+from flask.ext.restful import (Resource, abort, fields, marshal, marshal_with,
+    reqparse)
 from decimal import Decimal
 from .utils import make_optional
-from .decorators import handle_sqlalchemy_errors, resource_list
+from .decorators import (handle_sqlalchemy_errors, read_only_get, resource_list,
+    check_version, version_headers)
 
 mfields = {
     "id": fields.Integer,
@@ -15,6 +19,7 @@ mfields = {
     "latitude": fields.Arbitrary(default=None),
     "longitude": fields.Arbitrary(default=None),
     "name": fields.String,
+    "version": fields.Integer,
 }
 
 parser = reqparse.RequestParser()
@@ -23,16 +28,26 @@ parser.add_argument('seamless_id', type=int)
 parser.add_argument('latitude', type=Decimal)
 parser.add_argument('longitude', type=Decimal)
 
+sorts = {
+    "id": Vendor.id,
+    "seamless_id": Vendor.seamless_id,
+    "name": Vendor.name,
+}
+
 
 class VendorList(Resource):
     model = Vendor
-    decorators = [handle_sqlalchemy_errors(Vendor)]
+    decorators = [handle_sqlalchemy_errors(Vendor), read_only_get]
 
-    @resource_list(Vendor, mfields, parser=make_optional(parser))
+    @resource_list(Vendor, mfields, parser=make_optional(parser), sorts=sorts)
     def get(self):
         """
         Return a list of all vendors.
 
+        :query order: Comma-separated sort keys, each one of ``id``,
+            ``seamless_id`` or ``name``, with a leading ``-`` to sort in
+            descending order. Ties are sorted by ID.
+
         Example response:
 
         .. sourcecode:: http
@@ -99,13 +114,14 @@ class VendorList(Resource):
         vendor = Vendor(**args)
         db.session.add(vendor)
         db.session.commit()
+        copy_to_shards(vendor)
         location = url_for('vendordetail', vendor_id=vendor.id)
         return {"message": "created", "id": vendor.id}, 201, {"Location": location}
 
 
 class VendorDetail(Resource):
     model = Vendor
-    decorators = [handle_sqlalchemy_errors(Vendor)]
+    decorators = [handle_sqlalchemy_errors(Vendor), read_only_get]
 
     def get_vendor_or_abort(self, id):
         vendor = Vendor.query.get(id)
@@ -133,10 +149,13 @@ class VendorDetail(Resource):
               "longitude": -23.340924
             }
 
+        :resheader ETag: the version of the vendor, to send as ``If-Match``
+            when changing it
         :status 200: no error
         :status 404: there is no vendor with the given ID
         """
-        return self.get_vendor_or_abort(vendor_id)
+        vendor = self.get_vendor_or_abort(vendor_id)
+        return vendor, 200, version_headers(vendor)
 
     @marshal_with(mfields)
     def put(self, vendor_id):
@@ -173,17 +192,24 @@ class VendorDetail(Resource):
         :form name: *Optional* updated name
         :form latitude: *Optional* updated latitude
         :form longitude: *Optional* updated longitude
+        :reqheader If-Match: *Optional* the version of the vendor that the
+            client last saw, from its ``ETag``
         :status 200: the vendor was updated
         :status 404: there is no vendor with the given ID
+        :status 409: the vendor was changed by another request at the same
+            time
+        :status 412: the vendor has changed since the version in ``If-Match``
         """
         vendor = self.get_vendor_or_abort(vendor_id)
+        check_version(vendor)
         args = make_optional(parser).parse_args()
         for attr in ('seamless_id', 'name', 'latitude', 'longitude'):
             if attr in args:
                 setattr(vendor, attr, args[attr])
         db.session.add(vendor)
         db.session.commit()
-        return vendor
+        copy_to_shards(vendor)
+        return vendor, 200, version_headers(vendor)
 
     def delete(self, vendor_id):
         """
@@ -200,14 +226,164 @@ class VendorDetail(Resource):
               "message": "deleted"
             }
 
+        :reqheader If-Match: *Optional* the version of the vendor that the
+            client last saw, from its ``ETag``
         :status 200: the vendor was deleted
         :status 404: there is no vendor with the given ID
+        :status 409: the vendor was changed by another request at the same
+            time
+        :status 412: the vendor has changed since the version in ``If-Match``
         """
         vendor = self.get_vendor_or_abort(vendor_id)
+        check_version(vendor)
         db.session.delete(vendor)
         db.session.commit()
+        delete_from_shards(Vendor, vendor_id)
         return {"message": "deleted"}, 200
 
 
+MAX_RADIUS_KM = 50
+
+near_parser = reqparse.RequestParser()
+near_parser.add_argument('lat', type=float, required=True, location='args',
+    help="Latitude, in decimal degrees")
+near_parser.add_argument('lon', type=float, required=True, location='args',
+    help="Longitude, in decimal degrees")
+near_parser.add_argument('radius', type=float, default=1.0, location='args',
+    help="Radius, in kilometers")
+near_parser.add_argument('limit', type=int, default=50, location='args')
+
+
+class VendorsNear(Resource):
+    model = Vendor
+    decorators = [handle_sqlalchemy_errors(Vendor), read_only_get]
+
+    def get(self):
+        """
+        Return the vendors within a given distance of a point, nearest first.
+        Vendors without a location are never included.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "count": 2,
+              "data": [
+                {
+                  "id": 2,
+                  "seamless_id": 569452,
+                  "name": "Ponzu",
+                  "latitude": 40.744,
+                  "longitude": -73.985,
+                  "distance": 0.212
+                }, {
+                  "id": 3,
+                  "seamless_id": null,
+                  "name": "Bob's Steakhouse",
+                  "latitude": 40.751,
+                  "longitude": -73.978,
+                  "distance": 0.884
+                }
+              ]
+            }
+
+        :query lat: *Required* Latitude of the point, in decimal degrees.
+        :query lon: *Required* Longitude of the point, in decimal degrees.
+        :query radius: Search radius in kilometers, up to 50. Defaults to 1.
+        :query limit: Maximum number of vendors to return. Defaults to 50.
+        :status 200: no errors
+        :status 400: invalid coordinates or radius
+        """
+        args = near_parser.parse_args()
+        if not -90 <= args.lat <= 90 or not -180 <= args.lon <= 180:
+            abort(400, message="lat must be between -90 and 90, "
+                "and lon between -180 and 180")
+        if not 0 < args.radius <= MAX_RADIUS_KM:
+            abort(400, message="radius must be between 0 and {} km".format(MAX_RADIUS_KM))
+        found = Vendor.near(args.lat, args.lon, args.radius)
+        page = found[:max(args.limit, 0)]
+        vendors = {}
+        if page:
+            vendors = dict((vendor.id, vendor) for vendor in
+                Vendor.query.filter(Vendor.id.in_([id for id, _ in page])))
+        data = []
+        for vendor_id, distance in page:
+            item = marshal(vendors[vendor_id], mfields)
+            item["distance"] = round(distance, 3)
+            data.append(item)
+        return {"count": len(found), "data": data}
+
+
+MAX_SEARCH_RESULTS = 100
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', required=True, location='args',
+    help="Text to search for")
+search_parser.add_argument('limit', type=int, default=20, location='args')
+
+
+class VendorSearch(Resource):
+    model = Vendor
+    decorators = [handle_sqlalchemy_errors(Vendor), read_only_get]
+
+    def get(self):
+        """
+        Search for vendors by name, allowing for typos. Results are ranked by
+        how similar the name is to the query, from 0 to 1; names that start
+        with the query always match.
+
+        Example response:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+              "count": 1,
+              "data": [
+                {
+                  "id": 2,
+                  "seamless_id": 569452,
+                  "name": "Ponzu",
+                  "latitude": 40.744,
+                  "longitude": -73.985,
+                  "score": 0.5
+                }
+              ]
+            }
+
+        :query q: *Required* Text to search for.
+        :query limit: Maximum number of vendors to return, up to 100.
+            Defaults to 20.
+        :status 200: no errors
+        :status 400: the query is empty
+        """
+        args = search_parser.parse_args()
+        if not search.words(args.q):
+            abort(400, message="q must contain at least one letter or digit")
+        limit = min(max(args.limit, 0), MAX_SEARCH_RESULTS)
+        found = search.vendors.search(args.q, limit=limit,
+            ttl=current_app.config.get("SEARCH_INDEX_TTL", 300))
+        vendors = {}
+        if found:
+            vendors = dict((vendor.id, vendor) for vendor in
+                Vendor.query.filter(Vendor.id.in_([id for id, _ in found])))
+        data = []
+        for vendor_id, score in found:
+            if vendor_id not in vendors:
+                continue
+            item = marshal(vendors[vendor_id], mfields)
+            item["score"] = round(score, 3)
+            data.append(item)
+        return {"count": len(data), "data": data}
+
+
 api.add_resource(VendorList, "/vendors")
+api.add_resource(VendorsNear, "/vendors/near")
+api.add_resource(VendorSearch, "/vendors/search")
 api.add_resource(VendorDetail, "/vendors/<int:vendor_id>")
@@ -0,0 +1,235 @@
+# coding=utf-8
+"""
+Fuzzy name search for users and vendors.
+
+On PostgreSQL, this uses the ``pg_trgm`` extension: names are matched with
+the trigram similarity operator and with ``ILIKE`` prefix patterns, both of
+which are served by trigram GIN indexes. Other databases have nothing
+similar, so each process keeps an in-memory trigram index instead, which
+scores matches the same way ``pg_trgm`` does.
+"""
+from __future__ import division, unicode_literals
+
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter
+from seamless_karma.extensions import db
+from seamless_karma.models import User, Vendor
+from seamless_karma.signals import names_changed
+import sqlalchemy as sa
+
+# the default pg_trgm.similarity_threshold
+THRESHOLD = 0.3
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def words(text):
+    return WORD_RE.findall(text.lower())
+
+
+def trigrams(text):
+    """
+    The trigrams of a string, as ``pg_trgm`` counts them: each word is
+    lowercased and padded with two spaces in front and one behind.
+    """
+    grams = set()
+    for word in words(text):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class TrigramIndex(object):
+    """
+    An inverted index from trigrams to the names containing them. Each
+    document is one of the names of an object (its username, or its full
+    name); an object's score is the best similarity of any of its names.
+    Objects can be put in groups, such as organizations, and each group has
+    its own postings too, so that searching one group only looks at the
+    names in it.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.objects = {}
+        self.next_document = 0
+
+    def add(self, object_id, names, group=None):
+        self.remove(object_id)
+        documents = []
+        for name in names:
+            if not name:
+                continue
+            document = self.next_document
+            self.next_document += 1
+            grams = trigrams(name)
+            self.documents[document] = (object_id, len(grams), words(name))
+            for key in self._keys(grams, group):
+                self.postings.setdefault(key, set()).add(document)
+            documents.append((document, grams))
+        self.objects[object_id] = (group, documents)
+
+    def remove(self, object_id):
+        group, documents = self.objects.pop(object_id, (None, ()))
+        for document, grams in documents:
+            del self.documents[document]
+            for key in self._keys(grams, group):
+                self.postings[key].discard(document)
+                if not self.postings[key]:
+                    del self.postings[key]
+
+    @staticmethod
+    def _keys(grams, group):
+        for gram in grams:
+            yield (None, gram)
+            if group is not None:
+                yield (group, gram)
+
+    def search(self, query, group=None, limit=20, threshold=THRESHOLD):
+        """
+        Return ``(object_id, score)`` for the best matches, best first.
+        Names that are similar enough, or that have a word starting with
+        the query, match.
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        counts = Counter()
+        for gram in query_grams:
+            counts.update(self.postings.get((group, gram), ()))
+        # a similar name shares at least ``threshold`` of the query's
+        # trigrams, and a name starting with the query shares all but the
+        # last one, so names sharing fewer can be skipped without scoring
+        needed = max(min(int(math.ceil(threshold * len(query_grams) - 1e-9)),
+                         len(query_grams) - 1), 1)
+        prefix = " ".join(words(query))
+        scores = {}
+        for document, count in counts.items():
+            if count < needed:
+                continue
+            object_id, size, name_words = self.documents[document]
+            score = count / (len(query_grams) + size - count)
+            if score < threshold and not any(
+                    " ".join(name_words[i:]).startswith(prefix)
+                    for i in range(len(name_words))):
+                continue
+            if score > scores.get(object_id, -1):
+                scores[object_id] = score
+        return heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+class Searchable(object):
+    """
+    How to search one model: which names to match, and which column, if
+    any, groups its rows.
+    """
+    def __init__(self, model, group_column=None):
+        self.model = model
+        self.group_column = group_column
+        self.index = None
+        self.built_at = None
+        self.stale = set()
+        self.lock = threading.Lock()
+
+    def name_columns(self):
+        if self.model is User:
+            return [User.username, User.first_name + " " + User.last_name]
+        return [self.model.name]
+
+    def rows(self, ids=None):
+        columns = [self.model.id] + self.name_columns()
+        if self.group_column is not None:
+            columns.append(self.group_column)
+        query = db.session.query(*columns)
+        if ids is not None:
+            query = query.filter(self.model.id.in_(ids))
+        for row in query:
+            if self.group_column is not None:
+                yield row[0], row[1:-1], row[-1]
+            else:
+                yield row[0], row[1:], None
+
+    def memory_search(self, query, group, limit, ttl):
+        with self.lock:
+            if self.index is None or self.built_at + ttl < time.time():
+                self.index = TrigramIndex()
+                for object_id, names, object_group in self.rows():
+                    self.index.add(object_id, names, object_group)
+                self.built_at = time.time()
+                self.stale = set()
+            elif self.stale:
+                stale, self.stale = self.stale, set()
+                for object_id in stale:
+                    self.index.remove(object_id)
+                for object_id, names, object_group in self.rows(stale):
+                    self.index.add(object_id, names, object_group)
+            return self.index.search(query, group, limit)
+
+    def postgres_query(self, query, group, limit):
+        names = self.name_columns()
+        score = sa.func.greatest(*[sa.func.similarity(name, query) for name in names]) \
+            if len(names) > 1 else sa.func.similarity(names[0], query)
+        prefix = escape_like(query) + "%"
+        # "%" is the pg_trgm similarity operator; it is doubled because
+        # psycopg2 uses "%" for parameters
+        matches = [name.op("%%")(query) for name in names]
+        matches.extend(name.ilike(prefix) for name in names)
+        if self.model is User:
+            matches.append(User.last_name.ilike(prefix))
+        rows = (db.session.query(self.model.id, score.label("score"))
+            .filter(sa.or_(*matches)))
+        if group is not None:
+            rows = rows.filter(self.group_column == group)
+        return rows.order_by(sa.desc("score"), self.model.id).limit(limit)
+
+    def postgres_search(self, query, group, limit):
+        rows = self.postgres_query(query, group, limit)
+        return [(object_id, float(score)) for object_id, score in rows]
+
+    def search(self, query, group=None, limit=20, ttl=300):
+        """
+        Return ``(object_id, score)`` for the best matches for ``query``,
+        best first, optionally only within one group.
+        """
+        if db.session.get_bind(sa.inspect(self.model)).name == "postgresql":
+            return self.postgres_search(query, group, limit)
+        return self.memory_search(query, group, limit, ttl)
+
+    def mark_stale(self, ids):
+        with self.lock:
+            self.stale.update(ids)
+
+
+users = Searchable(User, group_column=User.organization_id)
+vendors = Searchable(Vendor)
+
+
+@names_changed.connect
+def mark_stale(sender, model, ids):
+    for searchable in (users, vendors):
+        if searchable.model is model:
+            searchable.mark_stale(ids)
+
+
+TRIGRAM_INDEXES = [
+    ("users", "ix_users_username_trgm", "username"),
+    ("users", "ix_users_full_name_trgm", "(first_name || ' ' || last_name)"),
+    ("users", "ix_users_last_name_trgm", "last_name"),
+    ("vendors", "ix_vendors_name_trgm", "name"),
+]
+
+
+sa.event.listen(db.metadata, "before_create",
+    sa.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+for table_name, index_name, expression in TRIGRAM_INDEXES:
+    sa.event.listen(db.metadata.tables[table_name], "after_create",
+        sa.DDL("CREATE INDEX {index} ON {table} USING gin ({expression} gin_trgm_ops)".format(
+            index=index_name, table=table_name, expression=expression,
+        )).execute_if(dialect="postgresql"))
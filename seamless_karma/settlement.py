@@ -0,0 +1,75 @@
+# coding=utf-8
+"""
+Settling karma: a short list of payments that would bring every user in
+an organization back to zero karma.
+"""
+from __future__ import unicode_literals
+
+import heapq
+from seamless_karma.extensions import db
+from seamless_karma.flows import to_cents
+from seamless_karma.models import User, Order, OrderContribution
+from seamless_karma.sql_types import Currency
+import sqlalchemy as sa
+from sqlalchemy.sql import type_coerce
+
+
+def organization_balances(org_id):
+    """
+    Return a dict of user ID to karma in cents for every user in the
+    organization with non-zero karma, from two grouped queries rather than
+    one karma subquery per user.
+    """
+    total = type_coerce(sa.func.sum(OrderContribution.amount), Currency)
+    external = OrderContribution.user_id != Order.ordered_by_id
+    given = (db.session.query(OrderContribution.user_id, total)
+        .join(Order, OrderContribution.order_id == Order.id)
+        .join(User, OrderContribution.user_id == User.id)
+        .filter(User.organization_id == org_id)
+        .filter(external)
+        .group_by(OrderContribution.user_id)
+    )
+    received = (db.session.query(Order.ordered_by_id, total)
+        .join(OrderContribution, OrderContribution.order_id == Order.id)
+        .join(User, Order.ordered_by_id == User.id)
+        .filter(User.organization_id == org_id)
+        .filter(external)
+        .group_by(Order.ordered_by_id)
+    )
+    balances = {}
+    for user_id, amount in given:
+        balances[user_id] = balances.get(user_id, 0) + to_cents(amount)
+    for user_id, amount in received:
+        balances[user_id] = balances.get(user_id, 0) - to_cents(amount)
+    return dict((user_id, cents) for user_id, cents in balances.items() if cents)
+
+
+def settle(balances):
+    """
+    Given a dict of user ID to balance in cents, return a list of
+    ``(payer_id, payee_id, cents)`` payments that bring every balance to
+    zero: users with a negative balance pay users with a positive one.
+
+    The largest debt is always paid to the largest credit, so each payment
+    settles at least one user completely, giving at most n - 1 payments for
+    n users. Each step is a couple of heap operations, so this takes
+    O(n log n) time. If the balances don't add up to zero, the payments
+    stop when one side runs out.
+    """
+    # heapq is a min-heap, so store amounts negated to pop the largest;
+    # user IDs break ties, to keep the result deterministic
+    credits = [(-cents, user_id) for user_id, cents in balances.items() if cents > 0]
+    debts = [(cents, user_id) for user_id, cents in balances.items() if cents < 0]
+    heapq.heapify(credits)
+    heapq.heapify(debts)
+    payments = []
+    while credits and debts:
+        credit, payee_id = heapq.heappop(credits)
+        debt, payer_id = heapq.heappop(debts)
+        amount = min(-credit, -debt)
+        payments.append((payer_id, payee_id, amount))
+        if amount < -credit:
+            heapq.heappush(credits, (credit + amount, payee_id))
+        elif amount < -debt:
+            heapq.heappush(debts, (debt + amount, payer_id))
+    return payments
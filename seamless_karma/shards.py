@@ -0,0 +1,224 @@
+# coding=utf-8
+"""
+Keep organizations in more than one database.
+
+All of an organization's rows live in one database, its shard: the
+organization itself, its users, their orders, and the summaries and change
+log entries about them. ``SQLALCHEMY_SHARDS`` names the shards, as a dict of
+name to database URI, and ``SHARD_MAP`` says which organizations are on
+which, as a dict of organization ID to shard name. Organizations that aren't
+in the map are on the default database, ``SQLALCHEMY_DATABASE_URI``, which is
+also where new organizations are created. To move an organization to a
+shard, copy its rows there and add it to the map.
+
+Each request's session is routed to one shard. The shard is found from the
+organization ID in the URL, or the ``organization_id`` or ``org`` in the
+query string or form. Failing that, each shard is asked whether it has the user or order
+that the URL or form names. Resource lists in requests that don't name an
+organization, such as ``GET /api/users``, are read from every shard and
+merged in order (see :func:`merge`).
+
+Vendors don't belong to an organization. They're read from and written to
+the default database, and every change to one is copied to every shard, so
+that orders on any shard can refer to them.
+
+Each database gives out its own IDs. Give each shard's sequences a range of
+their own, so that a user or order ID is only ever on one shard. An ID that
+is on more than one shard can only be used along with the
+``organization_id`` that it belongs to.
+"""
+from __future__ import unicode_literals
+
+import heapq
+import sqlalchemy as sa
+from flask import current_app, request
+from flask.ext.restful import abort
+from seamless_karma.extensions import db
+from seamless_karma.models import User, Order, Organization
+
+#: the name of the default database, for organizations that aren't in
+#: ``SHARD_MAP``
+DEFAULT = "default"
+#: tables that every shard has a copy of
+SHARED_TABLES = ("vendors",)
+
+# URL arguments, then form or query string values, that name a row whose
+# shard the request should go to
+URL_LOOKUPS = [
+    ("user_id", User.id),
+    ("order_id", Order.id),
+    ("username", User.username),
+    ("name", Organization.name),
+]
+VALUE_LOOKUPS = [
+    ("ordered_by_id", User.id),
+    ("organization", Organization.name),
+]
+
+
+class Shards(object):
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def configured(self):
+        return bool(self.app.config["SQLALCHEMY_SHARDS"])
+
+    def names(self):
+        return [DEFAULT] + sorted(self.app.config["SQLALCHEMY_SHARDS"])
+
+    def shard_for(self, org_id):
+        return self.app.config["SHARD_MAP"].get(org_id, DEFAULT)
+
+    def engine(self, name):
+        if name == DEFAULT:
+            return db.get_engine(self.app)
+        return db.get_engine(self.app, bind=name)
+
+    def locate(self, attribute, value):
+        """
+        Return the shard with a row whose ``attribute`` is ``value``, or
+        the default database if no shard has one.
+        """
+        try:
+            value = attribute.type.python_type(value)
+        except ValueError:
+            # let the view complain about it
+            return DEFAULT
+        query = sa.select([attribute]).where(attribute == value).limit(1)
+        found = []
+        for name in self.names():
+            connection = self.engine(name).connect()
+            try:
+                if connection.execute(query).first() is not None:
+                    found.append(name)
+            finally:
+                connection.close()
+        if len(found) > 1:
+            abort(400, message="{model} with {column} {value} is on more than one "
+                "shard; say which with organization_id".format(
+                    model=attribute.class_.__name__, column=attribute.key, value=value))
+        return found[0] if found else DEFAULT
+
+    def shard_for_request(self):
+        """
+        Return the shard for the current request, or None if it doesn't name
+        an organization.
+        """
+        args = request.view_args or {}
+        if "org_id" in args:
+            return self.shard_for(args["org_id"])
+        for name in ("organization_id", "org"):
+            if request.values.get(name):
+                try:
+                    return self.shard_for(int(request.values[name]))
+                except ValueError:
+                    return DEFAULT
+        for name, attribute in URL_LOOKUPS:
+            if name in args:
+                return self.locate(attribute, args[name])
+        for name, attribute in VALUE_LOOKUPS:
+            if request.values.get(name):
+                return self.locate(attribute, request.values[name])
+        return None
+
+    def route_request(self):
+        if self.configured:
+            route(self.shard_for_request())
+
+    def create_all(self):
+        for name in self.names()[1:]:
+            db.Model.metadata.create_all(bind=self.engine(name))
+
+    def drop_all(self):
+        for name in self.names()[1:]:
+            db.Model.metadata.drop_all(bind=self.engine(name))
+            self.engine(name).dispose()
+
+
+def route(shard):
+    """
+    Send the current session's queries to ``shard``. If it's None, they go
+    to the default database, but resource lists are read from every shard.
+    """
+    session = db.session()
+    if session.shard != shard:
+        # rows from one shard must not be mistaken for rows with the same
+        # IDs from another
+        session.close()
+        session.shard = shard
+
+
+def scattered(model):
+    """
+    Whether queries for ``model`` in this request should be run on every
+    shard.
+    """
+    return (current_app.extensions["shards"].configured and
+            db.session().shard is None and
+            model.__tablename__ not in SHARED_TABLES)
+
+
+def merge(results):
+    """
+    Merge lists of ``(key, item)`` pairs, each sorted by key, into one
+    iterator of items sorted by key. Items with the same key come in the
+    order of the lists they're in.
+    """
+    decorated = [[((key, i, j), item) for j, (key, item) in enumerate(pairs)]
+                 for i, pairs in enumerate(results)]
+    return (item for _, item in heapq.merge(*decorated))
+
+
+def column_values(obj):
+    mapper = sa.inspect(obj).mapper
+    return dict((prop.columns[0].name, getattr(obj, prop.key))
+                for prop in mapper.column_attrs)
+
+
+def copy_to_shards(obj):
+    """
+    Copy a row of a shared table from the default database to every shard,
+    once it has been committed.
+    """
+    shards = current_app.extensions["shards"]
+    table = obj.__table__
+    values = column_values(obj)
+    for name in shards.names()[1:]:
+        with shards.engine(name).begin() as connection:
+            updated = connection.execute(
+                table.update().where(table.c.id == obj.id).values(**values))
+            if not updated.rowcount:
+                connection.execute(table.insert().values(**values))
+
+
+def delete_from_shards(model, id):
+    """
+    Delete a row of a shared table from every shard, once it has been
+    deleted from the default database.
+    """
+    shards = current_app.extensions["shards"]
+    table = model.__table__
+    for name in shards.names()[1:]:
+        with shards.engine(name).begin() as connection:
+            connection.execute(table.delete().where(table.c.id == id))
+
+
+def engines_for(app, org_ids):
+    """
+    Return a dict of engine to the organizations in ``org_ids`` that are on
+    its shard.
+    """
+    shards = app.extensions["shards"]
+    engines = {}
+    for org_id in org_ids:
+        engines.setdefault(shards.engine(shards.shard_for(org_id)), set()).add(org_id)
+    return engines
+
+
+def init_app(app):
+    app.config.setdefault("SHARD_MAP", {})
+    if not hasattr(app, "extensions"):
+        app.extensions = {}
+    shards = app.extensions["shards"] = Shards(app)
+    app.before_request(shards.route_request)
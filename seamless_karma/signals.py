@@ -0,0 +1,32 @@
+# coding=utf-8
+"""
+Signals sent when data that other parts of the application may have cached
+changes. Receivers are called with the application as the sender.
+"""
+from __future__ import unicode_literals
+
+from blinker import Namespace
+
+signals = Namespace()
+
+#: Sent after the allocations of some users in an organization have been
+#: changed and committed, with the ``organization_id``, the ``user_ids``
+#: that were changed, and the ``effective`` date from which they changed.
+allocations_changed = signals.signal("allocations-changed")
+
+#: Sent after a transaction that changed orders or order contributions has
+#: been committed, with ``changes``: the set of ``(user_id, for_date)``
+#: pairs whose daily usage or karma changed, including the old and new
+#: orderers of orders that changed hands.
+orders_changed = signals.signal("orders-changed")
+
+#: Sent after a transaction that may have changed the karma or the
+#: organization of some users has been committed, with their ``user_ids``.
+#: This includes users who were created or deleted.
+karma_changed = signals.signal("karma-changed")
+
+#: Sent after a transaction that created, changed or deleted some users or
+#: vendors has been committed, with the ``model`` (:class:`User` or
+#: :class:`Vendor`) and the ``ids`` of the rows, so that their names can
+#: be looked up again.
+names_changed = signals.signal("names-changed")
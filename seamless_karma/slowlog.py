@@ -0,0 +1,244 @@
+# coding=utf-8
+"""
+Slow query log.
+
+Any SQL statement that takes longer than ``SLOW_QUERY_THRESHOLD``
+milliseconds is recorded, along with the endpoint and resource class of
+the request that ran it, its bound parameters (with string values
+redacted), and its query plan. A fraction ``SLOW_QUERY_SAMPLE_RATE`` of
+slow statements are kept, so that a burst of slow queries doesn't turn
+into a burst of extra work.
+
+The plan is captured by a background thread on a separate connection, so
+the request that ran the slow statement doesn't wait for it. Only a plain
+``EXPLAIN`` is used: a slow statement is never run a second time.
+
+Entries are written to a fixed-size ring buffer file per process in
+``SLOW_QUERY_DIR``, holding the last ``SLOW_QUERY_LOG_SIZE`` entries, and
+can be read with ``manage.py slowlog``.
+"""
+from __future__ import unicode_literals
+
+import glob
+import json
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from datetime import datetime
+import six
+from six.moves import queue
+import sqlalchemy as sa
+from flask import current_app, has_app_context, has_request_context, request
+from seamless_karma.profiler import explain
+
+SLOT_SIZE = 4096
+COUNT = struct.Struct(str("Q"))
+LENGTH = struct.Struct(str("I"))
+QUEUE_SIZE = 100
+
+
+class RingBuffer(object):
+    """
+    A file holding the last ``size`` JSON entries written to it, in fixed-size
+    slots. The file starts with the total number of entries ever written,
+    which says which slot the next entry goes in. Each process has its own
+    file, written only by its explain thread.
+    """
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        length = COUNT.size + size * SLOT_SIZE
+        self.f = open(filename, "a+b")
+        if os.path.getsize(filename) < length:
+            self.f.truncate(length)
+        self.m = mmap.mmap(self.f.fileno(), length)
+
+    @staticmethod
+    def encode(entry):
+        """
+        Encode an entry to fit in a slot, shortening the plan and then the
+        statement if necessary.
+        """
+        entry = dict(entry)
+        limit = SLOT_SIZE - LENGTH.size
+        data = json.dumps(entry).encode("utf-8")
+        while len(data) > limit and entry.get("plan"):
+            entry["plan"] = entry["plan"][:-1]
+            data = json.dumps(entry).encode("utf-8")
+        if len(data) > limit:
+            excess = len(data) - limit + len(" ...")
+            entry["statement"] = entry["statement"][:-excess] + " ..."
+            data = json.dumps(entry).encode("utf-8")
+        return data
+
+    def append(self, entry):
+        data = self.encode(entry)
+        count = COUNT.unpack_from(self.m, 0)[0]
+        pos = COUNT.size + (count % self.size) * SLOT_SIZE
+        LENGTH.pack_into(self.m, pos, len(data))
+        self.m[pos + LENGTH.size:pos + LENGTH.size + len(data)] = data
+        COUNT.pack_into(self.m, 0, count + 1)
+
+    @classmethod
+    def read_file(cls, filename):
+        """
+        Return the entries in a ring buffer file, oldest first.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < COUNT.size:
+            return []
+        count = COUNT.unpack_from(data, 0)[0]
+        size = (len(data) - COUNT.size) // SLOT_SIZE
+        entries = []
+        for i in range(max(count - size, 0), count):
+            pos = COUNT.size + (i % size) * SLOT_SIZE
+            length = LENGTH.unpack_from(data, pos)[0]
+            raw = data[pos + LENGTH.size:pos + LENGTH.size + length]
+            entries.append(json.loads(raw.decode("utf-8")))
+        return entries
+
+    def close(self):
+        self.m.close()
+        self.f.close()
+
+
+def redact(parameters):
+    """
+    Replace string values in bound parameters, which could hold names or
+    other personal details, while keeping numbers and dates that are
+    useful for reproducing a query.
+    """
+    def redact_value(value):
+        if isinstance(value, (six.text_type, six.binary_type)):
+            return "<redacted {} chars>".format(len(value))
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        return "{}".format(value)
+    if isinstance(parameters, dict):
+        return dict((k, redact_value(v)) for k, v in parameters.items())
+    if isinstance(parameters, (list, tuple)):
+        return [redact_value(v) for v in parameters]
+    return redact_value(parameters)
+
+
+class SlowQueryLog(object):
+    def __init__(self, app):
+        self.app = app
+        self.threshold = app.config["SLOW_QUERY_THRESHOLD"] / 1000.0
+        self.sample_rate = app.config["SLOW_QUERY_SAMPLE_RATE"]
+        self.directory = app.config["SLOW_QUERY_DIR"]
+        self.size = app.config["SLOW_QUERY_LOG_SIZE"]
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def filename(self, pid=None):
+        return os.path.join(self.directory,
+            "slowlog_{}.ring".format(pid or os.getpid()))
+
+    def start(self):
+        """
+        Start the explain thread for this process. This happens on the first
+        slow query, rather than at startup, so that each gunicorn worker
+        starts its own thread and gets its own file after forking.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.queue = queue.Queue(QUEUE_SIZE)
+            self.pid = os.getpid()
+            ring = RingBuffer(self.filename(), self.size)
+            thread = threading.Thread(target=self.run, args=(self.queue, ring))
+            thread.daemon = True
+            thread.start()
+
+    def record(self, statement, parameters, duration):
+        if duration < self.threshold or random.random() >= self.sample_rate:
+            return
+        entry = {
+            "time": datetime.utcnow().isoformat(),
+            "pid": os.getpid(),
+            "duration_ms": round(duration * 1000, 3),
+            "statement": statement,
+            "parameters": redact(parameters),
+        }
+        if has_request_context():
+            entry["method"] = request.method
+            entry["path"] = request.path
+            entry["endpoint"] = request.endpoint
+            view = current_app.view_functions.get(request.endpoint)
+            view_class = getattr(view, "view_class", None)
+            if view_class is not None:
+                entry["resource"] = view_class.__name__
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            # hold on to the raw parameters for EXPLAIN, but never log them
+            self.queue.put_nowait((entry, parameters))
+        except queue.Full:
+            pass
+
+    def run(self, entries, ring):
+        from seamless_karma.extensions import db
+        engine = db.get_engine(self.app)
+        while True:
+            entry, parameters = entries.get()
+            try:
+                entry["plan"] = explain(engine, entry["statement"], parameters,
+                                        analyze=False)
+            except sa.exc.SQLAlchemyError as e:
+                entry["plan_error"] = "{}".format(e)
+            ring.append(entry)
+            entries.task_done()
+
+    def wait(self):
+        """
+        Block until every queued entry has been explained and written.
+        """
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.join()
+
+    def entries(self):
+        """
+        Return the entries from every process, oldest first.
+        """
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, "slowlog_*.ring")):
+            entries.extend(RingBuffer.read_file(filename))
+        return sorted(entries, key=lambda entry: entry["time"])
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._slowlog_start = time.time()
+
+
+@sa.event.listens_for(sa.engine.Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if executemany or not has_app_context():
+        return
+    log = current_app.extensions.get("slowlog")
+    start = getattr(context, "_slowlog_start", None)
+    if log is None or start is None:
+        return
+    log.record(statement, parameters, time.time() - start)
+
+
+def init_app(app):
+    """
+    Set up the slow query log, if ``SLOW_QUERY_THRESHOLD`` is configured.
+    """
+    app.config.setdefault("SLOW_QUERY_THRESHOLD", None)
+    app.config.setdefault("SLOW_QUERY_SAMPLE_RATE", 1.0)
+    app.config.setdefault("SLOW_QUERY_DIR", "/tmp/seamless_karma_slowlog")
+    app.config.setdefault("SLOW_QUERY_LOG_SIZE", 500)
+    if not hasattr(app, "extensions"):
+        app.extensions = {}
+    if app.config["SLOW_QUERY_THRESHOLD"] is not None:
+        app.extensions["slowlog"] = SlowQueryLog(app)
@@ -0,0 +1,408 @@
+# coding=utf-8
+"""
+Process-safe metric storage.
+
+Every process writes its metric values into its own memory-mapped file in
+the directory named by the ``METRICS_DIR`` environment variable, and
+whoever serves ``/metrics`` reads and combines all of the files. Since
+each file has exactly one writer process, updating a value is a read and
+write of eight bytes in shared memory, under a lock that only the threads
+of that process share: no system calls, and no coordination between
+gunicorn workers. If ``METRICS_DIR`` is not set,
+values are kept in a dictionary and only describe the current process.
+
+Counters go in ``counter_<pid>.db`` and outlive the process that wrote
+them, so totals don't go backwards when gunicorn replaces a worker.
+Gauges that describe the live state of a process go in ``live_<pid>.db``,
+which is removed by :func:`mark_process_dead` when the worker exits.
+"""
+from __future__ import unicode_literals
+
+import glob
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+import six
+
+INITIAL_MMAP_SIZE = 1024 * 64
+HEADER = struct.Struct(str("i"))
+KEY_LENGTH = struct.Struct(str("i"))
+VALUE = struct.Struct(str("d"))
+
+
+def _padded(length):
+    # keep every value 8-byte aligned
+    return length + (8 - (KEY_LENGTH.size + length) % 8) % 8
+
+
+class MmapStore(object):
+    """
+    A dict of string keys to float values, backed by a memory-mapped file.
+    The file starts with the number of bytes in use, followed by entries
+    of the form ``<key length> <key, padded> <value>``. The file is
+    remapped when it grows, so every access holds ``lock``.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.positions = {}
+        self.lock = threading.Lock()
+        exists = os.path.exists(filename)
+        self.f = open(filename, "a+b")
+        if not exists or os.path.getsize(filename) == 0:
+            self.f.truncate(INITIAL_MMAP_SIZE)
+            self.capacity = INITIAL_MMAP_SIZE
+        else:
+            self.capacity = os.path.getsize(filename)
+        self.m = mmap.mmap(self.f.fileno(), self.capacity)
+        self.used = HEADER.unpack_from(self.m, 0)[0]
+        if self.used == 0:
+            self.used = 8
+            HEADER.pack_into(self.m, 0, self.used)
+        for key, value, pos in self._read_entries(self.m, self.used):
+            self.positions[key] = pos
+
+    @staticmethod
+    def _read_entries(data, used):
+        pos = 8
+        while pos < used:
+            length = KEY_LENGTH.unpack_from(data, pos)[0]
+            pos += KEY_LENGTH.size
+            key = data[pos:pos + length].decode("utf-8")
+            pos += _padded(length)
+            value = VALUE.unpack_from(data, pos)[0]
+            yield key, value, pos
+            pos += VALUE.size
+
+    @classmethod
+    def read_file(cls, filename):
+        """
+        Read all of the values in a store file, without mapping it.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            return
+        used = HEADER.unpack_from(data, 0)[0]
+        for key, value, pos in cls._read_entries(data, used):
+            yield key, value
+
+    def _init_value(self, key):
+        # called with the lock held
+        if key in self.positions:
+            return self.positions[key]
+        encoded = key.encode("utf-8")
+        padded = _padded(len(encoded))
+        needed = KEY_LENGTH.size + padded + VALUE.size
+        while self.used + needed > self.capacity:
+            self.capacity *= 2
+            self.m.close()
+            self.f.truncate(self.capacity)
+            self.m = mmap.mmap(self.f.fileno(), self.capacity)
+        pos = self.used
+        KEY_LENGTH.pack_into(self.m, pos, len(encoded))
+        self.m[pos + KEY_LENGTH.size:pos + KEY_LENGTH.size + len(encoded)] = encoded
+        value_pos = pos + KEY_LENGTH.size + padded
+        VALUE.pack_into(self.m, value_pos, 0.0)
+        # publish the entry only once it's completely written
+        self.used += needed
+        HEADER.pack_into(self.m, 0, self.used)
+        self.positions[key] = value_pos
+        return value_pos
+
+    def inc(self, key, amount):
+        with self.lock:
+            pos = self._init_value(key)
+            VALUE.pack_into(self.m, pos, VALUE.unpack_from(self.m, pos)[0] + amount)
+
+    def set(self, key, value):
+        with self.lock:
+            pos = self._init_value(key)
+            VALUE.pack_into(self.m, pos, value)
+
+    def get(self, key):
+        with self.lock:
+            pos = self.positions.get(key)
+            if pos is None:
+                return 0.0
+            return VALUE.unpack_from(self.m, pos)[0]
+
+    def items(self):
+        return [(key, self.get(key)) for key in list(self.positions)]
+
+    def close(self):
+        self.m.close()
+        self.f.close()
+
+
+class DictStore(object):
+    """
+    Same interface as :class:`MmapStore`, for a single process.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key, 0.0)
+
+    def items(self):
+        return list(self.values.items())
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def metrics_dir():
+    return os.environ.get("METRICS_DIR")
+
+
+def get_store(kind):
+    """
+    Return this process's store for ``counter`` or ``live`` values. Stores
+    are looked up by process ID, so that a worker forked from a process
+    that already had a store gets a file of its own.
+    """
+    pid = os.getpid()
+    store = _stores.get((kind, pid))
+    if store is not None:
+        return store
+    with _stores_lock:
+        if (kind, pid) not in _stores:
+            directory = metrics_dir()
+            if directory:
+                filename = os.path.join(
+                    directory, "{kind}_{pid}.db".format(kind=kind, pid=pid))
+                _stores[(kind, pid)] = MmapStore(filename)
+            else:
+                _stores[(kind, pid)] = DictStore()
+        return _stores[(kind, pid)]
+
+
+def mark_process_dead(pid, directory=None):
+    """
+    Forget the live gauges of a process that has exited. Counters are kept.
+    """
+    directory = directory or metrics_dir()
+    if not directory:
+        return
+    filename = os.path.join(directory, "live_{pid}.db".format(pid=pid))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def clear_metrics_dir(directory=None):
+    """
+    Remove all store files. Call this when starting the gunicorn master,
+    before any workers are forked.
+    """
+    directory = directory or metrics_dir()
+    if not directory:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for filename in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(filename)
+
+
+## metric definitions ##
+
+registry = OrderedDict()
+
+
+def sample_key(name, labels=None):
+    """
+    The key for a value in a store is the metric name and labels, exactly
+    as they appear in the Prometheus text format.
+    """
+    if not labels:
+        return name
+    label_str = ",".join(
+        '{}="{}"'.format(k, six.text_type(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+    return "{name}{{{labels}}}".format(name=name, labels=label_str)
+
+
+def key_name(key):
+    return key.split("{", 1)[0]
+
+
+class Metric(object):
+    type = None
+    kind = "counter"
+    aggregate = "sum"
+    suffixes = ("",)
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        registry[name] = self
+
+    def _store(self):
+        return get_store(self.kind)
+
+    def value(self, **labels):
+        return self._store().get(sample_key(self.name, labels))
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._store().inc(sample_key(self.name, labels), amount)
+
+
+class Gauge(Metric):
+    """
+    A gauge that describes the live state of a process. Values from
+    different processes are added together.
+    """
+    type = "gauge"
+    kind = "live"
+
+    def set(self, value, **labels):
+        self._store().set(sample_key(self.name, labels), value)
+
+
+class MaxGauge(Gauge):
+    """
+    A gauge that only ever goes up, such as a high-water mark. Values from
+    different processes are combined by taking the largest one.
+    """
+    kind = "counter"
+    aggregate = "max"
+
+    def set(self, value, **labels):
+        key = sample_key(self.name, labels)
+        store = self._store()
+        if value > store.get(key):
+            store.set(key, value)
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    float("inf"),
+)
+
+
+class Histogram(Metric):
+    """
+    Buckets are stored individually, rather than cumulatively, so that an
+    observation only has to update three values: its bucket, the sum and
+    the count. They are made cumulative when the metrics are rendered.
+    """
+    type = "histogram"
+    suffixes = ("_bucket", "_sum", "_count")
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        store = self._store()
+        for bound in self.buckets:
+            if value <= bound:
+                break
+        bucket_labels = dict(labels, le=format_value(bound))
+        store.inc(sample_key(self.name + "_bucket", bucket_labels), 1)
+        store.inc(sample_key(self.name + "_sum", labels), value)
+        store.inc(sample_key(self.name + "_count", labels), 1)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return "{:d}".format(int(value))
+    return "{!r}".format(value)
+
+
+## collecting ##
+
+def collect():
+    """
+    Combine the values from every process, and return them as a dict of
+    sample keys to values.
+    """
+    directory = metrics_dir()
+    if directory:
+        sources = [
+            MmapStore.read_file(f)
+            for f in sorted(glob.glob(os.path.join(directory, "*.db")))
+        ]
+    else:
+        sources = [store.items() for (kind, pid), store in _stores.items()
+                   if pid == os.getpid()]
+
+    metric_for_name = {}
+    for metric in registry.values():
+        for suffix in metric.suffixes:
+            metric_for_name[metric.name + suffix] = metric
+
+    values = {}
+    for source in sources:
+        for key, value in source:
+            metric = metric_for_name.get(key_name(key))
+            if metric and metric.aggregate == "max":
+                values[key] = max(values.get(key, value), value)
+            else:
+                values[key] = values.get(key, 0.0) + value
+    return values
+
+
+def _cumulative_buckets(metric, values):
+    """
+    Turn the individually-stored buckets of a histogram back into the
+    cumulative ``le`` buckets that Prometheus expects.
+    """
+    prefix = metric.name + "_bucket{"
+    by_series = {}
+    for key, value in values.items():
+        if not key.startswith(prefix):
+            continue
+        labels = key[len(prefix):-1].split(",")
+        le = [l for l in labels if l.startswith('le="')][0]
+        rest = ",".join(l for l in labels if not l.startswith('le="'))
+        by_series.setdefault(rest, {})[le[4:-1]] = value
+    lines = []
+    for rest in sorted(by_series):
+        buckets = by_series[rest]
+        total = 0.0
+        for bound in metric.buckets:
+            le = format_value(bound)
+            total += buckets.get(le, 0.0)
+            label_str = ",".join(filter(None, [rest, 'le="{}"'.format(le)]))
+            lines.append("{name}_bucket{{{labels}}} {value}".format(
+                name=metric.name, labels=label_str, value=format_value(total)))
+    return lines
+
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    values = collect()
+    lines = []
+    for metric in registry.values():
+        lines.append("# HELP {name} {help}".format(name=metric.name, help=metric.help))
+        lines.append("# TYPE {name} {type}".format(name=metric.name, type=metric.type))
+        if isinstance(metric, Histogram):
+            lines.extend(_cumulative_buckets(metric, values))
+        for suffix in metric.suffixes:
+            if suffix == "_bucket":
+                continue
+            name = metric.name + suffix
+            for key in sorted(k for k in values if key_name(k) == name):
+                lines.append("{key} {value}".format(
+                    key=key, value=format_value(values[key])))
+    return "\n".join(lines) + "\n"
@@ -3,11 +3,17 @@ from __future__ import unicode_literals
 
 from datetime import datetime
 from decimal import Decimal
-from functools import wraps
+from functools import wraps, partial
 import six
 import iso8601
 from flask.ext.restful import Api as BaseApi
 from flask.ext.restful import fields
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from flask.ext.sqlalchemy import _SignallingSession, _EngineConnector, get_state
+from sqlalchemy.orm import scoped_session
+from .pool import (
+    InstrumentedQueuePool, ping_connection, local_statement_timeout
+)
 
 ## Api subclass that does CORS ##
 
@@ -38,6 +44,92 @@ class Api(BaseApi):
     def handle_error(self, e):
         return super(Api, self).handle_error(e)
 
+## SQLAlchemy subclass that configures the connection pool and shards ##
+
+class ShardedSession(_SignallingSession):
+    """
+    A session that sends its queries to the shard named by ``shard``, if
+    it's set to one of the ``SQLALCHEMY_SHARDS``, rather than to the default
+    database. See :mod:`seamless_karma.shards`.
+    """
+    shard = None
+
+    def get_bind(self, mapper=None, clause=None):
+        info = getattr(getattr(mapper, 'mapped_table', None), 'info', {})
+        if (info.get('bind_key') is None and
+                self.shard in (self.app.config['SQLALCHEMY_SHARDS'] or {})):
+            return get_state(self.app).db.get_engine(self.app, bind=self.shard)
+        return super(ShardedSession, self).get_bind(mapper, clause)
+
+
+class ShardConnector(_EngineConnector):
+    def get_uri(self):
+        shards = self._app.config['SQLALCHEMY_SHARDS'] or {}
+        if self._bind in shards:
+            return shards[self._bind]
+        return super(ShardConnector, self).get_uri()
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Adds a few configuration variables on top of the ones that
+    Flask-SQLAlchemy already understands (``SQLALCHEMY_POOL_SIZE``,
+    ``SQLALCHEMY_MAX_OVERFLOW``, ``SQLALCHEMY_POOL_TIMEOUT`` and
+    ``SQLALCHEMY_POOL_RECYCLE``):
+
+    ``SQLALCHEMY_POOL_PRE_PING``
+        Check that each connection is alive before it's checked out of the
+        pool, replacing it if it isn't.
+    ``SQLALCHEMY_STATEMENT_TIMEOUT``
+        Cancel any statement that runs for longer than this many
+        milliseconds. PostgreSQL only.
+    ``SQLALCHEMY_PGBOUNCER``
+        Connect through PgBouncer in transaction pooling mode: don't send
+        startup options, and don't leave any session-level state on the
+        server connection.
+    ``SQLALCHEMY_SHARDS``
+        A dict of shard name to database URI, for organizations that don't
+        live in the default database. ``db.get_engine(app, bind=name)``
+        returns a shard's engine, set up like the default one.
+
+    PostgreSQL connections are pooled with :class:`InstrumentedQueuePool`,
+    so that checkout waits and pool exhaustion show up in ``/metrics``.
+    """
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('SQLALCHEMY_STATEMENT_TIMEOUT', None)
+        app.config.setdefault('SQLALCHEMY_PGBOUNCER', False)
+        app.config.setdefault('SQLALCHEMY_SHARDS', {})
+        super(SQLAlchemy, self).init_app(app)
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return scoped_session(
+            partial(ShardedSession, self, **options), scopefunc=scopefunc
+        )
+
+    def make_connector(self, app, bind=None):
+        return ShardConnector(self, app, bind)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        events = options.setdefault('pool_events', [])
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            events.append((ping_connection, 'checkout'))
+        if not info.drivername.startswith('postgres'):
+            return
+        options.setdefault('poolclass', InstrumentedQueuePool)
+        timeout = app.config['SQLALCHEMY_STATEMENT_TIMEOUT']
+        if app.config['SQLALCHEMY_PGBOUNCER']:
+            options['server_side_cursors'] = False
+            if timeout:
+                events.append((local_statement_timeout(timeout), 'checkout'))
+        elif timeout:
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = '-c statement_timeout={:d}'.format(timeout)
+
 ## marshal fields ##
 
 TWOPLACES = Decimal(10) ** -2
@@ -80,6 +172,13 @@ def date_type(value, name):
 def datetime_type(value, name):
     try:
         return iso8601.parse_date(value)
-    except:
-        raise ValueError(u"{} string must be an ISO-8601 formatted datetime")
+    except iso8601.ParseError:
+        raise ValueError(u"{} string must be an ISO-8601 formatted datetime".format(name))
+
+
+def int_type(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(u"{} must be an integer".format(name))
 
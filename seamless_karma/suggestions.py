@@ -0,0 +1,60 @@
+# coding=utf-8
+"""
+Suggesting who should contribute to an order that hasn't been placed yet.
+"""
+from __future__ import unicode_literals
+
+from seamless_karma.extensions import db
+from seamless_karma.flows import to_cents
+from seamless_karma.models import User
+from seamless_karma.settlement import organization_balances
+
+
+def candidates(org_id, for_date, orderer_id, nonparticipants=False):
+    """
+    Return ``(user_id, unallocated_cents, karma_cents)`` for every user in
+    the organization with unallocated money on the given date who could
+    contribute: those who have already participated in an order that day,
+    or everyone if ``nonparticipants`` is set. The orderer is always
+    included. Karma comes from :func:`organization_balances`, rather than
+    a karma subquery for every user.
+    """
+    unallocated = User.unallocated(for_date)
+    query = (db.session.query(User.id, unallocated)
+        .filter(User.organization_id == org_id)
+        .filter(unallocated > 0)
+    )
+    if not nonparticipants:
+        query = query.filter(
+            User.participated_on(for_date) | (User.id == orderer_id))
+    karma = organization_balances(org_id)
+    return [(user_id, to_cents(amount), karma.get(user_id, 0))
+            for user_id, amount in query]
+
+
+def suggest(amount, orderer_id, candidates):
+    """
+    Choose contributions, in cents, that add up to ``amount`` cents without
+    taking more than anyone's unallocated money. ``candidates`` are
+    ``(user_id, unallocated_cents, karma_cents)`` tuples.
+
+    The orderer pays as much as they can first. The rest is taken greedily
+    from the other users in order of lowest Karma, so that those who have
+    received the most pay back first; users with more unallocated money go
+    first among equals, to keep the number of contributors down. Returns a
+    list of ``(user_id, cents)`` and the amount that couldn't be covered.
+    """
+    def priority(candidate):
+        user_id, unallocated, karma = candidate
+        return (user_id != orderer_id, karma, -unallocated, user_id)
+
+    contributions = []
+    remaining = amount
+    for user_id, unallocated, karma in sorted(candidates, key=priority):
+        if remaining <= 0:
+            break
+        cents = min(unallocated, remaining)
+        if cents > 0:
+            contributions.append((user_id, cents))
+            remaining -= cents
+    return contributions, remaining
@@ -5,7 +5,9 @@ import json
 import pytest
 from decimal import Decimal
 from seamless_karma.extensions import db
+from seamless_karma.signals import allocations_changed
 from factories import UserFactory, OrderFactory, OrganizationFactory
+from datetime import date, timedelta
 
 
 @pytest.fixture
@@ -80,3 +82,191 @@ def test_one_order(client, users):
     obj = json.loads(response.get_data(as_text=True))
     assert len(obj['data']) == len(users)
     assert obj['total_unallocated'] == "10.50"
+
+
+def test_bulk_change(client, org, users):
+    other = UserFactory.create(allocation=Decimal("10.00"))
+    db.session.commit()
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append(kwargs)
+
+    with allocations_changed.connected_to(receiver):
+        response = client.post("/api/organizations/{}/allocations".format(org.id),
+            data={"allocation": "12.00", "default": "true"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj == {"message": "updated", "count": 2}
+    assert [u.allocation for u in users] == [Decimal("12.00"), Decimal("12.00")]
+    assert org.default_allocation == Decimal("12.00")
+    assert other.allocation == Decimal("10.00")
+    assert received == [{
+        "organization_id": org.id,
+        "user_ids": sorted(u.id for u in users),
+        "effective": date.today(),
+    }]
+
+    # earlier dates keep the old allocations
+    yesterday = date.today() - timedelta(days=1)
+    url = "/api/organizations/{org_id}/orders/{date}/unallocated?nonparticipants=1"
+    response = client.get(url.format(org_id=org.id, date=yesterday))
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["total_unallocated"] == "21.50"
+    response = client.get(url.format(org_id=org.id, date=date.today()))
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["total_unallocated"] == "24.00"
+
+
+def test_bulk_change_subset(client, org, users):
+    url = "/api/organizations/{}/allocations".format(org.id)
+    response = client.post(url, data={
+        "allocation": "9.00", "current_allocation": "11.50"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["count"] == 1
+    assert [u.allocation for u in users] == [Decimal("10.00"), Decimal("9.00")]
+
+    response = client.post(url, data={
+        "allocation": "8.00", "user_id": [str(users[0].id)]})
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["count"] == 1
+    assert [u.allocation for u in users] == [Decimal("8.00"), Decimal("9.00")]
+
+
+def test_bulk_change_missing_org(client):
+    response = client.post("/api/organizations/999/allocations",
+        data={"allocation": "9.00"})
+    assert response.status_code == 404
+
+
+def test_suggest(client, org, users):
+    u1, u2 = users
+    u3 = UserFactory.create(organization=org, allocation=Decimal("10.00"))
+    u4 = UserFactory.create(organization=org, allocation=Decimal("10.00"))
+    today = date.today()
+    last_week = today - timedelta(days=7)
+    # u2 owes u3 some karma; u4 hasn't ordered today
+    OrderFactory.create(for_date=last_week, ordered_by=u2, contributions=(
+        (u3, Decimal("4.00")),
+    ))
+    OrderFactory.create(for_date=today, ordered_by=u1, contributions=(
+        (u1, Decimal("7.00")),
+    ))
+    OrderFactory.create(for_date=today, ordered_by=u2, contributions=(
+        (u2, Decimal("5.00")),
+    ))
+    OrderFactory.create(for_date=today, ordered_by=u3, contributions=(
+        (u3, Decimal("2.00")),
+    ))
+    db.session.commit()
+    url = "/api/organizations/{org_id}/orders/{date}/suggest".format(
+        org_id=org.id, date=today)
+
+    response = client.get(url, query_string={"amount": "12.00", "orderer": u1.id})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    # orderer first, then lowest karma
+    assert obj == {"amount": "12.00", "shortfall": "0.00", "data": [
+        {"id": u1.id, "amount": "3.00"},
+        {"id": u2.id, "amount": "6.50"},
+        {"id": u3.id, "amount": "2.50"},
+    ]}
+
+    response = client.get(url, query_string={"amount": "30.00", "orderer": u1.id})
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["shortfall"] == "12.50"
+
+    response = client.get(url, query_string={
+        "amount": "30.00", "orderer": u1.id, "nonparticipants": "true"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["shortfall"] == "2.50"
+    assert obj["data"][2] == {"id": u4.id, "amount": "10.00"}
+
+
+def test_suggest_orderer_in_other_org(client, org, users):
+    other = UserFactory.create()
+    db.session.commit()
+    url = "/api/organizations/{}/orders/2014-01-01/suggest".format(org.id)
+    response = client.get(url, query_string={"amount": "12.00", "orderer": other.id})
+    assert response.status_code == 400
+
+
+def read_event(events):
+    lines = next(events).decode("utf-8").strip().split("\n")
+    if lines[0].startswith(":"):
+        return None, None
+    event, data = lines
+    return event[len("event: "):], json.loads(data[len("data: "):])
+
+
+def test_unallocated_stream(app, client, org, users):
+    app.config["LIVE_HEARTBEAT"] = 0.01
+    u1, u2 = users
+    url = "/api/organizations/{org_id}/orders/2014-01-01/unallocated/stream".format(
+        org_id=org.id)
+    response = client.get(url, query_string={"nonparticipants": "true"}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = response.iter_encoded()
+    event, data = read_event(events)
+    assert event == "snapshot"
+    assert data["total_unallocated"] == "21.50"
+    assert read_event(events) == (None, None)
+
+    OrderFactory.create(for_date=date(2014, 1, 1), ordered_by=u1,
+        contributions=[(u1, Decimal("4.00")), (u2, Decimal("1.50"))])
+    # a different day isn't watched
+    OrderFactory.create(for_date=date(2014, 1, 2), ordered_by=u2,
+        contributions=[(u2, Decimal("1.00"))])
+    db.session.commit()
+    assert read_event(events) == ("unallocated", [
+        {"id": u1.id, "unallocated": "6.00"},
+        {"id": u2.id, "unallocated": "10.00"},
+    ])
+    assert read_event(events) == ("karma", [
+        {"id": u1.id, "karma": "-1.50"},
+        {"id": u2.id, "karma": "1.50"},
+    ])
+    assert read_event(events) == (None, None)
+    response.close()
+    assert app.extensions["live"].topics() == set()
+
+
+def test_unallocated_stream_allocations(app, client, org, users):
+    app.config["LIVE_HEARTBEAT"] = 0.01
+    u1, u2 = users
+    today = date.today()
+    url = "/api/organizations/{org_id}/orders/{date}/unallocated/stream"
+    response = client.get(url.format(org_id=org.id, date=today),
+        query_string={"nonparticipants": "true"}, buffered=False)
+    events = response.iter_encoded()
+    assert read_event(events)[0] == "snapshot"
+    # a stream for an earlier day doesn't hear about it
+    earlier = client.get(url.format(org_id=org.id, date=today - timedelta(days=1)),
+        buffered=False)
+    earlier_events = earlier.iter_encoded()
+    assert read_event(earlier_events)[0] == "snapshot"
+
+    changed = client.post("/api/organizations/{}/allocations".format(org.id),
+        data={"allocation": "12.00", "user_id": [str(u1.id)]})
+    assert changed.status_code == 200
+    assert read_event(events) == ("unallocated", [{"id": u1.id, "unallocated": "12.00"}])
+    assert read_event(earlier_events) == (None, None)
+    response.close()
+    earlier.close()
+
+
+def test_unallocated_stream_limit(app, client, org):
+    app.config["LIVE_MAX_STREAMS"] = 1
+    url = "/api/organizations/{org_id}/orders/2014-01-01/unallocated/stream".format(
+        org_id=org.id)
+    first = client.get(url, buffered=False)
+    assert first.status_code == 200
+    response = client.get(url, buffered=False)
+    assert response.status_code == 503
+    assert "too many" in json.loads(response.get_data(as_text=True))["message"]
+    first.close()
+    response = client.get(url, buffered=False)
+    assert response.status_code == 200
+    response.close()
+    assert app.extensions["live"].count == 0
@@ -0,0 +1,56 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+from factories import OrganizationFactory, UserFactory, VendorFactory
+from seamless_karma.models import Change
+from seamless_karma.extensions import db
+
+
+def get_changes(test_client, **query):
+    response = test_client.get('/api/changes', query_string=query)
+    return response.status_code, json.loads(response.get_data(as_text=True))
+
+
+def test_sync(client):
+    org, other_org = OrganizationFactory.create(), OrganizationFactory.create()
+    db.session.commit()
+    status, obj = get_changes(client, org=org.id, client="phone")
+    assert status == 200
+    assert obj["data"] == []
+    cursor = obj["cursor"]
+
+    user = UserFactory.create(organization=org)
+    UserFactory.create(organization=other_org)
+    vendor = VendorFactory.create()
+    db.session.commit()
+    status, obj = get_changes(client, since=cursor, org=org.id, limit=1)
+    assert obj["more"]
+    assert obj["data"] == [{"seq": obj["cursor"], "type": "user", "id": user.id,
+                            "action": "created"}]
+    status, obj = get_changes(client, since=obj["cursor"], org=org.id)
+    assert not obj["more"]
+    assert [(c["type"], c["id"]) for c in obj["data"]] == [("vendor", vendor.id)]
+    status, obj = get_changes(client, since=obj["cursor"], org=org.id)
+    assert obj["data"] == []
+
+
+def test_compacted_cursor(client):
+    users = [UserFactory.create() for _ in range(3)]
+    db.session.commit()
+    latest = Change.latest()
+    get_changes(client, since=latest - 1, client="phone")
+    Change.compact()
+    db.session.commit()
+    status, obj = get_changes(client, since=latest - 1)
+    assert status == 200
+    assert len(obj["data"]) == 1
+    status, obj = get_changes(client, since=latest - 3)
+    assert status == 410
+    status, obj = get_changes(client, since=latest + 5)
+    assert status == 410
+
+
+def test_unknown_org(client):
+    status, obj = get_changes(client, org=42)
+    assert status == 404
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import sqlalchemy as sa
+from decimal import Decimal
+from datetime import date
+from seamless_karma.extensions import db
+from factories import UserFactory, OrderFactory, OrganizationFactory, VendorFactory
+
+
+def make_org():
+    org = OrganizationFactory.create(default_allocation=Decimal("10.00"))
+    u1 = UserFactory.create(organization=org, first_name="Ann", last_name="Zed")
+    u2 = UserFactory.create(organization=org, first_name="Bob", last_name="Young")
+    deli = VendorFactory.create()
+    OrderFactory.create(for_date=date(2014, 3, 3), ordered_by=u1, vendor=deli,
+        contributions=((u1, Decimal("6.00")), (u2, Decimal("2.50"))))
+    OrderFactory.create(for_date=date(2014, 2, 1), ordered_by=u2, vendor=deli,
+        contributions=((u2, Decimal("4.00")),))
+    # too long ago for the vendor stats
+    OrderFactory.create(for_date=date(2014, 1, 1), ordered_by=u2,
+        contributions=((u2, Decimal("7.00")),))
+    db.session.commit()
+    return org, u1, u2, deli
+
+
+def get_json(client, url, **params):
+    response = client.get(url, query_string=params)
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def test_dashboard(client):
+    org, u1, u2, deli = make_org()
+    obj = get_json(client, "/api/organizations/{}/dashboard".format(org.id),
+        date="2014-03-03", top=1)
+    assert obj["organization"]["name"] == org.name
+    assert obj["date"] == "2014-03-03"
+    assert [user["id"] for user in obj["users"]] == [u2.id, u1.id]
+    assert obj["users"][0]["allocation"] == "10.00"
+    assert [order["total"] for order in obj["orders"]] == ["8.50"]
+    assert obj["orders"][0]["contributions"] == [
+        {"user_id": u1.id, "amount": "6.00"},
+        {"user_id": u2.id, "amount": "2.50"},
+    ]
+    assert obj["unallocated"]["total_unallocated"] == "11.50"
+    assert obj["leaderboard"]["count"] == 2
+    assert [row["id"] for row in obj["leaderboard"]["data"]] == [u2.id]
+    assert obj["vendors"] == {
+        "from": "2014-02-02",
+        "to": "2014-03-03",
+        "order_count": 1,
+        "total": "8.50",
+        "top_vendors": [{"id": deli.id, "name": deli.name, "order_count": 1, "total": "8.50"}],
+    }
+
+
+def test_dashboard_concurrent(file_app):
+    # the same as the separate endpoints, when looked up on several threads
+    client = file_app.test_client()
+    org, u1, u2, deli = make_org()
+    prefix = "/api/organizations/{}".format(org.id)
+    obj = get_json(client, prefix + "/dashboard", date="2014-03-03", days=60)
+    assert obj["unallocated"] == get_json(client, prefix + "/orders/2014-03-03/unallocated")
+    assert obj["leaderboard"] == get_json(client, prefix + "/leaderboard")
+    assert obj["orders"] == get_json(client, prefix + "/orders/2014-03-03")["data"]
+    assert obj["vendors"]["top_vendors"] == get_json(client, prefix + "/stats",
+        **{"from": "2014-01-03", "to": "2014-03-03"})["top_vendors"]
+
+
+def test_dashboard_errors(client):
+    org = OrganizationFactory.create()
+    db.session.commit()
+    url = "/api/organizations/{}/dashboard".format(org.id)
+    assert client.get(url, query_string={"days": 0}).status_code == 400
+    assert client.get(url, query_string={"days": 367}).status_code == 400
+    assert client.get("/api/organizations/{}/dashboard".format(org.id + 1)).status_code == 404
+
+
+def test_dashboard_releases_connection(file_app, monkeypatch):
+    from seamless_karma.restful import dashboard
+    client = file_app.test_client()
+    org, u1, u2, deli = make_org()
+    checked_out = []
+    outstanding = []
+    def checkout(dbapi_connection, record, proxy):
+        checked_out.append(record)
+    def checkin(dbapi_connection, record):
+        checked_out.remove(record)
+    def fanout(**queries):
+        outstanding.append(len(checked_out))
+        return real_fanout(**queries)
+    real_fanout = dashboard.fanout
+    monkeypatch.setattr(dashboard, "fanout", fanout)
+    sa.event.listen(db.engine, "checkout", checkout)
+    sa.event.listen(db.engine, "checkin", checkin)
+    try:
+        get_json(client, "/api/organizations/{}/dashboard".format(org.id),
+            date="2014-03-03")
+    finally:
+        sa.event.remove(db.engine, "checkout", checkout)
+        sa.event.remove(db.engine, "checkin", checkin)
+    assert outstanding == [0]
+
+
+def test_dashboard_pool_timeout(client, monkeypatch):
+    from seamless_karma.restful import dashboard
+    org = OrganizationFactory.create()
+    db.session.commit()
+    def fanout(**queries):
+        raise sa.exc.TimeoutError("QueuePool limit reached")
+    monkeypatch.setattr(dashboard, "fanout", fanout)
+    response = client.get("/api/organizations/{}/dashboard".format(org.id))
+    assert response.status_code == 503
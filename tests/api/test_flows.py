@@ -0,0 +1,104 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import pytest
+from decimal import Decimal
+from datetime import date, timedelta
+from seamless_karma.extensions import db
+from seamless_karma import flows
+from factories import UserFactory, OrderFactory, OrganizationFactory
+
+
+@pytest.fixture
+def users(app):
+    org = OrganizationFactory.create()
+    users = [UserFactory.create(organization=org) for i in range(3)]
+    db.session.commit()
+    return users
+
+
+def get_flows(client, org_id, **params):
+    url = "/api/organizations/{}/flows".format(org_id)
+    response = client.get(url, query_string=params)
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def test_empty(client, users):
+    obj = get_flows(client, users[0].organization_id)
+    assert obj["users"] == []
+    assert obj["indptr"] == [0]
+
+
+def test_flows(client, users):
+    u1, u2, u3 = users
+    last_week = date.today() - timedelta(days=7)
+    OrderFactory.create(for_date=last_week, ordered_by=u1, contributions=(
+        (u1, Decimal("5.00")), (u2, Decimal("3.50")), (u3, Decimal("1.25")),
+    ))
+    OrderFactory.create(for_date=date.today(), ordered_by=u2, contributions=(
+        (u2, Decimal("5.00")), (u3, Decimal("2.00")),
+    ))
+    OrderFactory.create(for_date=date.today(), ordered_by=u1, contributions=(
+        (u3, Decimal("4.00")),
+    ))
+    # orders in another organization don't count
+    OrderFactory.create(contributions=((u1, Decimal("9.00")),))
+    db.session.commit()
+
+    obj = get_flows(client, u1.organization_id)
+    matrix = flows.FlowMatrix(*[obj[key] for key in
+        ("users", "indptr", "indices", "amounts", "counts")])
+    assert sorted(matrix.triples()) == sorted([
+        (u2.id, u1.id, 350, 1),
+        (u3.id, u1.id, 525, 2),
+        (u3.id, u2.id, 200, 1),
+    ])
+    assert matrix.get(u3.id, u1.id) == 525
+    assert matrix.get(u1.id, u3.id) == 0
+
+    obj = get_flows(client, u1.organization_id, to=last_week.isoformat())
+    assert obj["to"] == last_week.isoformat()
+    matrix = flows.FlowMatrix(*[obj[key] for key in
+        ("users", "indptr", "indices", "amounts", "counts")])
+    assert len(matrix) == 2
+    assert matrix.get(u3.id, u1.id) == 125
+
+
+def test_cache(app, client, users):
+    u1, u2, u3 = users
+    last_week = date.today() - timedelta(days=7)
+    order = OrderFactory.create(for_date=last_week, ordered_by=u1, contributions=(
+        (u2, Decimal("3.50")),
+    ))
+    db.session.commit()
+    app.config["FLOWS_CACHE_TTL"] = 60
+    flows.cache.clear()
+    try:
+        params = {"from": last_week.isoformat(), "to": last_week.isoformat()}
+        obj = get_flows(client, u1.organization_id, **params)
+        assert obj["amounts"] == [350]
+        assert len(flows.cache.entries) == 1
+        # changing an order in the range drops the cached matrix
+        order.contributions[0].amount = Decimal("4.00")
+        db.session.commit()
+        assert len(flows.cache.entries) == 0
+        obj = get_flows(client, u1.organization_id, **params)
+        assert obj["amounts"] == [400]
+        # and so does changing only who placed it
+        order.ordered_by = u3
+        db.session.commit()
+        assert len(flows.cache.entries) == 0
+        obj = get_flows(client, u1.organization_id, **params)
+        matrix = flows.FlowMatrix(*[obj[key] for key in
+            ("users", "indptr", "indices", "amounts", "counts")])
+        assert matrix.get(u2.id, u3.id) == 400
+        assert matrix.get(u2.id, u1.id) == 0
+    finally:
+        flows.cache.clear()
+
+
+def test_missing_org(client):
+    response = client.get("/api/organizations/999/flows")
+    assert response.status_code == 404
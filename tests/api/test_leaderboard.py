@@ -0,0 +1,99 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import pytest
+import sqlalchemy as sa
+from decimal import Decimal
+from seamless_karma.extensions import db
+from seamless_karma.leaderboard import leaderboards
+from factories import UserFactory, OrderFactory, OrganizationFactory
+
+
+@pytest.yield_fixture
+def cached(app):
+    app.config["LEADERBOARD_TTL"] = 300
+    leaderboards.clear()
+    yield
+    leaderboards.clear()
+
+
+@pytest.fixture
+def users(app):
+    org = OrganizationFactory.create()
+    users = [UserFactory.create(organization=org) for i in range(3)]
+    db.session.commit()
+    return users
+
+
+def get_leaderboard(client, org_id, **params):
+    url = "/api/organizations/{}/leaderboard".format(org_id)
+    response = client.get(url, query_string=params)
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def ranking(obj):
+    return [(row["id"], row["karma"]) for row in obj["data"]]
+
+
+def test_leaderboard(client, cached, users):
+    u1, u2, u3 = users
+    org_id = u1.organization_id
+    obj = get_leaderboard(client, org_id)
+    assert obj["count"] == 3
+    assert ranking(obj) == [(u1.id, "0.00"), (u2.id, "0.00"), (u3.id, "0.00")]
+
+    # updated incrementally after an order is written
+    order = OrderFactory.create(ordered_by=u1, contributions=(
+        (u3, Decimal("3.50")),
+    ))
+    db.session.commit()
+    assert set(leaderboards.stale) == set([u1.id, u3.id])
+    obj = get_leaderboard(client, org_id, top=2, user=u1.id)
+    assert ranking(obj) == [(u3.id, "3.50"), (u2.id, "0.00")]
+    assert obj["data"][0]["first_name"] == u3.first_name
+    assert obj["user"] == {"rank": 3, "id": u1.id, "karma": "-3.50"}
+
+    # a new orderer, a new user, and a user who leaves
+    order.ordered_by = u2
+    u4 = UserFactory.create(organization=u1.organization)
+    db.session.delete(u1)
+    db.session.commit()
+    obj = get_leaderboard(client, org_id)
+    assert ranking(obj) == [(u3.id, "3.50"), (u4.id, "0.00"), (u2.id, "-3.50")]
+
+
+def test_user_not_in_org(client, users):
+    other = UserFactory.create()
+    db.session.commit()
+    url = "/api/organizations/{}/leaderboard".format(users[0].organization_id)
+    response = client.get(url, query_string={"user": other.id})
+    assert response.status_code == 400
+
+
+def test_missing_org(client):
+    response = client.get("/api/organizations/999/leaderboard")
+    assert response.status_code == 404
+
+
+def test_queries_run_unlocked(client, cached, users):
+    u1, u2, u3 = users
+    org_id = u1.organization_id
+    locked = []
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        locked.append(leaderboards.lock.locked())
+        # a commit on another thread while the stale users are looked up
+        if "karma" in statement and u2.id in leaderboards.stale:
+            leaderboards.mark_stale([u2.id])
+    sa.event.listen(db.engine, "before_cursor_execute", before_execute)
+    try:
+        get_leaderboard(client, org_id)
+        leaderboards.mark_stale([u1.id, u2.id])
+        get_leaderboard(client, org_id)
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", before_execute)
+    assert locked and not any(locked)
+    # marked again while it was being looked up, so it's looked up again
+    assert set(leaderboards.stale) == set([u2.id])
+
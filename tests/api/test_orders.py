@@ -6,6 +6,8 @@ import pytest
 from seamless_karma.extensions import db
 from factories import UserFactory, OrderFactory, VendorFactory
 from six.moves.urllib.parse import urlparse
+from datetime import date, datetime
+from decimal import Decimal
 
 
 def test_empty(client):
@@ -66,3 +68,132 @@ def test_create(client):
     assert resp2.status_code == 200
     created = json.loads(resp2.get_data(as_text=True))
     assert created["contributions"][0]["amount"] == "8.50"
+
+
+@pytest.fixture
+def dated_orders(app):
+    alice, bob = UserFactory.create(), UserFactory.create()
+    v1, v2 = VendorFactory.create(), VendorFactory.create()
+    orders = [
+        OrderFactory.create(for_date=date(2014, 3, 31), vendor=v1, ordered_by=alice,
+            placed_at=datetime(2014, 3, 30, 12)),
+        OrderFactory.create(for_date=date(2014, 4, 1), vendor=v2, ordered_by=alice,
+            placed_at=datetime(2014, 4, 1, 11),
+            contributions=[(alice, Decimal("5.00")), (bob, Decimal("3.00"))]),
+        OrderFactory.create(for_date=date(2014, 4, 2), vendor=v1, ordered_by=bob,
+            placed_at=datetime(2014, 4, 2, 12)),
+    ]
+    db.session.commit()
+    return orders
+
+
+def order_ids(client, **query):
+    response = client.get('/api/orders', query_string=query)
+    assert response.status_code == 200
+    return [o["id"] for o in json.loads(response.get_data(as_text=True))["data"]]
+
+
+def test_filters(client, dated_orders):
+    o1, o2, o3 = [o.id for o in dated_orders]
+    assert order_ids(client, for_date="2014-04-01") == [o2]
+    assert order_ids(client, for_date__gte="2014-04-01") == [o2, o3]
+    assert order_ids(client, for_date__gt="2014-03-31", for_date__lt="2014-04-02") == [o2]
+    assert order_ids(client, vendor_id__in="{},999".format(dated_orders[1].vendor_id)) == [o2]
+    assert order_ids(client, placed_at__lt="2014-04-01T12:00:00Z") == [o1, o2]
+    assert order_ids(client, contributor=dated_orders[2].ordered_by_id) == [o2, o3]
+    assert order_ids(client, ordered_by_id=dated_orders[0].ordered_by_id,
+        for_date__lte="2014-04-01") == [o1, o2]
+
+
+def test_user_orders_filter(client, dated_orders):
+    alice = dated_orders[0].ordered_by_id
+    response = client.get('/api/users/{}/orders'.format(alice),
+        query_string={"for_date__gte": "2014-04-01"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [o["id"] for o in obj["data"]] == [dated_orders[1].id]
+
+
+@pytest.mark.parametrize("query", [
+    {"for_date__gte": "April"},
+    {"for_date__like": "2014-%"},
+    {"placed_at": "2014-04-01T11:00:00Z"},
+    {"contributor__gt": "1"},
+    {"vendor_id__in": ""},
+    {"vendor_id__in": ",".join(str(i) for i in range(500))},
+    # not indexed
+    {"seamless_id__gt": "1"},
+    {"total_amount__gte": "5"},
+])
+def test_invalid_filters(client, query):
+    response = client.get('/api/orders', query_string=query)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query,message", [
+    ({"vendor_id": "pizza"}, "vendor_id must be an integer"),
+    ({"contributor__in": "1,two"}, "contributor must be an integer"),
+    ({"placed_at__lt": "noon"}, "placed_at string must be an ISO-8601 formatted datetime"),
+    ({"for_date": "today"}, "for_date string must be a YYYY-MM-DD formatted date"),
+])
+def test_invalid_filter_values(client, query, message):
+    response = client.get('/api/orders', query_string=query)
+    assert response.status_code == 400
+    assert json.loads(response.get_data(as_text=True))["message"] == message
+
+
+def test_order_by(client, dated_orders):
+    o1, o2, o3 = [o.id for o in dated_orders]
+    assert order_ids(client, order="-for_date") == [o3, o2, o1]
+    assert order_ids(client, order="placed_at") == [o1, o2, o3]
+    assert order_ids(client, order="-id") == [o3, o2, o1]
+
+
+@pytest.mark.parametrize("order", ["total_amount", "-vendor", "for_date,karma", "query"])
+def test_order_by_unsupported(client, order):
+    response = client.get('/api/orders', query_string={"order": order})
+    assert response.status_code == 400
+    obj = json.loads(response.get_data(as_text=True))
+    assert "cannot order by" in obj["message"]
+
+
+def test_enforce_allocations(app, client):
+    user = UserFactory.create(allocation=Decimal("10.00"))
+    vendor = VendorFactory.create()
+    db.session.commit()
+    data = {"for_date": "2014-01-01", "ordered_by_id": user.id, "vendor_id": vendor.id,
+            "contributed_by": user.id, "contributed_amount": "8.00"}
+    assert client.post('/api/orders', data=data).status_code == 201
+    # not enforced by default
+    assert client.post('/api/orders', data=data).status_code == 201
+
+    app.config["ENFORCE_ALLOCATIONS"] = True
+    response = client.post('/api/orders', data=data)
+    assert response.status_code == 409
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["message"] == \
+        "user {} would be 14.00 over their allocation on 2014-01-01".format(user.id)
+    # and another day has its own allocation
+    data["for_date"] = "2014-01-02"
+    assert client.post('/api/orders', data=data).status_code == 201
+
+
+def test_contributions_change_version(client):
+    order = OrderFactory.create(for_date=date(2014, 1, 1))
+    other = UserFactory.create(organization=order.ordered_by.organization)
+    db.session.commit()
+    url = '/api/orders/{}'.format(order.id)
+    response = client.get(url)
+    assert response.headers["ETag"] == '"1"'
+    response = client.put(url, headers={"If-Match": '"1"'}, data={
+        "ordered_by_id": order.ordered_by_id,
+        "vendor_id": order.vendor_id,
+        "for_date": "2014-01-01",
+        "placed_at": order.placed_at.isoformat(),
+        "contributed_by": other.id,
+        "contributed_amount": "3.00",
+    })
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["contributions"] == [{"user_id": other.id, "amount": "3.00"}]
+    assert obj["version"] == 2
+    assert client.delete(url, headers={"If-Match": '"1"'}).status_code == 412
@@ -0,0 +1,35 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+from decimal import Decimal
+from seamless_karma.extensions import db
+from factories import UserFactory, OrderFactory, OrganizationFactory
+
+
+def test_settlement(client):
+    org = OrganizationFactory.create()
+    u1, u2, u3 = [UserFactory.create(organization=org) for i in range(3)]
+    OrderFactory.create(ordered_by=u1, contributions=(
+        (u1, Decimal("5.00")), (u2, Decimal("3.50")), (u3, Decimal("1.25")),
+    ))
+    OrderFactory.create(ordered_by=u3, contributions=(
+        (u3, Decimal("5.00")), (u2, Decimal("2.00")),
+    ))
+    db.session.commit()
+    # karma: u1 -4.75, u2 +5.50, u3 -0.75
+    response = client.get("/api/organizations/{}/settlement".format(org.id))
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj == {
+        "total": "5.50",
+        "data": [
+            {"from_user_id": u1.id, "to_user_id": u2.id, "amount": "4.75"},
+            {"from_user_id": u3.id, "to_user_id": u2.id, "amount": "0.75"},
+        ],
+    }
+
+
+def test_missing_org(client):
+    response = client.get("/api/organizations/999/settlement")
+    assert response.status_code == 404
@@ -0,0 +1,72 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+from decimal import Decimal
+from datetime import date
+from seamless_karma.extensions import db
+from seamless_karma.analytics import OrganizationStats, percentile
+from factories import UserFactory, OrderFactory, OrganizationFactory, VendorFactory
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 90) == 4
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_stats(client):
+    org = OrganizationFactory.create()
+    u1, u2 = [UserFactory.create(organization=org) for i in range(2)]
+    deli, tacos = VendorFactory.create(), VendorFactory.create()
+    OrderFactory.create(for_date=date(2014, 3, 3), ordered_by=u1, vendor=deli,
+        contributions=((u1, Decimal("10.00")), (u2, Decimal("8.50"))))
+    OrderFactory.create(for_date=date(2014, 3, 3), ordered_by=u2, vendor=tacos,
+        contributions=((u2, Decimal("6.50")),))
+    OrderFactory.create(for_date=date(2014, 3, 4), ordered_by=u2, vendor=deli,
+        contributions=((u2, Decimal("5.00")), (u1, Decimal("5.00"))))
+    # outside of the date range, and in another organization
+    OrderFactory.create(for_date=date(2014, 4, 1), ordered_by=u1)
+    OrderFactory.create(for_date=date(2014, 3, 3))
+    db.session.commit()
+
+    response = client.get("/api/organizations/{}/stats".format(org.id),
+        query_string={"from": "2014-03-01", "to": "2014-03-31"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["order_count"] == 3
+    assert obj["total"] == "35.00"
+    assert obj["external_total"] == "13.50"
+    assert obj["external_share"] == round(13.5 / 35, 4)
+    assert obj["order_size"] == {
+        "mean": "11.67", "p50": "10.00", "p90": "18.50", "p99": "18.50", "max": "18.50",
+    }
+    assert obj["daily"] == [
+        {"date": "2014-03-03", "order_count": 2, "total": "25.00"},
+        {"date": "2014-03-04", "order_count": 1, "total": "10.00"},
+    ]
+    assert obj["top_vendors"] == [
+        {"id": deli.id, "name": deli.name, "order_count": 2, "total": "28.50"},
+        {"id": tacos.id, "name": tacos.name, "order_count": 1, "total": "6.50"},
+    ]
+
+
+def test_chunks(app):
+    user = UserFactory.create()
+    for i in range(7):
+        OrderFactory.create(ordered_by=user)
+    db.session.commit()
+    stats = OrganizationStats.for_organization(user.organization_id, chunk_size=2)
+    assert len(stats.totals) == 7
+    assert sum(count for _, count, _ in stats.daily()) == 7
+
+
+def test_empty(client):
+    org = OrganizationFactory.create()
+    db.session.commit()
+    response = client.get("/api/organizations/{}/stats".format(org.id))
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["order_count"] == 0
+    assert obj["order_size"]["p50"] is None
+    assert obj["external_share"] is None
@@ -3,9 +3,13 @@ from __future__ import unicode_literals
 
 import json
 import pytest
+import sqlalchemy as sa
 from seamless_karma.extensions import db
-from factories import OrganizationFactory, UserFactory
+from seamless_karma import search
+from factories import OrganizationFactory, UserFactory, OrderFactory
 from six.moves.urllib.parse import urlparse
+from decimal import Decimal
+from datetime import date, timedelta
 
 
 def test_empty(client):
@@ -131,3 +135,160 @@ def test_users_by_org_name(client):
     assert o2_obj["count"] == 2
     assert o2_obj["data"][0]["first_name"] == u2.first_name
     assert o2_obj["data"][1]["last_name"] == u3.last_name
+
+
+def test_get_releases_connection(app, client, users):
+    checked_out = []
+    outstanding = []
+    def checkout(dbapi_connection, record, proxy):
+        checked_out.append(record)
+    def checkin(dbapi_connection, record):
+        checked_out.remove(record)
+    def after_request(response):
+        outstanding.append(len(checked_out))
+        return response
+    sa.event.listen(db.engine, "checkout", checkout)
+    sa.event.listen(db.engine, "checkin", checkin)
+    app.after_request(after_request)
+    try:
+        response = client.get('/api/users')
+    finally:
+        sa.event.remove(db.engine, "checkout", checkout)
+        sa.event.remove(db.engine, "checkin", checkin)
+        app.after_request_funcs[None].remove(after_request)
+    assert response.status_code == 200
+    # the view's transaction ended and gave its connection back to the pool
+    # before the request was torn down
+    assert outstanding == [0]
+
+
+def test_update_allocation_keeps_history(client):
+    user = UserFactory.create(allocation=Decimal("10.00"))
+    yesterday = date.today() - timedelta(days=1)
+    db.session.commit()
+    response = client.put("/api/users/{}".format(user.id),
+        data={
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "allocation": "12.50",
+        })
+    assert response.status_code == 200
+    url = "/api/organizations/{org_id}/orders/{date}/unallocated?nonparticipants=1"
+    response = client.get(url.format(org_id=user.organization_id, date=yesterday))
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["total_unallocated"] == "10.00"
+    response = client.get(url.format(org_id=user.organization_id, date=date.today()))
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["total_unallocated"] == "12.50"
+
+
+def test_karma_history(client):
+    u1 = UserFactory.create()
+    u2 = UserFactory.create(organization=u1.organization)
+    OrderFactory.create(for_date=date(2014, 2, 10), ordered_by=u2,
+        contributions=((u1, Decimal("12.50")),))
+    OrderFactory.create(for_date=date(2014, 2, 20), ordered_by=u1,
+        contributions=((u2, Decimal("3.00")),))
+    OrderFactory.create(for_date=date(2014, 3, 5), ordered_by=u1,
+        contributions=((u1, Decimal("4.00")), (u2, Decimal("11.25"))))
+    db.session.commit()
+    url = "/api/users/{}/karma/history".format(u1.id)
+
+    response = client.get(url, query_string={"granularity": "month"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj == {"granularity": "month", "data": [
+        {"date": "2014-02-01", "given": "12.50", "received": "3.00", "karma": "9.50"},
+        {"date": "2014-03-01", "given": "0.00", "received": "11.25", "karma": "-1.75"},
+    ]}
+
+    response = client.get(url, query_string={"from": "2014-02-15"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [(row["date"], row["karma"]) for row in obj["data"]] == [
+        ("2014-02-20", "9.50"), ("2014-03-05", "-1.75"),
+    ]
+
+    response = client.get(url, query_string={"granularity": "year"})
+    assert response.status_code == 400
+
+
+def test_search(app, client, monkeypatch):
+    # keep the in-memory index between requests, so that it has to be
+    # updated rather than rebuilt
+    app.config["SEARCH_INDEX_TTL"] = 300
+    monkeypatch.setattr(search.users, "index", None)
+    org = OrganizationFactory.create()
+    other_org = OrganizationFactory.create()
+    john = UserFactory.create(organization=org, username="jsmith",
+        first_name="John", last_name="Smith")
+    jane = UserFactory.create(organization=org, username="jane",
+        first_name="Jane", last_name="Smyth")
+    bob = UserFactory.create(organization=other_org, username="bob",
+        first_name="Bob", last_name="Smith")
+    db.session.commit()
+    response = client.get('/api/users/search', query_string={"q": "smith"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    # "Bob Smith" has more in common with "smith" than "John Smith" does,
+    # and "Jane Smyth" isn't similar enough
+    assert [u["id"] for u in obj["data"]] == [bob.id, john.id]
+    assert obj["data"][1]["username"] == "jsmith"
+    assert 0 < obj["data"][1]["score"] < obj["data"][0]["score"] <= 1
+
+    response = client.get('/api/users/search', query_string={"q": "smith", "org": org.id})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [u["id"] for u in obj["data"]] == [john.id]
+
+    # renamed users are found by their new name
+    jane.last_name = "Smith"
+    db.session.commit()
+    response = client.get('/api/users/search', query_string={"q": "smith", "org": org.id})
+    obj = json.loads(response.get_data(as_text=True))
+    assert sorted(u["id"] for u in obj["data"]) == sorted([john.id, jane.id])
+
+    response = client.get('/api/users/search', query_string={"q": "--"})
+    assert response.status_code == 400
+
+
+def test_order_by_name(client):
+    org = OrganizationFactory.create()
+    names = [("Bob", "Smith"), ("Alice", "Smith"), ("Zoe", "Adams"), ("Alice", "Smith")]
+    users = [UserFactory.create(organization=org, username="user{}".format(i),
+                                first_name=first, last_name=last)
+             for i, (first, last) in enumerate(names)]
+    db.session.commit()
+    ids = [u.id for u in users]
+    response = client.get('/api/users', query_string={"order": "name"})
+    obj = json.loads(response.get_data(as_text=True))
+    # equal names stay in ID order
+    assert [u["id"] for u in obj["data"]] == [ids[2], ids[1], ids[3], ids[0]]
+    response = client.get('/api/organizations/{}/users'.format(org.id),
+        query_string={"order": "-name"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [u["id"] for u in obj["data"]] == [ids[0], ids[1], ids[3], ids[2]]
+    response = client.get('/api/users', query_string={"order": "karma"})
+    assert response.status_code == 400
+
+
+def test_if_match(client):
+    user = UserFactory.create()
+    db.session.commit()
+    url = "/api/users/{}".format(user.id)
+    response = client.get(url)
+    assert response.headers["ETag"] == '"1"'
+    assert json.loads(response.get_data(as_text=True))["version"] == 1
+    data = {"username": user.username, "first_name": "Jo", "last_name": user.last_name}
+
+    response = client.put(url, data=data, headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"'
+    assert json.loads(response.get_data(as_text=True))["version"] == 2
+    # someone else's change wins, and this one is refused
+    data["first_name"] = "Joe"
+    response = client.put(url, data=data, headers={"If-Match": '"1"'})
+    assert response.status_code == 412
+    assert json.loads(response.get_data(as_text=True))["message"] == \
+        "User {} has changed; its version is now 2".format(user.id)
+    assert client.delete(url, headers={"If-Match": '"1"'}).status_code == 412
+    assert client.delete(url, headers={"If-Match": '"2"'}).status_code == 200
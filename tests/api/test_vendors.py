@@ -110,3 +110,57 @@ def test_update_all(client, vendors):
     assert vendor.latitude == lat
     assert vendor.longitude == lon
 
+
+def test_near(client):
+    # around Madison Square Park
+    VendorFactory.create(name="Eataly", latitude=Decimal("40.7421"), longitude=Decimal("-73.9897"))
+    VendorFactory.create(name="Shake Shack", latitude=Decimal("40.7416"), longitude=Decimal("-73.9882"))
+    VendorFactory.create(name="Katz's", latitude=Decimal("40.7223"), longitude=Decimal("-73.9874"))
+    VendorFactory.create(name="Nowhere")
+    db.session.commit()
+    response = client.get('/api/vendors/near', query_string={
+        "lat": "40.7414", "lon": "-73.9882", "radius": "0.5"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert obj["count"] == 2
+    assert [v["name"] for v in obj["data"]] == ["Shake Shack", "Eataly"]
+    assert obj["data"][0]["distance"] < obj["data"][1]["distance"] < 0.5
+
+    response = client.get('/api/vendors/near', query_string={
+        "lat": "40.7414", "lon": "-73.9882", "radius": "3"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [v["name"] for v in obj["data"]] == ["Shake Shack", "Eataly", "Katz's"]
+
+
+def test_near_moved_vendor(client):
+    vendor = VendorFactory.create(latitude=Decimal("40.7416"), longitude=Decimal("-73.9882"))
+    db.session.commit()
+    vendor.latitude = Decimal("51.5074")
+    vendor.longitude = Decimal("-0.1278")
+    db.session.commit()
+    response = client.get('/api/vendors/near', query_string={
+        "lat": "51.5072", "lon": "-0.1275", "radius": "1"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [v["id"] for v in obj["data"]] == [vendor.id]
+
+
+def test_near_invalid(client):
+    response = client.get('/api/vendors/near', query_string={
+        "lat": "40.7", "lon": "-73.9", "radius": "500"})
+    assert response.status_code == 400
+    response = client.get('/api/vendors/near', query_string={"lat": "95", "lon": "0"})
+    assert response.status_code == 400
+
+
+def test_search(client):
+    ponzu = VendorFactory.create(name="Ponzu")
+    palace = VendorFactory.create(name="China Palace")
+    VendorFactory.create(name="Bob's Steakhouse")
+    db.session.commit()
+    response = client.get('/api/vendors/search', query_string={"q": "ponzo"})
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert [v["id"] for v in obj["data"]] == [ponzu.id]
+    response = client.get('/api/vendors/search', query_string={"q": "pal"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert [v["name"] for v in obj["data"]] == [palace.name]
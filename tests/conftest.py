@@ -1,6 +1,7 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
+import sys
 import pytest
 try:
     import seamless_karma
@@ -12,6 +13,11 @@ except ImportError:
     import seamless_karma
 from seamless_karma import create_app, extensions
 
+# the asyncio server doesn't run on Python 2
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append("test_aio.py")
+
 
 def pytest_addoption(parser):
     parser.addoption("--db", default="sqlite", metavar="BACKEND",
@@ -36,6 +42,31 @@ def app(request, pytestconfig):
     ctx.pop()
 
 
+@pytest.yield_fixture
+def file_app(tmpdir, pytestconfig):
+    """
+    An app whose database every thread can share, for tests that use the
+    database from more than one thread: each thread gets a database of its
+    own if it's SQLite in memory, so this one is a file. With ``--db
+    postgres``, it's the PostgreSQL test database.
+    """
+    if pytestconfig.option.db == "postgres":
+        app = create_app("test_postgres")
+    else:
+        app = create_app("test")
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + str(tmpdir.join("test.db"))
+    ctx = app.test_request_context()
+    ctx.push()
+    extensions.db.create_all()
+
+    yield app
+
+    extensions.db.session.remove()
+    extensions.db.drop_all(app=app)
+    extensions.db.get_engine(app).dispose()
+    ctx.pop()
+
+
 @pytest.fixture
 def db():
     return extensions.db
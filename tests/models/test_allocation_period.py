@@ -0,0 +1,45 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from factories import UserFactory, OrderFactory
+from seamless_karma.models import User, AllocationPeriod
+from seamless_karma.extensions import db
+from decimal import Decimal
+from datetime import date, timedelta
+
+
+def unallocated(user, for_date):
+    return (db.session.query(User.unallocated(for_date))
+        .filter(User.id == user.id).scalar())
+
+
+def test_change_keeps_history(app):
+    user = UserFactory.create(allocation=Decimal("10.00"))
+    today = date.today()
+    last_week = today - timedelta(days=7)
+    OrderFactory.create(for_date=last_week, ordered_by=user, contributions=(
+        (user, Decimal("4.00")),
+    ))
+    db.session.commit()
+
+    user.change_allocation(Decimal("12.00"))
+    db.session.commit()
+    assert user.allocation == Decimal("12.00")
+    assert unallocated(user, last_week) == Decimal("6.00")
+    assert unallocated(user, today) == Decimal("12.00")
+    assert user.unallocated(last_week) == Decimal("6.00")
+    assert user.allocation_on(today) == Decimal("12.00")
+
+    # a change scheduled for the future doesn't affect today
+    next_week = today + timedelta(days=7)
+    user.change_allocation(Decimal("8.00"), effective=next_week)
+    db.session.commit()
+    assert user.allocation == Decimal("12.00")
+    assert unallocated(user, today) == Decimal("12.00")
+    assert unallocated(user, next_week) == Decimal("8.00")
+    assert [(p.valid_from, p.valid_to) for p in user.allocation_periods] == [
+        (AllocationPeriod.BEGINNING, today),
+        (today, next_week),
+        (next_week, None),
+    ]
+
@@ -0,0 +1,122 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import pytest
+import sqlalchemy as sa
+from factories import (OrganizationFactory, UserFactory, VendorFactory, OrderFactory,
+    OrderContributionFactory)
+from seamless_karma.models import Change, ChangeCursor, User, Organization
+from seamless_karma.extensions import db
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+
+def logged(since=0):
+    return [(c.action, c.model, c.object_id) for c in Change.since(since)]
+
+
+def test_writes_are_logged(app):
+    org = OrganizationFactory.create()
+    u1 = UserFactory.create(organization=org)
+    u2 = UserFactory.create(organization=org)
+    vendor = VendorFactory.create()
+    db.session.commit()
+    cursor = Change.latest()
+    order = OrderFactory.create(ordered_by=u1, vendor=vendor,
+        contributions=((u1, Decimal("5.00")),))
+    db.session.commit()
+    assert logged(cursor) == [("created", "order", order.id)]
+    assert Change.query.get(Change.latest()).organization_id == org.id
+
+    cursor = Change.latest()
+    order.contributions[0].amount = Decimal("6.00")
+    u2.first_name = "Zed"
+    db.session.commit()
+    assert logged(cursor) == [("updated", "order", order.id), ("updated", "user", u2.id)]
+
+    cursor = Change.latest()
+    OrderContributionFactory.create(order=order, user=u2, amount=Decimal("1.00"))
+    db.session.commit()
+    assert logged(cursor) == [("updated", "order", order.id)]
+
+    cursor = Change.latest()
+    db.session.delete(order)
+    db.session.commit()
+    assert logged(cursor) == [("deleted", "order", order.id)]
+
+    # users are changed behind the ORM's back
+    cursor = Change.latest()
+    User.bulk_change_allocation(User.query.filter(User.organization_id == org.id),
+        Decimal("9.00"))
+    db.session.commit()
+    assert logged(cursor) == [("updated", "user", u1.id), ("updated", "user", u2.id)]
+
+    # only users that matched before the change, and only once it commits
+    cursor = Change.latest()
+    User.bulk_change_allocation(User.query.filter(User.allocation == Decimal("9.00"))
+        .filter(User.id == u1.id), Decimal("8.00"))
+    assert logged(cursor) == []
+    db.session.commit()
+    assert logged(cursor) == [("updated", "user", u1.id)]
+
+
+def test_unchanged_objects_are_not_logged(app):
+    user = UserFactory.create()
+    db.session.commit()
+    cursor = Change.latest()
+    user.first_name = user.first_name
+    db.session.commit()
+    assert logged(cursor) == []
+
+
+def test_written_at_commit(app):
+    cursor = Change.latest() or 0
+    UserFactory.create()
+    db.session.flush()
+    assert logged(cursor) == []
+    db.session.rollback()
+    assert logged(cursor) == []
+    user = UserFactory.create()
+    db.session.commit()
+    assert ("created", "user", user.id) in logged(cursor)
+
+
+def test_interleaved_transactions(app):
+    if db.engine.name != "postgresql":
+        pytest.skip("SQLite runs one writing transaction at a time; run with --db postgres")
+    cursor = Change.latest() or 0
+    first, second = sa.orm.Session(bind=db.engine), sa.orm.Session(bind=db.engine)
+    try:
+        first.add(Organization(name="first", default_allocation=Decimal("10.00")))
+        first.flush()
+        second.add(Organization(name="second", default_allocation=Decimal("10.00")))
+        second.commit()
+        # a client syncs while the first transaction is still going
+        seen = [(c.model, c.object_id) for c in Change.since(cursor)]
+        cursor = Change.latest()
+        db.session.rollback()
+        first.commit()
+        seen.extend((c.model, c.object_id) for c in Change.since(cursor))
+    finally:
+        first.close()
+        second.close()
+    names = [Organization.query.get(object_id).name for _, object_id in seen]
+    assert names == ["second", "first"]
+
+
+def test_compact(app):
+    users = [UserFactory.create() for _ in range(4)]
+    db.session.commit()
+    first = Change.oldest()
+    now = datetime.utcnow()
+    db.session.add(ChangeCursor(client="a", position=first + 2, seen_at=now))
+    db.session.add(ChangeCursor(client="b", position=first + 4, seen_at=now))
+    # long gone, so doesn't hold anything back
+    db.session.add(ChangeCursor(client="c", position=first, seen_at=now - timedelta(days=30)))
+    db.session.commit()
+    assert Change.compact(now=now) == 2
+    assert Change.oldest() == first + 2
+
+    # nothing is kept forever, but the newest change always is
+    assert Change.compact(now=now + timedelta(days=60)) == Change.latest() - first - 2
+    assert Change.oldest() == Change.latest()
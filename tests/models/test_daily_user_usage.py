@@ -0,0 +1,103 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import threading
+import time
+import pytest
+from factories import UserFactory, OrderFactory
+from seamless_karma.models import User, DailyUserUsage
+from seamless_karma.extensions import db
+from decimal import Decimal
+from datetime import date, timedelta
+
+
+def usage(user, for_date):
+    return DailyUserUsage.query.get((user.id, for_date))
+
+
+def test_usage_follows_order_writes(app):
+    u1 = UserFactory.create(allocation=Decimal("10.00"))
+    u2 = UserFactory.create(organization=u1.organization, allocation=Decimal("10.00"))
+    today = date.today()
+    o1 = OrderFactory.create(for_date=today, ordered_by=u1, contributions=(
+        (u1, Decimal("6.00")), (u2, Decimal("2.50")),
+    ))
+    OrderFactory.create(for_date=today, ordered_by=u2, contributions=(
+        (u2, Decimal("4.00")),
+    ))
+    db.session.commit()
+    assert usage(u1, today).amount == Decimal("6.00")
+    assert usage(u2, today).amount == Decimal("6.50")
+    assert usage(u2, today).order_count == 2
+    assert db.session.query(User.unallocated(today)).filter(User.id == u2.id).scalar() == Decimal("3.50")
+
+    # moving an order to another day moves its usage
+    tomorrow = today + timedelta(days=1)
+    o1.for_date = tomorrow
+    db.session.commit()
+    assert usage(u1, today) is None
+    assert usage(u2, today).amount == Decimal("4.00")
+    assert usage(u2, tomorrow).amount == Decimal("2.50")
+
+    # and deleting it removes it
+    db.session.delete(o1)
+    db.session.commit()
+    assert usage(u1, tomorrow) is None
+    assert usage(u2, tomorrow) is None
+    assert usage(u2, today).order_count == 1
+    assert db.session.query(User.participated_on(tomorrow)).filter(User.id == u2.id).scalar() is False
+
+
+def test_rebuild(app):
+    user = UserFactory.create()
+    orders = [OrderFactory.create(ordered_by=user) for i in range(4)]
+    db.session.commit()
+    expected = sorted((u.user_id, u.for_date, u.amount, u.order_count)
+        for u in DailyUserUsage.query)
+    db.session.execute(DailyUserUsage.__table__.delete())
+    DailyUserUsage.rebuild(db.session.connection())
+    db.session.commit()
+    rebuilt = sorted((u.user_id, u.for_date, u.amount, u.order_count)
+        for u in DailyUserUsage.query)
+    assert rebuilt == expected
+    assert sum(count for _, _, _, count in rebuilt) == len(orders)
+
+
+def test_concurrent_refresh(app):
+    if db.engine.name != "postgresql":
+        pytest.skip("SQLite runs one writing transaction at a time; run with --db postgres")
+    user = UserFactory.create()
+    today = date.today()
+    OrderFactory.create(for_date=today, ordered_by=user, contributions=(
+        (user, Decimal("4.00")),
+    ))
+    db.session.commit()
+    user_id = user.id
+    db.session.execute(DailyUserUsage.__table__.delete())
+    db.session.commit()
+
+    first = db.engine.connect()
+    transaction = first.begin()
+    DailyUserUsage.refresh(first, user_id, today)
+    errors = []
+
+    def refresh_again():
+        # can't see the first row yet, so it tries to insert one too, and
+        # waits for the first transaction to end
+        second = db.engine.connect()
+        try:
+            with second.begin():
+                DailyUserUsage.refresh(second, user_id, today)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            second.close()
+
+    thread = threading.Thread(target=refresh_again)
+    thread.start()
+    time.sleep(0.2)
+    transaction.commit()
+    first.close()
+    thread.join()
+    assert errors == []
+    assert DailyUserUsage.query.get((user_id, today)).amount == Decimal("4.00")
@@ -0,0 +1,123 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import threading
+import pytest
+from datetime import date, datetime
+from decimal import Decimal
+from factories import UserFactory, OrderFactory, OrganizationFactory, VendorFactory
+from seamless_karma.models import Order, DailyUserUsage, AllocationExceeded
+from seamless_karma.extensions import db
+
+DAY = date(2014, 1, 1)
+
+
+@pytest.fixture
+def enforced(app):
+    app.config["ENFORCE_ALLOCATIONS"] = True
+
+
+def test_cut_back_when_over(app, enforced):
+    user = UserFactory.create(allocation=Decimal("10.00"))
+    order = OrderFactory.create(for_date=DAY, ordered_by=user,
+        contributions=[(user, Decimal("8.00"))])
+    db.session.commit()
+    user.change_allocation(Decimal("5.00"), effective=DAY)
+    db.session.commit()
+    # still over, but by less
+    order.contributions[0].amount = Decimal("6.00")
+    db.session.commit()
+    with pytest.raises(AllocationExceeded) as excinfo:
+        order.contributions[0].amount = Decimal("7.00")
+        db.session.commit()
+    db.session.rollback()
+    assert excinfo.value.overdrawn == [(user.id, DAY, Decimal("-2.00"))]
+    assert DailyUserUsage.query.get((user.id, DAY)).amount == Decimal("6.00")
+
+
+def place_orders(app, user_ids, vendor_id, amount, count, results):
+    with app.app_context():
+        for i in range(count):
+            for user_id in user_ids:
+                db.session.add(Order.create(
+                    for_date=DAY, placed_at=datetime.now(), ordered_by_id=user_id,
+                    vendor_id=vendor_id, contributions={user_id: amount}))
+                try:
+                    db.session.commit()
+                    results.append(True)
+                except AllocationExceeded:
+                    db.session.rollback()
+                    results.append(False)
+
+
+def test_concurrent_orders(file_app):
+    file_app.config["ENFORCE_ALLOCATIONS"] = True
+    org = OrganizationFactory.create()
+    vendor = VendorFactory.create()
+    shared = UserFactory.create(organization=org, allocation=Decimal("10.00"))
+    own = [UserFactory.create(organization=org, allocation=Decimal("10.00"))
+           for i in range(8)]
+    db.session.commit()
+    shared_id, own_ids, vendor_id = shared.id, [user.id for user in own], vendor.id
+
+    # everyone orders for the same user: only three orders fit
+    results = []
+    threads = [threading.Thread(target=place_orders,
+                                args=(file_app, [shared_id], vendor_id, Decimal("3.00"), 3, results))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 24
+    assert results.count(True) == 3
+    assert DailyUserUsage.query.get((shared_id, DAY)).amount == Decimal("9.00")
+
+    # everyone orders for themselves: nobody gets in anyone else's way
+    results = []
+    threads = [threading.Thread(target=place_orders,
+                                args=(file_app, [user_id], vendor_id, Decimal("2.00"), 5, results))
+               for user_id in own_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 40
+    for user_id in own_ids:
+        assert DailyUserUsage.query.get((user_id, DAY)).amount == Decimal("10.00")
+
+
+def test_separate_users_dont_wait(app, enforced):
+    if db.engine.name != "postgresql":
+        pytest.skip("SQLite only lets one transaction write at a time; run with --db postgres")
+    org = OrganizationFactory.create()
+    vendor = VendorFactory.create()
+    locked, free = [UserFactory.create(organization=org, allocation=Decimal("10.00"))
+                    for i in range(2)]
+    db.session.commit()
+    locked_id, free_id, vendor_id = locked.id, free.id, vendor.id
+
+    # another transaction is ordering for one user
+    holder = db.engine.connect()
+    transaction = holder.begin()
+    DailyUserUsage.lock(holder, [(locked_id, DAY)])
+    try:
+        # an order for someone else goes straight through
+        results = []
+        thread = threading.Thread(target=place_orders,
+            args=(app, [free_id], vendor_id, Decimal("2.00"), 1, results))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert results == [True]
+        # an order for the same user waits for it
+        waiting = threading.Thread(target=place_orders,
+            args=(app, [locked_id], vendor_id, Decimal("2.00"), 1, results))
+        waiting.start()
+        waiting.join(0.5)
+        assert waiting.is_alive()
+    finally:
+        transaction.commit()
+        holder.close()
+    waiting.join()
+    assert results == [True, True]
@@ -0,0 +1,52 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+from factories import UserFactory, OrderFactory
+from seamless_karma.models import DailyUserKarma, UserKarmaRollup
+from seamless_karma.extensions import db
+from decimal import Decimal
+from datetime import date
+
+
+def rows(model):
+    return sorted(tuple(row) for row in db.session.execute(model.__table__.select()))
+
+
+def test_history_follows_order_writes(app):
+    u1 = UserFactory.create()
+    u2 = UserFactory.create(organization=u1.organization)
+    order = OrderFactory.create(for_date=date(2014, 3, 31), ordered_by=u1,
+        contributions=((u1, Decimal("5.00")), (u2, Decimal("2.50"))))
+    OrderFactory.create(for_date=date(2014, 4, 1), ordered_by=u2,
+        contributions=((u1, Decimal("1.00")),))
+    db.session.commit()
+    assert DailyUserKarma.query.get((u2.id, date(2014, 3, 31))).given == Decimal("2.50")
+    assert DailyUserKarma.query.get((u1.id, date(2014, 3, 31))).received == Decimal("2.50")
+    # both orders are in the same week, but in different months
+    week = UserKarmaRollup.query.get((u1.id, "week", date(2014, 3, 31)))
+    assert (week.given, week.received) == (Decimal("1.00"), Decimal("2.50"))
+    assert UserKarmaRollup.query.get((u1.id, "month", date(2014, 3, 1))).given == 0
+
+    # moving an order moves its karma
+    order.for_date = date(2014, 4, 2)
+    db.session.commit()
+    assert DailyUserKarma.query.get((u1.id, date(2014, 3, 31))) is None
+    assert UserKarmaRollup.query.get((u1.id, "month", date(2014, 3, 1))) is None
+    month = UserKarmaRollup.query.get((u1.id, "month", date(2014, 4, 1)))
+    assert (month.given, month.received) == (Decimal("1.00"), Decimal("2.50"))
+
+
+def test_rebuild(app):
+    user = UserFactory.create()
+    for i in range(5):
+        OrderFactory.create(contributions=((user, Decimal("3.00")),))
+        OrderFactory.create(ordered_by=user)
+    db.session.commit()
+    daily, rollups = rows(DailyUserKarma), rows(UserKarmaRollup)
+    connection = db.session.connection()
+    DailyUserKarma.rebuild(connection)
+    UserKarmaRollup.rebuild(connection)
+    db.session.commit()
+    assert rows(DailyUserKarma) == daily
+    assert rows(UserKarmaRollup) == rollups
+    assert len(daily) > 0
@@ -1,7 +1,9 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from factories import OrganizationFactory, UserFactory, VendorFactory
+import pytest
+import sqlalchemy as sa
+from factories import OrganizationFactory, UserFactory, VendorFactory, OrderFactory
 from seamless_karma.models import Order, OrderContribution
 from seamless_karma.extensions import db
 from decimal import Decimal
@@ -33,3 +35,32 @@ def test_order_allocations(app):
     db.session.add(oc3)
     db.session.commit()
     assert order.total_amount == Decimal("18.05")
+
+
+def test_concurrent_update(app):
+    order = OrderFactory.create()
+    db.session.commit()
+    assert order.version == 1
+    # another transaction changes the order after this one loaded it
+    table = Order.__table__
+    db.session.connection().execute(table.update()
+        .where(table.c.id == order.id).values(version=table.c.version + 1))
+    order.seamless_id = 12345
+    with pytest.raises(sa.orm.exc.StaleDataError):
+        db.session.commit()
+    db.session.rollback()
+
+
+def test_core_insert_version(app):
+    # rows inserted without the ORM, as by the benchmarks, start at version 1
+    from seamless_karma.models import Organization, User, Vendor
+    connection = db.session.connection()
+    org_id = connection.execute(Organization.__table__.insert().values(
+        name="Core", default_allocation=Decimal("10.00"))).inserted_primary_key[0]
+    connection.execute(User.__table__.insert().values(
+        username="core", first_name="Co", last_name="Re", allocation=Decimal("10.00"),
+        organization_id=org_id))
+    connection.execute(Vendor.__table__.insert().values(name="Core Deli"))
+    for model in (Organization, User, Vendor):
+        assert connection.execute(sa.select([model.version])).scalar() == 1
+    db.session.rollback()
@@ -0,0 +1,116 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import asyncio
+import json
+import socket
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from http.client import HTTPConnection
+import pytest
+from seamless_karma.aio import Server
+from seamless_karma.extensions import db
+from factories import UserFactory, OrderFactory, OrganizationFactory
+
+
+@pytest.yield_fixture
+def server(file_app):
+    file_app.config["LIVE_HEARTBEAT"] = 0.05
+    loop = asyncio.new_event_loop()
+    server = Server(file_app, threads=2)
+    listener = loop.run_until_complete(server.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    server.port = listener.sockets[0].getsockname()[1]
+
+    yield server
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    listener.close()
+    loop.run_until_complete(listener.wait_closed())
+    loop.close()
+    server.executor.shutdown()
+
+
+def test_requests(file_app, server):
+    org = OrganizationFactory.create(name="Acme")
+    db.session.commit()
+    connection = HTTPConnection("127.0.0.1", server.port, timeout=5)
+    connection.request("GET", "/api/organizations/{}".format(org.id))
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read().decode("utf-8")) == \
+        json.loads(file_app.test_client().get("/api/organizations/{}".format(org.id)).data.decode("utf-8"))
+    # on the same connection
+    connection.request("POST", "/api/vendors", body="name=Pizza+Place",
+        headers={"Content-Type": "application/x-www-form-urlencoded"})
+    response = connection.getresponse()
+    assert response.status == 201
+    assert json.loads(response.read().decode("utf-8"))["message"] == "created"
+    connection.request("GET", "/api/nothing")
+    assert connection.getresponse().status == 404
+    connection.close()
+
+
+def test_bad_request(server):
+    client = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    client.sendall(b"nonsense\r\n\r\n")
+    assert client.recv(1024).startswith(b"HTTP/1.1 400 ")
+    client.close()
+
+
+def open_stream(port, url):
+    client = socket.create_connection(("127.0.0.1", port), timeout=5)
+    client.sendall("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(url).encode("ascii"))
+    return client, client.makefile("rb")
+
+
+def read_event(stream):
+    """
+    Skip the response head and keepalives; return the next event.
+    """
+    while True:
+        line = stream.readline().decode("utf-8").strip()
+        if line.startswith("event: "):
+            data = stream.readline().decode("utf-8").strip()
+            return line[len("event: "):], json.loads(data[len("data: "):])
+
+
+def test_idle_streams(file_app, server):
+    org = OrganizationFactory.create()
+    user = UserFactory.create(organization=org, allocation=Decimal("10.00"))
+    db.session.commit()
+    url = "/api/organizations/{}/orders/2014-01-01/unallocated/stream".format(org.id)
+    # many more streams than threads
+    streams = [open_stream(server.port, url) for _ in range(50)]
+    for _, stream in streams:
+        assert read_event(stream)[0] == "snapshot"
+    hub = file_app.extensions["live"]
+    assert len(hub.subscriptions[(org.id, date(2014, 1, 1))]) == 50
+
+    # requests still get a thread
+    started = time.time()
+    connection = HTTPConnection("127.0.0.1", server.port, timeout=5)
+    connection.request("GET", "/api/users/{}".format(user.id))
+    assert connection.getresponse().status == 200
+    assert time.time() - started < 1
+
+    OrderFactory.create(for_date=date(2014, 1, 1), ordered_by=user,
+        contributions=[(user, Decimal("4.00"))])
+    db.session.commit()
+    for _, stream in streams:
+        assert read_event(stream) == ("unallocated", [{"id": user.id, "unallocated": "6.00"}])
+
+    # hanging up unsubscribes
+    for client, stream in streams:
+        stream.close()
+        client.close()
+    for _ in range(100):
+        if not hub.topics():
+            break
+        time.sleep(0.01)
+    assert hub.topics() == set()
+    assert server.streams == set()
@@ -0,0 +1,41 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import threading
+import pytest
+from seamless_karma.extensions import db
+from seamless_karma.fanout import fanout
+from seamless_karma.models import Organization
+from factories import OrganizationFactory
+
+
+def meet(mine, theirs):
+    # only returns True if the other query is running at the same time
+    mine.set()
+    return theirs.wait(5), Organization.query.count(), threading.current_thread().ident
+
+
+def test_concurrent(file_app):
+    OrganizationFactory.create()
+    db.session.commit()
+    a, b = threading.Event(), threading.Event()
+    results = fanout(a=(meet, (a, b)), b=(meet, (b, a)))
+    assert results["a"][:2] == results["b"][:2] == (True, 1)
+    assert results["a"][2] != results["b"][2] != threading.current_thread().ident
+
+
+def fail():
+    raise ValueError("no")
+
+
+def test_error(file_app):
+    with pytest.raises(ValueError):
+        fanout(count=(Organization.query.count, ()), fail=(fail, ()))
+
+
+def test_serial_in_memory(app):
+    # each thread would get its own empty database
+    OrganizationFactory.create()
+    db.session.commit()
+    results = fanout(a=(Organization.query.count, ()), b=(Organization.query.count, ()))
+    assert results == {"a": 1, "b": 1}
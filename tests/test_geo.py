@@ -0,0 +1,33 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import random
+from seamless_karma import geo
+
+
+def covered(ranges, lat, lon):
+    c = geo.cell(lat, lon)
+    return any(first <= c <= last for first, last in ranges)
+
+
+def test_distance():
+    # Times Square to the Empire State Building
+    assert abs(geo.distance_km(40.758, -73.9855, 40.7484, -73.9857) - 1.07) < 0.01
+    assert geo.distance_km(10, 20, 10, 20) == 0
+
+
+def test_ranges_cover_circle():
+    rng = random.Random(0)
+    for lat, lon in [(40.75, -73.98), (-33.86, 151.2), (0, 179.999), (89.99, 10)]:
+        ranges = geo.cell_ranges(lat, lon, 2.0)
+        for i in range(500):
+            other_lat = max(min(lat + rng.uniform(-0.02, 0.02), 90), -90)
+            other_lon = (lon + rng.uniform(-0.05, 0.05) + 180) % 360 - 180
+            if geo.distance_km(lat, lon, other_lat, other_lon) <= 2.0:
+                assert covered(ranges, other_lat, other_lon)
+
+
+def test_ranges_wrap_antimeridian():
+    ranges = geo.cell_ranges(0, 179.999, 1.0)
+    assert covered(ranges, 0, -179.999)
+    assert covered(ranges, 0, 179.99)
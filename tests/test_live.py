@@ -0,0 +1,73 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import socket
+import threading
+from datetime import date
+from seamless_karma.live import Hub, SocketRelay
+
+
+def test_publish(app):
+    hub = Hub(app)
+    s1 = hub.subscribe(1, date(2014, 4, 1))
+    s2 = hub.subscribe(1, date(2014, 4, 1))
+    other = hub.subscribe(2, date(2014, 4, 1))
+    hub.publish((1, date(2014, 4, 1)), "karma", [{"id": 5, "karma": "1.00"}])
+    assert s1.get(timeout=0) == s2.get(timeout=0) == ("karma", [{"id": 5, "karma": "1.00"}])
+    assert other.get(timeout=0) is None
+    hub.unsubscribe(s1)
+    hub.unsubscribe(s2)
+    assert hub.topics() == {(2, date(2014, 4, 1))}
+
+
+def test_slow_watcher_is_dropped(app):
+    hub = Hub(app)
+    subscription = hub.subscribe(1, date(2014, 4, 1))
+    for i in range(subscription.queue.maxsize + 1):
+        hub.publish((1, date(2014, 4, 1)), "karma", [])
+    assert subscription.overflowed
+    assert hub.topics() == set()
+
+
+def test_relay(app, tmpdir):
+    sender, receiver = Hub(app), Hub(app)
+    sender.relay = SocketRelay(str(tmpdir), sender, name="sender")
+    receiver.relay = SocketRelay(str(tmpdir), receiver, name="receiver")
+    received = []
+    done = threading.Event()
+
+    def orders_changed(changes, relay=True):
+        received.append((changes, relay))
+        done.set()
+    receiver.orders_changed = orders_changed
+
+    sender.orders_changed({(3, date(2014, 4, 1))})
+    assert done.wait(5)
+    assert received == [({(3, date(2014, 4, 1))}, False)]
+    # sockets of processes that have gone away are cleaned up
+    gone = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    gone.bind(str(tmpdir.join("gone.sock")))
+    gone.close()
+    sender.karma_changed({3})
+    assert not tmpdir.join("gone.sock").exists()
+    assert tmpdir.join("receiver.sock").exists()
+
+
+def test_relay_allocations(app, tmpdir):
+    sender, receiver = Hub(app), Hub(app)
+    sender.relay = SocketRelay(str(tmpdir), sender, name="sender")
+    receiver.relay = SocketRelay(str(tmpdir), receiver, name="receiver")
+    received = []
+    done = threading.Event()
+
+    def orders_changed(changes, relay=True):
+        received.append((changes, relay))
+        done.set()
+    receiver.orders_changed = orders_changed
+    receiver.subscribe(1, date(2014, 3, 31))
+    receiver.subscribe(1, date(2014, 4, 2))
+
+    # the receiver looks up the users for the days it's watching from then on
+    sender.allocations_changed({3, 4}, date(2014, 4, 1))
+    assert done.wait(5)
+    assert received == [({(3, date(2014, 4, 2)), (4, date(2014, 4, 2))}, False)]
@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import sys
+import threading
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.engine.url import make_url
+from seamless_karma import stats
+from seamless_karma.pool import (
+    InstrumentedQueuePool, ping_connection,
+    POOL_CHECKOUTS, POOL_CONNECTS, POOL_EXHAUSTED, POOL_TIMEOUTS,
+)
+from seamless_karma.metrics import REQUESTS, REQUEST_LATENCY
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert "# TYPE seamless_karma_db_pool_checkouts_total counter" in text
+    assert "# TYPE seamless_karma_http_request_duration_seconds histogram" in text
+
+
+def test_request_metrics(client):
+    labels = dict(endpoint="userlist", method="GET")
+    count = REQUESTS.value(status=200, **labels)
+    observed = stats.get_store("counter").get(
+        stats.sample_key(REQUEST_LATENCY.name + "_count", labels))
+    client.get("/api/users")
+    assert REQUESTS.value(status=200, **labels) == count + 1
+    text = client.get("/metrics").get_data(as_text=True)
+    line = ('seamless_karma_http_request_duration_seconds_bucket'
+            '{endpoint="userlist",method="GET",le="+Inf"} ')
+    assert line + stats.format_value(observed + 1) in text
+
+
+def test_pool_exhaustion():
+    checkouts = POOL_CHECKOUTS.value()
+    connects = POOL_CONNECTS.value()
+    exhausted = POOL_EXHAUSTED.value()
+    timeouts = POOL_TIMEOUTS.value()
+    engine = sa.create_engine("sqlite://", poolclass=InstrumentedQueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=0.01)
+    conn = engine.connect()
+    assert POOL_CHECKOUTS.value() == checkouts + 1
+    assert POOL_EXHAUSTED.value() == exhausted
+    with pytest.raises(sa.exc.TimeoutError):
+        engine.connect()
+    assert POOL_EXHAUSTED.value() == exhausted + 1
+    assert POOL_TIMEOUTS.value() == timeouts + 1
+    conn.close()
+    engine.connect().close()
+    assert POOL_CHECKOUTS.value() == checkouts + 2
+    assert POOL_CONNECTS.value() == connects + 1
+
+
+def test_stores_aggregate_across_processes(tmpdir, monkeypatch):
+    monkeypatch.setenv("METRICS_DIR", str(tmpdir))
+    worker1 = stats.MmapStore(str(tmpdir.join("counter_1.db")))
+    worker2 = stats.MmapStore(str(tmpdir.join("counter_2.db")))
+    key = stats.sample_key(REQUESTS.name, {"endpoint": "index"})
+    worker1.inc(key, 2)
+    worker2.inc(key, 3)
+    # grow past the initial size of the file
+    for i in range(3000):
+        worker2.inc(stats.sample_key(REQUESTS.name, {"endpoint": i}), 1)
+    assert stats.collect()[key] == 5
+    assert stats.collect()[stats.sample_key(REQUESTS.name, {"endpoint": 2999})] == 1
+    # counters survive their worker
+    stats.mark_process_dead(2)
+    assert stats.collect()[key] == 5
+    worker1.close()
+    worker2.close()
+
+
+def test_store_threads(tmpdir, monkeypatch):
+    # one thread keeps adding keys, growing and remapping the file, while
+    # the others increment the same value
+    monkeypatch.setattr(stats, "INITIAL_MMAP_SIZE", 64)
+    store = stats.MmapStore(str(tmpdir.join("counter_1.db")))
+    def increment():
+        for i in range(2000):
+            store.inc("shared", 1)
+    def add_keys():
+        for i in range(2000):
+            store.set("key{}".format(i), i)
+    threads = [threading.Thread(target=increment) for i in range(4)]
+    threads.append(threading.Thread(target=add_keys))
+    # switch threads often, so that an unlocked increment would be lost
+    if hasattr(sys, "setswitchinterval"):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+    else:
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if hasattr(sys, "setswitchinterval"):
+            sys.setswitchinterval(interval)
+        else:
+            sys.setcheckinterval(interval)
+    assert store.get("shared") == 8000
+    assert store.get("key1999") == 1999
+    store.close()
+
+
+def test_postgres_pool_options(app, db):
+    app.config["SQLALCHEMY_POOL_PRE_PING"] = True
+    app.config["SQLALCHEMY_STATEMENT_TIMEOUT"] = 5000
+    options = {}
+    db.apply_driver_hacks(app, make_url("postgresql://localhost/sk"), options)
+    assert options["poolclass"] is InstrumentedQueuePool
+    assert options["connect_args"]["options"] == "-c statement_timeout=5000"
+    assert (ping_connection, "checkout") in options["pool_events"]
+
+
+def test_pgbouncer_pool_options(app, db):
+    app.config["SQLALCHEMY_STATEMENT_TIMEOUT"] = 5000
+    app.config["SQLALCHEMY_PGBOUNCER"] = True
+    options = {}
+    db.apply_driver_hacks(app, make_url("postgresql://localhost/sk"), options)
+    # PgBouncer rejects startup options, so the timeout is set per transaction
+    assert "connect_args" not in options
+    assert len(options["pool_events"]) == 1
@@ -0,0 +1,96 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import pytest
+from decimal import Decimal
+from seamless_karma import create_app, profiler
+from seamless_karma.extensions import db
+from factories import UserFactory, OrderFactory
+
+
+@pytest.fixture
+def profiled_app(app):
+    app.config["PROFILER_TOKEN"] = "sekrit"
+    profiler.init_app(app)
+    return app
+
+
+@pytest.fixture
+def order(app):
+    user = UserFactory.create(allocation=Decimal("10.00"))
+    order = OrderFactory.create(ordered_by=user)
+    db.session.commit()
+    return order
+
+
+def unallocated_url(order):
+    return "/api/organizations/{org_id}/orders/{date}/unallocated".format(
+        org_id=order.ordered_by.organization_id, date=order.for_date)
+
+
+def test_not_installed_without_token():
+    app = create_app("test")
+    assert not isinstance(app.wsgi_app, profiler.ProfilerMiddleware)
+
+
+def test_no_token(profiled_app, order):
+    client = profiled_app.test_client()
+    response = client.get(unallocated_url(order))
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert "total_unallocated" in obj
+
+
+def test_wrong_token(profiled_app, order):
+    client = profiled_app.test_client()
+    response = client.get(unallocated_url(order),
+        headers={"X-Profile-Token": "guess"})
+    obj = json.loads(response.get_data(as_text=True))
+    assert "total_unallocated" in obj
+
+
+def test_report(profiled_app, order):
+    client = profiled_app.test_client()
+    response = client.get(unallocated_url(order),
+        headers={"X-Profile-Token": "sekrit"})
+    assert response.status_code == 200
+    report = json.loads(response.get_data(as_text=True))
+    assert report["status"] == "200 OK"
+    assert report["functions"]
+    assert len(report["sql"]) >= 2
+    slowest = report["slowest_statement"]
+    assert slowest["statement"] in [s["statement"] for s in report["sql"]]
+    assert slowest["plan"]
+
+
+def test_report_saved(profiled_app, order, tmpdir):
+    profiled_app.wsgi_app.directory = str(tmpdir)
+    client = profiled_app.test_client()
+    url = unallocated_url(order) + "?nonparticipants=true&profile_token=sekrit"
+    response = client.get(url)
+    assert response.status_code == 200
+    obj = json.loads(response.get_data(as_text=True))
+    assert "total_unallocated" in obj
+    filename = response.headers["X-Profile-Report"]
+    assert tmpdir.listdir()[0] == filename
+    report = json.loads(tmpdir.listdir()[0].read())
+    assert report["query"] == "nonparticipants=true"
+
+
+def test_constant_time_compare():
+    assert profiler.constant_time_compare(b"sekrit", b"sekrit")
+    assert not profiler.constant_time_compare(b"sekrit", b"sekrat")
+    assert not profiler.constant_time_compare(b"sekrit", b"sekri")
+
+
+def test_stream_not_profiled(profiled_app, order):
+    profiled_app.config["LIVE_HEARTBEAT"] = 0.01
+    client = profiled_app.test_client()
+    response = client.get(unallocated_url(order) + "/stream",
+        headers={"X-Profile-Token": "sekrit"}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert next(response.iter_encoded()).startswith(b"event: snapshot")
+    response.close()
+    assert profiled_app.extensions["live"].topics() == set()
@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from seamless_karma import search
+from seamless_karma.extensions import db
+from seamless_karma.search import TrigramIndex, trigrams
+from factories import OrganizationFactory, UserFactory
+
+
+def test_trigrams():
+    assert trigrams("Cat") == {"  c", " ca", "cat", "at "}
+    assert trigrams("a-b") == {"  a", " a ", "  b", " b "}
+    assert trigrams("  ") == set()
+
+
+def test_similarity_matches_pg_trgm():
+    index = TrigramIndex()
+    index.add(1, ["word"])
+    # SELECT similarity('word', 'two words') = 0.363636
+    [(object_id, score)] = index.search("two words")
+    assert object_id == 1
+    assert abs(score - 4 / 11) < 1e-6
+
+
+def test_search_ranks_and_groups():
+    index = TrigramIndex()
+    index.add(1, ["jsmith", "John Smith"], group=1)
+    index.add(2, ["jsmyth", "Jane Smyth"], group=1)
+    index.add(3, ["bob", "Bob Smith"], group=2)
+    index.add(4, ["alice", "Alice Jones"], group=2)
+    assert [id for id, _ in index.search("smith")] == [3, 1]
+    assert [id for id, _ in index.search("smyth")] == [2]
+    assert [id for id, _ in index.search("smith", group=2)] == [3]
+    # prefixes of a word match even when they are too short to be similar
+    assert [id for id, _ in index.search("al")] == [4]
+    assert index.search("zzz") == []
+
+
+def test_remove():
+    index = TrigramIndex()
+    index.add(1, ["Ponzu"])
+    index.add(1, ["Sushi Yasaka"])
+    assert index.search("ponzu") == []
+    index.remove(1)
+    assert index.search("sushi") == []
+    assert not index.postings
+    assert not index.documents
+
+
+@pytest.fixture
+def people(app):
+    org, other_org = OrganizationFactory.create(), OrganizationFactory.create()
+    john = UserFactory.create(organization=org, username="jsmith",
+        first_name="John", last_name="Smith")
+    bob = UserFactory.create(organization=other_org, username="bob",
+        first_name="Bob", last_name="Smith")
+    db.session.commit()
+    return org, john, bob
+
+
+def test_postgres_search(app, people):
+    if db.engine.name != "postgresql":
+        pytest.skip("needs pg_trgm; run with --db postgres")
+    org, john, bob = people
+    assert [id for id, _ in search.users.postgres_search("smith", None, 20)] == \
+        [bob.id, john.id]
+    assert [id for id, _ in search.users.postgres_search("smith", org.id, 20)] == [john.id]
+
+
+def test_postgres_search_query(app, people):
+    # SQLite can't run pg_trgm's functions, but it can build the query
+    org = people[0]
+    query = search.users.postgres_query("smith", org.id, 5)
+    statement = str(query.statement.compile(dialect=postgresql.dialect()))
+    assert "users.organization_id = " in statement
+    assert statement.index("WHERE") < statement.index("ORDER BY") < statement.index("LIMIT")
@@ -0,0 +1,45 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import random
+import time
+from seamless_karma.settlement import settle
+
+
+def check(balances, payments):
+    remaining = dict(balances)
+    for payer_id, payee_id, cents in payments:
+        assert cents > 0
+        remaining[payer_id] += cents
+        remaining[payee_id] -= cents
+    assert all(cents == 0 for cents in remaining.values())
+
+
+def test_settle():
+    balances = {1: 500, 2: -300, 3: -200, 4: 0}
+    payments = settle(balances)
+    assert payments == [(2, 1, 300), (3, 1, 200)]
+    check(balances, payments)
+
+
+def test_settle_empty():
+    assert settle({}) == []
+
+
+def test_settle_at_most_n_minus_one_payments():
+    rng = random.Random(0)
+    balances = dict((i, rng.randint(-5000, 5000)) for i in range(1, 1000))
+    balances[1000] = -sum(balances.values())
+    payments = settle(balances)
+    check(balances, payments)
+    assert len(payments) < len(balances)
+
+
+def test_settle_10k_users_quickly():
+    rng = random.Random(1)
+    balances = dict((i, rng.randint(-10000, 10000)) for i in range(1, 10000))
+    balances[10000] = -sum(balances.values())
+    start = time.time()
+    payments = settle(balances)
+    assert time.time() - start < 1
+    check(balances, payments)
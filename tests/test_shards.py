@@ -0,0 +1,195 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+from decimal import Decimal
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from seamless_karma import create_app, extensions
+from seamless_karma.extensions import db
+from seamless_karma.models import User, Vendor, Organization
+from seamless_karma.shards import route, merge, DEFAULT
+from seamless_karma.restful.decorators import Descending, order_by
+from factories import OrganizationFactory, UserFactory
+
+
+@pytest.yield_fixture
+def sharded_app(tmpdir):
+    """
+    An app with organization 1 on the default database, 2 on shard "east",
+    and 3 on shard "west", each database a file.
+    """
+    app = create_app("test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + str(tmpdir.join("default.db"))
+    app.config["SQLALCHEMY_SHARDS"] = {
+        "east": "sqlite:///" + str(tmpdir.join("east.db")),
+        "west": "sqlite:///" + str(tmpdir.join("west.db")),
+    }
+    app.config["SHARD_MAP"] = {2: "east", 3: "west"}
+    ctx = app.test_request_context()
+    ctx.push()
+    extensions.db.create_all()
+    shards = app.extensions["shards"]
+    shards.create_all()
+    for org_id, shard in ((1, DEFAULT), (2, "east"), (3, "west")):
+        route(shard)
+        OrganizationFactory.create(id=org_id, name="org{}".format(org_id),
+                                   default_allocation=Decimal("10.00"))
+        extensions.db.session.commit()
+    route(None)
+
+    yield app
+
+    extensions.db.session.remove()
+    extensions.db.drop_all(app=app)
+    shards.drop_all()
+    extensions.db.get_engine(app).dispose()
+    ctx.pop()
+
+
+def get_json(client, url, **query):
+    response = client.get(url, query_string=query)
+    return response.status_code, json.loads(response.get_data(as_text=True))
+
+
+def user_ids(app, shard):
+    engine = app.extensions["shards"].engine(shard)
+    return [row[0] for row in engine.execute(sa.select([User.id]).order_by(User.id))]
+
+
+def test_route_by_organization(sharded_app):
+    client = sharded_app.test_client()
+    for org_id, username in ((1, "home"), (2, "east1"), (3, "west1")):
+        response = client.post('/api/users', data={
+            "username": username, "first_name": "A", "last_name": username,
+            "organization_id": org_id,
+        })
+        assert response.status_code == 201
+    # each user is on its organization's shard, and they all got ID 1
+    for shard in (DEFAULT, "east", "west"):
+        assert user_ids(sharded_app, shard) == [1]
+
+    status, obj = get_json(client, '/api/organizations/2/users')
+    assert [u["username"] for u in obj["data"]] == ["east1"]
+    status, obj = get_json(client, '/api/organizations/3')
+    assert obj["name"] == "org3"
+    # the same ID is on every shard
+    status, obj = get_json(client, '/api/users/1')
+    assert status == 400
+    assert "more than one shard" in obj["message"]
+    status, obj = get_json(client, '/api/users/1', organization_id=3)
+    assert obj["username"] == "west1"
+
+
+def test_route_by_id(sharded_app):
+    route("west")
+    UserFactory.create(id=500, organization=Organization.query.get(3))
+    db.session.commit()
+    route(None)
+    client = sharded_app.test_client()
+    status, obj = get_json(client, '/api/users/500')
+    assert status == 200
+    assert obj["organization_id"] == 3
+    status, obj = get_json(client, '/api/users/501')
+    assert status == 404
+
+
+def test_merged_list(sharded_app):
+    names = {DEFAULT: ["b", "e", "h"], "east": ["a", "f"], "west": ["c", "d", "g"]}
+    for shard, org_id in ((DEFAULT, 1), ("east", 2), ("west", 3)):
+        route(shard)
+        org = Organization.query.get(org_id)
+        for name in names[shard]:
+            UserFactory.create(username=name, organization=org)
+        db.session.commit()
+    route(None)
+    client = sharded_app.test_client()
+
+    status, obj = get_json(client, '/api/users', order="username")
+    assert obj["count"] == 8
+    assert [u["username"] for u in obj["data"]] == list("abcdefgh")
+    status, obj = get_json(client, '/api/users', order="-username", limit=3, offset=2)
+    assert [u["username"] for u in obj["data"]] == list("fed")
+    assert "next" in obj and "prev" in obj
+    status, obj = get_json(client, '/api/organizations')
+    assert [o["id"] for o in obj["data"]] == [1, 2, 3]
+
+
+def test_route_by_org_argument(sharded_app):
+    route("east")
+    UserFactory.create(id=600, organization=Organization.query.get(2),
+        username="jsmith", first_name="John", last_name="Smith")
+    db.session.commit()
+    route(None)
+    client = sharded_app.test_client()
+    status, obj = get_json(client, '/api/changes', org=2, since=0)
+    assert status == 200
+    assert ("user", 600) in [(c["type"], c["id"]) for c in obj["data"]]
+    status, obj = get_json(client, '/api/users/search', q="smith", org=2)
+    assert [u["id"] for u in obj["data"]] == [600]
+
+
+def test_scattered_strings_sorted_bytewise(sharded_app):
+    # with the shards on PostgreSQL, each one sorts strings with the "C"
+    # collation, like Python does when it merges them
+    clause = order_by([(User.username, False), (User.id, True)], "C")
+    compiled = [str(c.compile(dialect=postgresql.dialect())) for c in clause]
+    assert compiled == ['users.username COLLATE "C" ASC', "users.id DESC"]
+
+
+def test_vendors_copied(sharded_app):
+    client = sharded_app.test_client()
+    response = client.post('/api/vendors', data={"name": "Pizza Place"})
+    vendor_id = json.loads(response.get_data(as_text=True))["id"]
+    shards = sharded_app.extensions["shards"]
+    for name in shards.names():
+        engine = shards.engine(name)
+        assert engine.execute(sa.select([Vendor.name])).fetchall() == [("Pizza Place",)]
+    assert client.put('/api/vendors/{}'.format(vendor_id),
+        data={"name": "Pizza Palace"}).status_code == 200
+    assert shards.engine("west").execute(sa.select([Vendor.name])).scalar() == "Pizza Palace"
+    response = client.post('/api/vendors', data={"name": "Closed"})
+    closed_id = json.loads(response.get_data(as_text=True))["id"]
+    assert client.delete('/api/vendors/{}'.format(closed_id)).status_code == 200
+    assert shards.engine("east").execute(sa.select([Vendor.id])).fetchall() == [(vendor_id,)]
+
+    # orders on a shard can refer to it
+    route("west")
+    UserFactory.create(id=700, organization=Organization.query.get(3))
+    db.session.commit()
+    route(None)
+    response = client.post('/api/orders', data={
+        "for_date": "2014-01-01", "ordered_by_id": 700, "vendor_id": vendor_id,
+        "contributed_by": 700, "contributed_amount": "4.00",
+    })
+    assert response.status_code == 201
+    status, obj = get_json(client, '/api/organizations/3/orders/2014-01-01/unallocated')
+    assert obj["data"][0]["unallocated"] == "6.00"
+    status, obj = get_json(client, '/api/organizations/3/dashboard', date="2014-01-01")
+    assert status == 200
+    assert obj["vendors"]["top_vendors"][0]["name"] == "Pizza Palace"
+    assert [u["id"] for u in obj["users"]] == [700]
+
+
+def test_unsharded(app, client):
+    # without shards, nothing is routed
+    OrganizationFactory.create()
+    db.session.commit()
+    status, obj = get_json(client, '/api/organizations')
+    assert obj["count"] == 1
+    assert db.session().shard is None
+
+
+def test_merge():
+    results = [
+        [((1,), "a"), ((3,), "c")],
+        [((2,), "b"), ((3,), "d")],
+        [],
+    ]
+    assert list(merge(results)) == ["a", "b", "c", "d"]
+    results = [
+        [((Descending(3),), "c"), ((Descending(1),), "a")],
+        [((Descending(2),), "b")],
+    ]
+    assert list(merge(results)) == ["c", "b", "a"]
@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import pytest
+from seamless_karma import create_app, extensions
+from seamless_karma.slowlog import RingBuffer, redact, SLOT_SIZE
+from factories import UserFactory
+
+
+@pytest.yield_fixture
+def slow_app(tmpdir):
+    # the plan is captured on a separate connection, so this needs a
+    # database that isn't private to one connection
+    app = create_app("test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}".format(tmpdir.join("sk.db"))
+    app.config["SLOW_QUERY_THRESHOLD"] = 0
+    app.config["SLOW_QUERY_DIR"] = str(tmpdir.join("slowlog"))
+    from seamless_karma import slowlog
+    slowlog.init_app(app)
+    ctx = app.test_request_context()
+    ctx.push()
+    extensions.db.create_all()
+
+    yield app
+
+    extensions.db.session.remove()
+    extensions.db.drop_all(app=app)
+    extensions.db.get_engine(app).dispose()
+    ctx.pop()
+
+
+def test_slow_queries_logged(slow_app):
+    user = UserFactory.create(first_name="Sally")
+    extensions.db.session.commit()
+    client = slow_app.test_client()
+    response = client.get("/api/users/{}".format(user.id))
+    assert response.status_code == 200
+    log = slow_app.extensions["slowlog"]
+    log.wait()
+    entries = [e for e in log.entries() if e.get("resource") == "UserDetail"]
+    assert entries
+    assert all(e["endpoint"] == "userdetail" for e in entries)
+    assert all(e["method"] == "GET" for e in entries)
+    # karma is computed by lazily loading the user's contributions and orders
+    entry = [e for e in entries if "FROM orders" in e["statement"]][0]
+    assert entry["parameters"] == [user.id]
+    assert entry["plan"]
+    # the insert ran outside of any request, with the user's name redacted
+    inserts = [e for e in log.entries() if e["statement"].startswith("INSERT INTO users")]
+    assert "Sally" not in "{}".format(inserts[0]["parameters"])
+
+
+def test_redact():
+    assert redact(("Sally", 3, None)) == ["<redacted 5 chars>", 3, None]
+    assert redact({"name": "Bob"}) == {"name": "<redacted 3 chars>"}
+
+
+def test_ring_buffer(tmpdir):
+    filename = str(tmpdir.join("ring"))
+    ring = RingBuffer(filename, size=3)
+    for i in range(5):
+        ring.append({"statement": "SELECT {}".format(i), "plan": []})
+    # oversized entries are shortened to fit in a slot
+    ring.append({"statement": "SELECT " + "x" * SLOT_SIZE, "plan": ["a"] * 10})
+    entries = RingBuffer.read_file(filename)
+    assert [e["statement"] for e in entries[:2]] == ["SELECT 3", "SELECT 4"]
+    assert entries[2]["statement"].endswith(" ...")
+    assert entries[2]["plan"] == []
+    ring.close()